@@ -0,0 +1,69 @@
+"""
+    Processor benchmark
+    ~~~~~~~~~~~~~~~~~~~
+
+    Compares the per render cost of building a new Markdown engine for
+    every document (what Processor used to do) against converting with
+    the pooled, per thread engine returned by get_markdown_engine.
+
+    Run from the repository root:
+
+        python artifacts/benchmarks/processor_benchmark.py
+"""
+import os
+import sys
+import timeit
+
+import markdown
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from wiki.core import MARKDOWN_EXTENSIONS, get_markdown_engine  # noqa: E402
+
+SAMPLE = """title: Benchmark
+
+# Benchmark page
+
+Some *emphasis*, some **strong** text and a [link](http://example.com).
+
+| Name | Value |
+|------|-------|
+| a    | 1     |
+| b    | 2     |
+
+```python
+def hello(name):
+    return 'Hello ' + name
+```
+
+* one
+* two
+* three
+"""
+
+RUNS = 500
+
+
+def render_fresh_engine():
+    return markdown.Markdown(extensions=MARKDOWN_EXTENSIONS).convert(SAMPLE)
+
+
+def render_pooled_engine():
+    return get_markdown_engine().convert(SAMPLE)
+
+
+def main():
+    # warm up imports, Pygments lexers and the pooled engine
+    render_fresh_engine()
+    render_pooled_engine()
+
+    fresh = min(timeit.repeat(render_fresh_engine, number=RUNS, repeat=3)) / RUNS
+    pooled = min(timeit.repeat(render_pooled_engine, number=RUNS, repeat=3)) / RUNS
+
+    print("new engine per render: %8.1f us" % (fresh * 1e6))
+    print("pooled engine:         %8.1f us" % (pooled * 1e6))
+    print("speedup:               %8.2fx" % (fresh / pooled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+    Storage benchmark
+    ~~~~~~~~~~~~~~~~~
+
+    Times the reads of the wiki (a page, a page of the index, a tag and a
+    search) on the in-memory storage, the baseline, and on MongoDB, to
+    show what the round trips of the MongoDB path cost.
+
+    Run from the repository root, with the connection string of a MongoDB
+    server whose wikiBenchmark database may be dropped:
+
+        python artifacts/benchmarks/storage_benchmark.py mongodb://localhost:27017
+"""
+import os
+import sys
+import timeit
+
+from flask import Flask, session
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from wiki.DataAccessObject import ensure_indexes  # noqa: E402
+from wiki.core import Page, Wiki  # noqa: E402
+from wiki.storage import MemoryStorage, MongoStorage  # noqa: E402
+
+PAGES = 1000
+RUNS = 200
+
+
+def fill(storage):
+    for number in range(PAGES):
+        page = Page(storage, 'page_%04d' % number, new_flag=True)
+        page.title = 'Page %d' % number
+        page.tags = 'tag%d, all' % (number % 10)
+        page.content = 'Page %d links to [[page_%04d]].' % (number, (number + 1) % PAGES)
+        page.save(update=False)
+
+
+def reads(wiki):
+    return {
+        'get': lambda: wiki.get('page_0500'),
+        'index page': lambda: wiki.index(after='page_0500', limit=50),
+        'tag page': lambda: wiki.index_by_tag('tag3', limit=50),
+        'search': lambda: list(wiki.iter_search('page', limit=50)),
+    }
+
+
+def main():
+    connection_string = sys.argv[1] if len(sys.argv) > 1 else 'mongodb://localhost:27017'
+    client = MongoClient(connection_string)
+    database = client.wikiBenchmark
+    app = Flask(__name__)
+    app.secret_key = 'benchmark'
+    app.add_url_rule('/<path:url>/', 'wiki.display')
+    try:
+        # the indexes the app creates on start, so the indexed path is timed
+        for name, error in ensure_indexes(database):
+            print("Could not create index %s: %s" % (name, error))
+        with app.test_request_context():
+            session['unique_id'] = 'benchmark'
+            timings = {}
+            for name, storage in (('memory', MemoryStorage()), ('mongo', MongoStorage(database))):
+                fill(storage)
+                for read, run in reads(Wiki(storage)).items():
+                    timings.setdefault(read, {})[name] = min(timeit.repeat(run, number=RUNS, repeat=3)) / RUNS
+    finally:
+        client.drop_database(database)
+    for read, timing in timings.items():
+        print("%-11s memory %8.1f us   mongo %8.1f us   %6.1fx" % (
+            read, timing['memory'] * 1e6, timing['mongo'] * 1e6, timing['mongo'] / timing['memory']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import patch
+
+import mongomock
+
+from wiki import DataAccessObject
+
+
+class TestDataAccessObject(unittest.TestCase):
+    def setUp(self):
+        DataAccessObject.configure({'CONNECTION_STRING': 'mongodb://localhost', 'MONGO_MAX_POOL_SIZE': 10,
+                                    'MONGO_READ_PREFERENCE': 'secondaryPreferred', 'MONGO_COMPRESSORS': None})
+        self.client = patch.object(DataAccessObject, 'MongoClient', side_effect=mongomock.MongoClient)
+        # the database other tests assign replaces the one of the client
+        self.assigned = vars(DataAccessObject).pop('db', None)
+
+    def tearDown(self):
+        DataAccessObject.configure(None)
+        if self.assigned is not None:
+            DataAccessObject.db = self.assigned
+
+    def test_client_is_created_on_first_use_with_the_settings(self):
+        with self.client as client:
+            self.assertEqual(client.call_count, 0)
+            DataAccessObject.get_db()
+            DataAccessObject.get_db()
+        self.assertEqual(client.call_count, 1)
+        args, options = client.call_args
+        self.assertEqual(args, ('mongodb://localhost',))
+        self.assertEqual(options['maxPoolSize'], 10)
+        self.assertEqual(options['readPreference'], 'secondaryPreferred')
+        self.assertNotIn('compressors', options)
+        self.assertIn(DataAccessObject.pool_stats, options['event_listeners'])
+
+    def test_forked_process_creates_its_own_client(self):
+        with self.client as client:
+            parent = DataAccessObject.get_client()
+            DataAccessObject._after_fork()
+            self.assertIsNot(DataAccessObject.get_client(), parent)
+        self.assertEqual(client.call_count, 2)
+
+    def test_lazy_database_uses_the_database_of_the_process(self):
+        with self.client:
+            collection = DataAccessObject.database['pages']
+            collection.insert_one({"url": "a"})
+            DataAccessObject._after_fork()
+            self.assertIsNone(collection.find_one({"url": "a"}))
+
+    def test_pool_stats(self):
+        stats = DataAccessObject.PoolStats()
+        stats.connection_created(None)
+        stats.connection_checked_out(None)
+        stats.connection_checked_out(None)
+        stats.connection_checked_in(None)
+        stats.connection_check_out_failed(None)
+        counters = stats.as_dict()
+        self.assertEqual((counters['open'], counters['checked_out'], counters['checkouts'],
+                          counters['checkout_failures']), (1, 1, 2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
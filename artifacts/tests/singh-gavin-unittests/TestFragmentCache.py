@@ -0,0 +1,79 @@
+import unittest
+
+import mongomock
+
+from wiki.core import page_moved, page_saved
+from wiki.web.fragments import LISTINGS, FragmentCache, ListingGeneration, SharedFragmentStore
+
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = FragmentCache(maxsize=2)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get(('page', 'a', 'v1')))
+        self.cache.set('a', ('page', 'a', 'v1'), '<p>a</p>')
+        self.assertEqual(self.cache.get(('page', 'a', 'v1')), '<p>a</p>')
+        self.assertIsNone(self.cache.get(('page', 'a', 'v2')))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', ('page', 'a'), 'a')
+        self.cache.set('b', ('page', 'b'), 'b')
+        self.cache.get(('page', 'a'))
+        self.cache.set('c', ('page', 'c'), 'c')
+        self.assertEqual(self.cache.get(('page', 'a')), 'a')
+        self.assertIsNone(self.cache.get(('page', 'b')))
+
+    def test_writes_drop_the_page_and_listings(self):
+        self.cache.connect()
+        self.cache.set('a', ('page', 'a'), 'a')
+        generation = self.cache.generation()
+        self.cache.set(LISTINGS, ('index', generation), 'index')
+
+        page_saved.send('a')
+        self.assertIsNone(self.cache.get(('page', 'a')))
+        self.assertIsNone(self.cache.get(('index', generation)))
+        self.assertNotEqual(self.cache.generation(), generation)
+
+    def test_move_drops_both_urls(self):
+        self.cache.connect()
+        self.cache.set('a', ('page', 'a'), 'a')
+        self.cache.set('b', ('page', 'b'), 'b')
+        page_moved.send('a', new_url='b')
+        self.assertIsNone(self.cache.get(('page', 'a')))
+        self.assertIsNone(self.cache.get(('page', 'b')))
+
+
+class TestSharedFragmentStore(unittest.TestCase):
+    def setUp(self):
+        database = mongomock.MongoClient().db
+        self.node1 = FragmentCache(2, SharedFragmentStore(database), ListingGeneration(database))
+        self.node2 = FragmentCache(2, SharedFragmentStore(database), ListingGeneration(database))
+
+    def test_fragments_are_shared(self):
+        self.node1.set('a', ('page', 'a'), 'a')
+        self.assertEqual(self.node2.get(('page', 'a')), 'a')
+
+    def test_fragments_record_when_they_were_stored(self):
+        self.node1.set('a', ('page', 'a'), 'a')
+        self.assertIn('created_at', self.node1.shared.collection.find_one({"group": 'a'}))
+
+    def test_listings_generation_is_shared(self):
+        generation = self.node2.generation()
+        self.node2.set(LISTINGS, ('index', generation), 'index')
+        self.node1.page_changed('a')
+        self.assertNotEqual(self.node2.generation(), generation)
+        self.assertIsNone(self.node1.get(('index', generation)))
+
+    def test_listings_generation_without_shared_tier(self):
+        database = mongomock.MongoClient().db
+        node1 = FragmentCache(2, listing_generation=ListingGeneration(database))
+        node2 = FragmentCache(2, listing_generation=ListingGeneration(database))
+        generation = node2.generation()
+        node1.page_changed('a')
+        self.assertNotEqual(node2.generation(), generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
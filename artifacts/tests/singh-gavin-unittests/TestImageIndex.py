@@ -0,0 +1,115 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from wiki.web import images
+from wiki.web.images import ImageIndex, ImageStore, LocalImageStore, create_image_store, make_variants
+
+
+class TestImageIndex(unittest.TestCase):
+    def setUp(self):
+        # Create a temporary image directory
+        self.directory = tempfile.mkdtemp()
+        self.touch("existing_page.png")
+        self.index = ImageIndex(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, filename):
+        open(os.path.join(self.directory, filename), 'wb').close()
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup("existing_page"), ".png")
+        self.assertIsNone(self.index.lookup("missing_page"))
+
+    def test_move_remove(self):
+        self.assertEqual(self.index.lookup("existing_page"), ".png")
+        os.rename(os.path.join(self.directory, "existing_page.png"), os.path.join(self.directory, "moved_page.png"))
+        self.index.move("existing_page", "moved_page")
+        self.assertIsNone(self.index.lookup("existing_page"))
+        self.assertEqual(self.index.lookup("moved_page"), ".png")
+
+        os.remove(os.path.join(self.directory, "moved_page.png"))
+        self.index.remove("moved_page")
+        self.assertIsNone(self.index.lookup("moved_page"))
+
+    def test_picks_up_changes_of_other_workers(self):
+        self.assertIsNone(self.index.lookup("other_page"))
+        self.touch("other_page.jpeg")
+        # make sure the directory mtime differs even on coarse filesystems
+        stat = os.stat(self.directory)
+        os.utime(self.directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.index.lookup("other_page"), ".jpeg")
+
+
+class TestLocalImageStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LocalImageStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_open(self):
+        digest = self.store.put(b"image data")
+        file, length = self.store.open(digest)
+        with file:
+            self.assertEqual(file.read(), b"image data")
+        self.assertEqual(length, len(b"image data"))
+        with self.assertRaises(KeyError):
+            self.store.open("0" * 64)
+
+    def test_identical_uploads_are_stored_once(self):
+        self.assertEqual(self.store.put(b"same"), self.store.put(b"same"))
+        blobs = [file for root, dirs, files in os.walk(self.directory) for file in files]
+        self.assertEqual(len(blobs), 1)
+
+    def test_create_image_store(self):
+        config = {'RIKI_DIR': self.directory, 'IMAGE_STORE': 'local'}
+        self.assertIsInstance(create_image_store(config, None), LocalImageStore)
+        self.assertRaises(ValueError, create_image_store, dict(config, IMAGE_STORE='s3'), None)
+        self.assertRaises(ValueError, create_image_store, dict(config, IMAGE_STORE='gridfs'), None)
+
+    def test_store_without_open_cannot_be_instantiated(self):
+        class WriteOnlyStore(ImageStore):
+            put = LocalImageStore.put
+
+        self.assertRaises(TypeError, WriteOnlyStore)
+
+
+@unittest.skipIf(images.Image is None, "Pillow is not installed")
+class TestImageVariants(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LocalImageStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def encode(self, mode, size, image_format):
+        buffer = io.BytesIO()
+        images.Image.new(mode, size).save(buffer, image_format)
+        return buffer.getvalue()
+
+    def test_make_variants(self):
+        width, variants = make_variants(self.store, self.encode('RGB', (2000, 1000), 'PNG'))
+        self.assertEqual(width, 2000)
+        self.assertEqual(sorted(variants), ['medium', 'thumb'])
+        self.assertEqual(variants['thumb']['extension'], '.jpg')
+        file, length = self.store.open(variants['thumb']['sha256'])
+        with file, images.Image.open(file) as thumb:
+            self.assertEqual(thumb.size, (270, 135))
+
+    def test_small_transparent_image(self):
+        width, variants = make_variants(self.store, self.encode('RGBA', (500, 500), 'PNG'))
+        self.assertEqual(width, 500)
+        # never upscaled, and the transparency is kept
+        self.assertEqual(list(variants), ['thumb'])
+        self.assertEqual(variants['thumb']['extension'], '.png')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import ExitStack
+from unittest.mock import patch
+
+import mongomock
+from flask import Flask, session
+
+from wiki import DataAccessObject, create_app
+from wiki.cache import PageCache, create_page_cache
+from wiki.core import Page, Wiki, encode_cursor
+from wiki.storage import MongoStorage
+from wiki.web.routes import bp, listing_key
+
+VIEW_CONFIG = """
+SECRET_KEY = 'secret'
+PRIVATE = False
+STORAGE = 'mongo'
+PAGE_CACHE_CHANGE_STREAM = False
+FRAGMENT_CACHE_SHARED = False
+"""
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = PageCache(maxsize=2, ttl=60)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"url": "a", "meta": {"title": "A"}}, self.cache.token())
+        document = self.cache.get("a")
+        self.assertEqual(document["meta"]["title"], "A")
+        # a copy, the cached document cannot be changed through it
+        document["meta"]["title"] = "changed"
+        self.assertEqual(self.cache.get("a")["meta"]["title"], "A")
+        self.assertEqual(self.cache.stats(), {'size': 1, 'backlinks': 0, 'hits': 2, 'misses': 1})
+
+    def test_least_recently_used_is_evicted(self):
+        for url in ("a", "b"):
+            self.cache.set(url, {"url": url}, self.cache.token())
+        self.cache.get("a")
+        self.cache.set("c", {"url": "c"}, self.cache.token())
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_entries_expire(self):
+        cache = PageCache(ttl=0)
+        cache.set("a", {"url": "a"}, cache.token())
+        self.assertIsNone(cache.get("a"))
+
+    def test_document_read_before_a_write_is_not_stored(self):
+        token = self.cache.token()
+        self.cache.drop("a")
+        self.cache.set("a", {"url": "a"}, token)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_backlinks_are_dropped_with_the_pages_listed(self):
+        for target in ("a", "b", "c"):
+            self.cache.set_backlinks(target, [{"url": "x"}] if target != "c" else [], self.cache.token())
+        # a write of x, which links to c now
+        self.cache.drop("x", links=["c"])
+        self.assertEqual([self.cache.get_backlinks(target) for target in ("a", "b", "c")], [None, None, None])
+
+        self.cache.set_backlinks("a", [{"url": "x"}], self.cache.token())
+        self.cache.drop("y")
+        self.assertEqual(self.cache.get_backlinks("a"), [{"url": "x"}])
+
+    def test_change_stream_events(self):
+        for url in ("a", "b"):
+            self.cache.set(url, {"url": url}, self.cache.token())
+        self.cache.apply_change({"operationType": "update", "fullDocument": {"url": "a"},
+                                 "updateDescription": {"updatedFields": {"content": "x"}}})
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("b"))
+        self.cache.apply_change({"operationType": "delete", "documentKey": {"_id": 1}})
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_create_page_cache(self):
+        self.assertIsNone(create_page_cache({'PAGE_CACHE_SIZE': 0}, None))
+        cache = create_page_cache({'PAGE_CACHE_SIZE': 5, 'PAGE_CACHE_TTL': 3}, None)
+        self.assertEqual((cache.maxsize, cache.ttl, cache.listener), (5, 3, None))
+
+
+class TestCachedMongoStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage = MongoStorage(mongomock.MongoClient().db, page_cache=PageCache())
+        self.wiki = Wiki(self.storage)
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret'
+        self.app.register_blueprint(bp)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        session['unique_id'] = 'author'
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def save(self, url, content):
+        page = Page(self.storage, url, new_flag=True)
+        page.content = content
+        page.save(update=False)
+
+    def count_reads(self):
+        return patch.object(self.storage.pages, 'find_one', wraps=self.storage.pages.find_one)
+
+    def test_hot_page_is_read_once(self):
+        self.save("alpha", "A")
+        with self.count_reads() as find_one:
+            self.wiki.get_or_404("alpha")
+            self.wiki.get_or_404("alpha")
+            self.assertTrue(self.wiki.exists("alpha"))
+            self.assertIsNone(self.wiki.get_image_ref("alpha"))
+        self.assertEqual(find_one.call_count, 1)
+
+    def test_writes_drop_the_page(self):
+        self.save("alpha", "A")
+        self.wiki.get("alpha")
+        self.save("alpha", "changed")
+        self.assertEqual(self.wiki.get("alpha").content, "changed")
+
+        self.wiki.move("alpha", "gamma")
+        self.assertIsNone(self.wiki.get("alpha"))
+        self.assertEqual(self.wiki.get("gamma").content, "changed")
+
+        self.wiki.delete("gamma")
+        self.assertIsNone(self.wiki.get("gamma"))
+
+    def test_backlinks_are_read_once(self):
+        self.save("alpha", "A")
+        self.save("beta", "See [[alpha]].")
+        with patch.object(self.storage.pages, 'find', wraps=self.storage.pages.find) as find:
+            self.assertEqual([page.url for page in self.wiki.backlinks("alpha")], ["beta"])
+            self.assertEqual([page.url for page in self.wiki.backlinks("alpha")], ["beta"])
+        self.assertEqual(find.call_count, 1)
+
+    def test_link_writes_drop_the_backlinks(self):
+        self.save("alpha", "A")
+        self.assertEqual(self.wiki.backlinks("alpha"), [])
+        self.save("beta", "See [[alpha]].")
+        self.assertEqual([page.title for page in self.wiki.backlinks("alpha")], ["beta"])
+
+        page = self.wiki.get("beta")
+        page.title = "Renamed"
+        page.save(update=False)
+        self.assertEqual([page.title for page in self.wiki.backlinks("alpha")], ["Renamed"])
+
+        self.wiki.move("beta", "gamma")
+        self.assertEqual([page.url for page in self.wiki.backlinks("alpha")], ["gamma"])
+
+        self.wiki.delete("gamma")
+        self.assertEqual(self.wiki.backlinks("alpha"), [])
+
+    def test_referrers_are_dropped(self):
+        self.save("alpha", "See [[beta]].")
+        self.assertIn("class='missing'", self.wiki.get("alpha").html)
+        self.save("beta", "B")
+        self.assertNotIn("class='missing'", self.wiki.get("alpha").html)
+
+    def test_image_variants_drop_the_page(self):
+        self.save("alpha", "A")
+        self.storage.pages.update_one({"url": "alpha"}, {"$set": {"image_ref": {"sha256": "abc"}}})
+        self.storage.page_cache.clear()
+        self.wiki.get("alpha")
+        self.storage.set_image_variants("abc", 800, {"thumb": "def"})
+        self.assertEqual(self.wiki.get_image_ref("alpha")["variants"], {"thumb": "def"})
+
+
+
+class TestPageViews(unittest.TestCase):
+    """Repeated views of a page, through the app, on the mongo storage."""
+
+    def setUp(self):
+        self.database = DataAccessObject.db = mongomock.MongoClient().db
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'config.py'), 'w') as file:
+            file.write(VIEW_CONFIG)
+        self.app = create_app(self.directory)
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as client_session:
+            client_session['unique_id'] = 'author'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count_calls(self):
+        """Patches the reads of the pages collection, returns the mocks."""
+        stack = ExitStack()
+        pages = self.database['pages']
+        mocks = [stack.enter_context(patch.object(pages, name, wraps=getattr(pages, name)))
+                 for name in ('find', 'find_one', 'count_documents', 'aggregate', 'bulk_write', 'update_one')]
+        return stack, mocks
+
+    def test_wrong_shaped_cursors_are_rejected(self):
+        number, text = encode_cursor(3), encode_cursor("beta")
+        for path in ('/index/?cursor=' + number, '/tags/?cursor=' + number, '/tag/t/?cursor=' + number,
+                     '/search/?term=x&search_by_author=1&cursor=' + number, '/search/?term=x&cursor=' + text):
+            self.assertEqual(self.client.get(path).status_code, 400, path)
+
+    def test_listings_are_cached_per_login_state(self):
+        self.assertIn(b'>Login<', self.client.get('/index/').data)
+        with self.client.session_transaction() as client_session:
+            client_session['is_authenticated'] = True
+        self.assertIn(b'>Logout<', self.client.get('/index/').data)
+
+    def test_listing_key_ignores_unrelated_arguments(self):
+        with self.app.test_request_context('/index/?page_size=9999&utm_source=x'):
+            key = listing_key('index')
+        with self.app.test_request_context('/index/?page_size=500'):
+            self.assertEqual(listing_key('index'), key)
+
+    def test_hot_page_views_do_not_touch_the_database(self):
+        # saved before the render hash was stored, it is rendered on the first view
+        self.database['pages'].insert_many([
+            {"url": "alpha", "content": "See [[beta]] and [[gone]].", "meta": {"title": "Alpha"},
+             "links": ["beta", "gone"]},
+            {"url": "beta", "content": "Back to [[alpha]].", "meta": {"title": "Beta"}, "links": ["alpha"],
+             "author": "author"}])
+        first = self.client.get('/alpha/')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn(b"class='missing'", first.data)
+        self.assertNotIn('Last-Modified', first.headers)
+        # storing the new HTML dropped the page, which is read once more
+        self.assertEqual(self.client.get('/alpha/').data, first.data)
+
+        stack, mocks = self.count_calls()
+        with stack:
+            for _ in range(3):
+                response = self.client.get('/alpha/')
+                self.assertEqual(response.data, first.data)
+            self.assertEqual(self.client.get('/alpha/', headers={'If-None-Match': first.headers['ETag']}).status_code,
+                             304)
+        self.assertEqual([mock.call_count for mock in mocks], [0] * len(mocks))
+
+
+if __name__ == '__main__':
+    unittest.main()
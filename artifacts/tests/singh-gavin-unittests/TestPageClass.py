@@ -3,7 +3,7 @@ from unittest.mock import patch
 import mongomock
 from flask import Flask, session
 
-from wiki.core import Page, DataAccessObject
+from wiki.core import Page, DataAccessObject, Processor, render_blocks, render_hash, split_blocks, wikilink
 
 class TestPage(unittest.TestCase):
     def setUp(self):
@@ -85,6 +85,55 @@ class TestPage(unittest.TestCase):
         self.assertIsNotNone(saved_page)
         self.assertEqual(saved_page['content'], new_content)
 
+    def test_save_keeps_image_variants(self):
+        image_ref = {"sha256": "a" * 64, "extension": ".png"}
+        self.mock_db.pages.insert_one({"url": "image_page", "content": "Text", "image_ref": image_ref})
+        page = Page(self.mock_db, "image_page")
+        # the variants are recorded by a background job after the page was loaded
+        self.mock_db.pages.update_one({"url": "image_page"}, {"$set": {"image_ref.variants": {"thumb": {}}}})
+        page.content = "Edited text"
+        page.save()
+
+        saved_page = self.mock_db.pages.find_one({"url": "image_page"})
+        self.assertEqual(saved_page['image_ref']['variants'], {"thumb": {}})
+
+        page.image_ref = {"sha256": "b" * 64, "extension": ".jpg"}
+        page.save()
+        saved_page = self.mock_db.pages.find_one({"url": "image_page"})
+        self.assertEqual(saved_page['image_ref'], {"sha256": "b" * 64, "extension": ".jpg"})
+
+    def test_etag(self):
+        page = Page(self.mock_db, "etag_page", new_flag=True)
+        page.content = "First"
+        page.save()
+        first = page.etag
+        self.assertEqual(Page(self.mock_db, "etag_page").etag, first)
+
+        page.content = "Second"
+        page.save()
+        self.assertNotEqual(page.etag, first)
+
+        second = page.etag
+        self.mock_db.pages.update_one({"url": "etag_page"}, {"$set": {"image_ref": {"sha256": "a" * 64}}})
+        self.assertNotEqual(Page(self.mock_db, "etag_page").etag, second)
+
+    def test_split_blocks(self):
+        text = "# Title\n\n* one\n\n* two\n\n```\ncode\n\nmore code\n```\n\nLast"
+        self.assertEqual(split_blocks(text), ["# Title", "* one\n\n* two", "```\ncode\n\nmore code\n```", "Last"])
+
+    def test_render_blocks_matches_full_render(self):
+        text = "title: Blocks\n\n# Header\n\nNote: a paragraph\n\n* one\n\n* two\n    more\n\n> quote\n\n> again"
+        full = Processor(text).process()[0]
+        blocks = render_blocks(text)
+        incremental = "\n".join(html for digest, html in blocks)
+        self.assertEqual([line for line in incremental.splitlines() if line.strip()],
+                         [line for line in full.splitlines() if line.strip()])
+
+        # an edit changes the hash of the edited block only
+        edited = render_blocks(text.replace("# Header", "# Edited"))
+        self.assertEqual([digest for digest, html in blocks if digest not in dict(edited)],
+                         [blocks[1][0]])
+
     def test_tags_property(self):
         page = Page(self.mock_db, "test_page")
         page.tags = "tag1, tag2"
@@ -117,5 +166,98 @@ class TestPage(unittest.TestCase):
         page.render()
         self.assertEqual(page._html, "")
 
+    @patch('wiki.core.session', {'unique_id': 'test_user'})
+    def test_save_stores_rendered_html(self):
+        page = Page(self.mock_db, "stored_html_page", new_flag=True)
+        page.content = "# Stored Header"
+        page.tags = "Tag1, tag2, , tag1"
+        page.save(update=False)
+
+        saved_page = self.mock_db.pages.find_one({"url": "stored_html_page"})
+        self.assertIn("<h1>Stored Header</h1>", saved_page['html'])
+        self.assertEqual(saved_page['html_hash'], render_hash("# Stored Header"))
+        self.assertEqual(saved_page['tag_list'], ["tag1", "tag2"])
+
+    def test_load_uses_stored_html(self):
+        content = "# Cached Header"
+        self.mock_db.pages.insert_one({"url": "cached_page", "content": content, "meta": {},
+                                       "html": "<p>stored</p>", "html_hash": render_hash(content)})
+        with patch('wiki.core.Processor') as processor:
+            page = Page(self.mock_db, "cached_page")
+        processor.assert_not_called()
+        self.assertEqual(page.html, "<p>stored</p>")
+
+    def test_from_document(self):
+        document = {"url": "doc_page", "content": "Doc content", "meta": {"title": "Doc"}, "tags": "t1"}
+        page = Page.from_document(self.mock_db, document)
+        self.assertEqual(page.url, "doc_page")
+        self.assertEqual(page.title, "Doc")
+        self.assertEqual(page.tags, "t1")
+        self.assertIn("Doc content", page.html)
+
+    def test_load_rerenders_stale_html(self):
+        self.mock_db.pages.insert_one({"url": "stale_page", "content": "# Fresh Header", "meta": {},
+                                       "html": "<p>stale</p>", "html_hash": render_hash("old content")})
+        page = Page(self.mock_db, "stale_page")
+        self.assertIn("<h1>Fresh Header</h1>", page.html)
+
+    @patch('wiki.core.url_for', lambda endpoint, url: '/%s/' % url)
+    def test_rerendered_html_is_stored(self):
+        # saved before the render hash was stored, and links to a missing page
+        self.mock_db.pages.insert_one({"url": "old_page", "content": "title: Old\n\nSee [[nowhere]].",
+                                       "meta": {"title": "Edited"}, "html": "<p>old</p>"})
+        Page(self.mock_db, "old_page")
+        stored = self.mock_db.pages.find_one({"url": "old_page"})
+        self.assertEqual(stored["html_hash"], render_hash(stored["content"]))
+        self.assertIn("class='missing'", stored["html"])
+        self.assertEqual(stored["missing_links"], ["nowhere"])
+        self.assertEqual(stored["meta"]["title"], "Old")
+        with patch('wiki.core.Processor') as processor:
+            page = Page(self.mock_db, "old_page")
+        processor.assert_not_called()
+        self.assertIn("class='missing'", page.html)
+
+    def test_rerendered_html_does_not_overwrite_a_save(self):
+        self.mock_db.pages.insert_one({"url": "raced_page", "content": "old", "meta": {}, "html_hash": ""})
+        page = Page(self.mock_db, "raced_page", document={"url": "raced_page", "content": "older", "meta": {},
+                                                            "html_hash": "stale"})
+        self.assertIn("older", page.html)
+        self.assertEqual(self.mock_db.pages.find_one({"url": "raced_page"})["html_hash"], "")
+
+    def test_processor_reuses_engine(self):
+        first = Processor("title: First\n\nfirst body")
+        first.process()
+        second = Processor("second body")
+        _, _, meta = second.process()
+        # the engine is pooled per thread but reset between documents
+        self.assertIs(first.md, second.md)
+        self.assertNotIn('title', meta)
+        self.assertIn("second body", second.final)
+
+    def test_wikilink(self):
+        calls = []
+
+        def formatter(endpoint, url):
+            calls.append(url)
+            return '/%s/' % url
+
+        html = wikilink("<p>[[Some Page]] and [[some page|Other]] and [[bb]]</p>", formatter)
+        self.assertEqual(html, "<p><a href='/some_page/'>Some Page</a> and "
+                               "<a href='/some_page/'>Other</a> and <a href='/bb/'>bb</a></p>")
+        # each cleaned url is formatted once
+        self.assertEqual(calls, ['some_page', 'bb'])
+
+    def test_wikilink_marks_missing_pages(self):
+        html = wikilink("[[Here]] [[Gone]]", lambda endpoint, url: '/%s/' % url, missing_links={'gone'})
+        self.assertEqual(html, "<a href='/here/'>Here</a> <a href='/gone/' class='missing'>Gone</a>")
+
+    def test_creating_a_page_drops_the_html_of_referrers(self):
+        self.mock_db.pages.insert_one({"url": "referrer", "content": "[[created]]", "links": ["created"],
+                                       "html_hash": "rendered"})
+        page = Page(self.mock_db, "created", new_flag=True)
+        page.content = "Now it exists"
+        page.save()
+        self.assertEqual(self.mock_db.pages.find_one({"url": "referrer"})["html_hash"], "")
+
 if __name__ == '__main__':
     unittest.main()
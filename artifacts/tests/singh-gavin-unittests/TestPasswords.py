@@ -0,0 +1,88 @@
+import unittest
+
+import mongomock
+from flask import Flask
+
+from wiki import DataAccessObject
+from wiki.web import passwords
+from wiki.web.user import UserManager, make_salted_hash, user_cache
+
+
+class TestPasswords(unittest.TestCase):
+    def test_hash_records_its_parameters(self):
+        for hasher in (passwords.PBKDF2Hasher(iterations=1000), passwords.ScryptHasher(n=2 ** 8)):
+            encoded = hasher.encode("secret")
+            self.assertTrue(encoded.startswith("$%s$" % hasher.name))
+            self.assertTrue(passwords.verify_password("secret", encoded))
+            self.assertFalse(passwords.verify_password("wrong", encoded))
+            self.assertEqual(passwords.decode(encoded)[0].options, hasher.options)
+
+    def test_hashes_stay_verifiable_after_the_cost_changes(self):
+        encoded = passwords.PBKDF2Hasher(iterations=1000).encode("secret")
+        configured = passwords.PBKDF2Hasher(iterations=2000)
+        self.assertTrue(passwords.verify_password("secret", encoded))
+        self.assertTrue(passwords.needs_rehash(encoded, configured))
+        self.assertFalse(passwords.needs_rehash(configured.encode("secret"), configured))
+        self.assertTrue(passwords.needs_rehash(make_salted_hash("secret"), configured))
+
+    def test_unknown_options_and_hashers(self):
+        self.assertRaises(ValueError, passwords.PBKDF2Hasher, cost=1)
+        self.assertRaises(ValueError, passwords.get_hasher, {'PASSWORD_HASHER': 'md5'})
+        self.assertRaises(NotImplementedError, passwords.verify_password, "secret", "$md5$x=1$c2FsdA$aGFzaA")
+
+    def test_hasher_without_derive_cannot_be_instantiated(self):
+        class PlainHasher(passwords.PasswordHasher):
+            name = 'plain'
+
+        self.assertRaises(TypeError, PlainHasher)
+
+    def test_calibrate_reaches_the_target(self):
+        options, elapsed = passwords.calibrate(passwords.PBKDF2Hasher, 0.005)
+        self.assertGreaterEqual(elapsed, 0.005)
+        self.assertEqual(options['digest'], 'sha256')
+
+
+class TestRehashOnLogin(unittest.TestCase):
+    def setUp(self):
+        DataAccessObject.db = mongomock.MongoClient().db
+        self.app = Flask(__name__)
+        self.app.config['PASSWORD_HASHER_OPTIONS'] = {'iterations': 1000}
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.manager = UserManager()
+
+    def tearDown(self):
+        user_cache.drop("alice")
+        self.ctx.pop()
+
+    def login(self, password):
+        user = UserManager().get_user("alice")
+        self.assertTrue(user.check_password(password))
+        return self.manager.rehash_if_needed(user, password)
+
+    def test_cleartext_password_is_rehashed(self):
+        self.manager.add_user("alice", "secret", authentication_method='cleartext')
+        self.login("secret").result()
+        stored = self.manager.collection.find_one({"name": "alice"})
+        self.assertEqual(stored["authentication_method"], 'hash')
+        self.assertNotIn("password", stored)
+        self.assertTrue(passwords.verify_password("secret", stored["hash"]))
+        self.assertIsNone(self.login("secret"))
+
+    def test_legacy_hash_is_rehashed(self):
+        self.manager.add_user("alice", "secret")
+        self.manager.collection.update_one({"name": "alice"}, {"$set": {"hash": make_salted_hash("secret")}})
+        self.login("secret").result()
+        self.assertTrue(passwords.is_encoded(self.manager.collection.find_one({"name": "alice"})["hash"]))
+
+    def test_hash_is_rehashed_when_the_cost_changes(self):
+        self.manager.add_user("alice", "secret")
+        self.assertIsNone(self.login("secret"))
+        self.app.config['PASSWORD_HASHER'] = 'scrypt'
+        self.app.config['PASSWORD_HASHER_OPTIONS'] = {'n': 2 ** 8}
+        self.login("secret").result()
+        self.assertTrue(self.manager.collection.find_one({"name": "alice"})["hash"].startswith("$scrypt$"))
+
+
+if __name__ == '__main__':
+    unittest.main()
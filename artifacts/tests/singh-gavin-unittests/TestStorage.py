@@ -0,0 +1,175 @@
+import unittest
+from unittest.mock import patch
+
+import mongomock
+from flask import Flask, session
+
+from wiki.DataAccessObject import ensure_indexes
+from wiki.core import Page, Wiki
+from wiki.search import InvertedIndex
+from wiki.storage import MemoryStorage, MongoStorage, Storage, create_storage
+from wiki.web.routes import bp
+from wiki.web.user import UserManager, user_cache
+
+
+class StorageContract(object):
+    """The behaviour every storage must have, run against each of them."""
+
+    def make_storage(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.wiki = Wiki(self.storage)
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret'
+        self.app.register_blueprint(bp)
+        self.app.config['PASSWORD_HASHER_OPTIONS'] = {'iterations': 1000}
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        session['unique_id'] = 'author'
+
+    def tearDown(self):
+        user_cache.drop("alice")
+        self.ctx.pop()
+
+    def save(self, url, content, tags="", title=None):
+        page = Page(self.storage, url, new_flag=True)
+        page.content = content
+        page.tags = tags
+        page.title = title or url
+        page.save(update=False)
+
+    def test_save_and_get(self):
+        self.save("alpha", "To [[beta]].", tags="One, two", title="Page A")
+        page = self.wiki.get("alpha")
+        self.assertEqual(page.title, "Page A")
+        self.assertIn("class='missing'", page.html)
+        self.assertTrue(self.wiki.exists("alpha"))
+        self.assertFalse(self.wiki.exists("beta"))
+        self.assertIsNone(self.wiki.get("beta"))
+        self.assertEqual(self.wiki.get_by_title("Page A")["url"], "alpha")
+        # creating the target drops the HTML that showed the link as missing
+        self.save("beta", "B")
+        self.assertNotIn("class='missing'", self.wiki.get("alpha").html)
+
+    def test_listings(self):
+        for url, tags in (("c", "x"), ("a", "x, y"), ("b", "")):
+            self.save(url, url, tags=tags)
+        self.assertEqual([page.url for page in self.wiki.index()], ["a", "b", "c"])
+        self.assertEqual([page.url for page in self.wiki.index(after="a", limit=1)], ["b"])
+        self.assertEqual([page.url for page in self.wiki.index_by_tag("X")], ["a", "c"])
+        self.assertEqual(sorted(self.wiki.get_tags()["x"]), ["a", "c"])
+        self.assertEqual(list(self.wiki.get_tags(after="x")), ["y"])
+        self.assertEqual([page.url for page in self.wiki.search_by_author("author")], ["a", "b", "c"])
+        self.assertEqual([page.url for page in self.wiki.get_all()], ["a", "b", "c"])
+
+    def test_search(self):
+        self.save("a", "nothing here", title="Gardening")
+        self.save("b", "all about gardening")
+        self.assertEqual([page.url for page in self.wiki.search("gardening")], ["a", "b"])
+        first = self.wiki.search("gardening")[0]
+        self.assertEqual([page.url for page in self.wiki.iter_search("gardening", after=[first.score, "a"])],
+                         ["b"])
+
+    def test_move_rewrites_links(self):
+        self.save("alpha", "A")
+        self.save("beta", "See [[alpha]].")
+        self.assertEqual(self.wiki.move("alpha", "gamma"), 1)
+        self.assertIsNone(self.wiki.get("alpha"))
+        self.assertIn("[[gamma", self.wiki.get("beta").content)
+        self.assertEqual([page.url for page in self.wiki.backlinks("gamma")], ["beta"])
+
+    def test_links_within_code_are_not_links(self):
+        self.save("alpha", "A")
+        self.save("beta", "See [[alpha]], written `[[alpha]]`:\n\n```\n[[alpha]]\n```")
+        self.save("delta", "~~~\n[[alpha]]\n~~~")
+        self.assertEqual([page.url for page in self.wiki.backlinks("alpha")], ["beta"])
+        self.assertEqual(self.wiki.move("alpha", "gamma"), 1)
+        self.assertEqual(self.wiki.get("beta").content,
+                         "See [[gamma|alpha]], written `[[alpha]]`:\n\n```\n[[alpha]]\n```")
+        self.assertEqual(self.wiki.get("delta").content, "~~~\n[[alpha]]\n~~~")
+
+    def test_move_onto_the_page_of_another_author(self):
+        self.save("alpha", "A")
+        session['unique_id'] = 'other'
+        self.save("beta", "B")
+        with self.assertRaises(RuntimeError):
+            self.wiki.move("beta", "alpha")
+        with self.assertRaises(RuntimeError):
+            self.storage.rename_page("beta", "alpha")
+        self.assertEqual(self.wiki.get("alpha").content, "A")
+        self.assertEqual(self.wiki.get("beta").content, "B")
+
+    def test_delete_and_broken_links(self):
+        self.save("alpha", "A")
+        self.save("beta", "See [[alpha]] and [[gone]].")
+        self.assertTrue(self.wiki.delete("alpha"))
+        self.assertFalse(self.wiki.delete("alpha"))
+        self.assertEqual(self.wiki.broken_links(batch_size=1), [("alpha", ["beta"]), ("gone", ["beta"])])
+        self.assertEqual(self.storage.find_page("beta", fields=["html_hash"])["html_hash"], "")
+
+    def test_backfill(self):
+        self.save("a", "A")
+        self.assertEqual(self.wiki.backfill_links(), 0)
+
+    def test_users(self):
+        manager = UserManager(self.storage)
+        manager.add_user("alice", "secret", authentication_method='cleartext')
+        user = manager.get_user("alice")
+        self.assertTrue(user.check_password("secret"))
+        user.set("authenticated", True)
+        self.assertTrue(UserManager(self.storage).get_user("alice").is_authenticated())
+
+        manager.rehash_if_needed(user, "secret").result()
+        stored = self.storage.find_user("alice")
+        self.assertEqual(stored["authentication_method"], 'hash')
+        self.assertNotIn("password", stored)
+        # the password changed since the login, the rehash must not overwrite it
+        self.assertFalse(self.storage.update_user("alice", {"hash": "x"}, expected={"hash": "stale"}))
+
+        self.assertTrue(manager.delete_user("alice"))
+        self.assertFalse(manager.user_exists("alice"))
+
+
+class TestMongoStorage(StorageContract, unittest.TestCase):
+    def make_storage(self):
+        database = mongomock.MongoClient().db
+        ensure_indexes(database)
+        return MongoStorage(database)
+
+    def test_search_fallback_is_built_once_per_write(self):
+        # mongomock cannot run $text, the in-process index stands in
+        self.save("a", "gardening")
+        with patch('wiki.storage.InvertedIndex', wraps=InvertedIndex) as build, \
+                self.assertLogs('wiki.storage', 'WARNING'):
+            self.assertEqual([page.url for page in self.wiki.search("gardening")], ["a"])
+            self.assertEqual([page.url for page in self.wiki.search("gardening")], ["a"])
+            self.assertEqual(build.call_count, 1)
+            self.save("b", "more gardening")
+            self.assertEqual([page.url for page in self.wiki.search("gardening")], ["a", "b"])
+            self.assertEqual(build.call_count, 2)
+
+
+class TestMemoryStorage(StorageContract, unittest.TestCase):
+    def make_storage(self):
+        return MemoryStorage()
+
+    def test_documents_are_copied(self):
+        self.save("a", "A")
+        self.storage.find_page("a")["meta"]["title"] = "changed"
+        self.assertEqual(self.wiki.get("a").title, "a")
+
+    def test_create_storage(self):
+        self.assertIsInstance(create_storage({'STORAGE': 'memory'}), MemoryStorage)
+        self.assertRaises(ValueError, create_storage, {'STORAGE': 'sqlite'})
+
+    def test_partial_storage_cannot_be_instantiated(self):
+        class PagesOnly(Storage):
+            find_page = MemoryStorage.find_page
+
+        self.assertRaises(TypeError, PagesOnly)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 import unittest
 from TestPageClass import TestPage  # Assuming WikiTest is the file name and also the class name
 from TestWikiClass import WikiTest   # Assuming TestPage is the file name and also the class name
+from TestImageIndex import TestImageIndex, TestLocalImageStore, TestImageVariants
+from TestFragmentCache import TestFragmentCache, TestSharedFragmentStore
+from TestTransfer import TestTransfer
+from TestUserManager import TestUserManager
+from TestPasswords import TestPasswords, TestRehashOnLogin
+from TestDataAccessObject import TestDataAccessObject
+from TestStorage import TestMongoStorage, TestMemoryStorage
+from TestPageCache import TestPageCache, TestCachedMongoStorage, TestPageViews
 
 # Create a test loader
 loader = unittest.TestLoader()
@@ -8,9 +16,26 @@ loader = unittest.TestLoader()
 # Load tests from each test class
 suite1 = loader.loadTestsFromTestCase(WikiTest)
 suite2 = loader.loadTestsFromTestCase(TestPage)
+suite3 = loader.loadTestsFromTestCase(TestImageIndex)
+suite4 = loader.loadTestsFromTestCase(TestLocalImageStore)
+suite5 = loader.loadTestsFromTestCase(TestImageVariants)
+suite6 = loader.loadTestsFromTestCase(TestFragmentCache)
+suite7 = loader.loadTestsFromTestCase(TestSharedFragmentStore)
+suite8 = loader.loadTestsFromTestCase(TestTransfer)
+suite9 = loader.loadTestsFromTestCase(TestUserManager)
+suite10 = loader.loadTestsFromTestCase(TestPasswords)
+suite11 = loader.loadTestsFromTestCase(TestRehashOnLogin)
+suite12 = loader.loadTestsFromTestCase(TestDataAccessObject)
+suite13 = loader.loadTestsFromTestCase(TestMongoStorage)
+suite14 = loader.loadTestsFromTestCase(TestMemoryStorage)
+suite15 = loader.loadTestsFromTestCase(TestPageCache)
+suite16 = loader.loadTestsFromTestCase(TestCachedMongoStorage)
+suite17 = loader.loadTestsFromTestCase(TestPageViews)
 
 # Combine the test suites
-combined_suite = unittest.TestSuite([suite1, suite2])
+combined_suite = unittest.TestSuite([suite1, suite2, suite3, suite4, suite5, suite6, suite7, suite8, suite9, suite10,
+                                     suite11, suite12, suite13, suite14,
+                                     suite15, suite16, suite17])
 
 # Run the combined test suite
 runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mongomock
+
+from wiki.transfer import URL_PLACEHOLDER, export_files, export_ndjson, import_pages, iter_export, page_file, \
+    page_path, scan_pages
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = mongomock.MongoClient().db.pages
+        self.write("Home Page.md", "title: Home\ntags: Start, Wiki\n\nSee [[Sub/Child]] and [[Nowhere]].")
+        self.write("sub/child.markdown", "A *child* page.")
+        self.write("notes.txt", "Not a page.")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+
+    def import_directory(self, workers=0):
+        return import_pages(self.collection, scan_pages(self.directory), "importer",
+                            "/%s/" % URL_PLACEHOLDER, batch_size=1, workers=workers)
+
+    def test_scan_pages(self):
+        self.assertEqual([url for url, path in scan_pages(self.directory)], ["home_page", "sub/child"])
+
+    def test_import_pages(self):
+        self.assertEqual(self.import_directory(), (2, 0))
+        home = self.collection.find_one({"url": "home_page"})
+        self.assertEqual(home["meta"]["title"], "Home")
+        self.assertEqual(home["tag_list"], ["start", "wiki"])
+        self.assertEqual(home["links"], ["nowhere", "sub/child"])
+        self.assertEqual(home["missing_links"], ["nowhere"])
+        self.assertIn("<a href='/sub/child/'>Sub/Child</a>", home["html"])
+        self.assertIn("<a href='/nowhere/' class='missing'>Nowhere</a>", home["html"])
+        self.assertEqual(home["author"], "importer")
+
+    def test_import_in_process_pool(self):
+        self.assertEqual(self.import_directory(workers=1), (2, 0))
+        self.assertIn("<em>child</em>", self.collection.find_one({"url": "sub/child"})["html"])
+
+    def test_import_is_resumable(self):
+        self.import_directory()
+        self.write("sub/child.markdown", "Changed.")
+        self.assertEqual(self.import_directory(), (1, 1))
+
+    def test_page_file(self):
+        self.assertEqual(page_file({"url": "a", "content": "Text", "meta": {"title": "A"}, "tags": "x, y"}),
+                         "title: A\ntags: x, y\n\nText")
+        self.assertEqual(page_file({"url": "a", "content": "title: Own\n\nText", "meta": {"title": "Own"},
+                                    "tags": "x"}),
+                         "tags: x\ntitle: Own\n\nText")
+
+    def test_export(self):
+        self.import_directory()
+        export = io.StringIO()
+        self.assertEqual(export_ndjson(iter_export(self.collection), export), "sub/child")
+        documents = [json.loads(line) for line in export.getvalue().splitlines()]
+        self.assertEqual([document["url"] for document in documents], ["home_page", "sub/child"])
+        self.assertNotIn("html", documents[0])
+
+        target = tempfile.mkdtemp()
+        try:
+            export_files(iter_export(self.collection, after="home_page"), target)
+            with open(os.path.join(target, "sub", "child.md"), encoding='utf-8') as file:
+                self.assertEqual(file.read(), "title: sub/child\n\nA *child* page.")
+            self.assertFalse(os.path.exists(os.path.join(target, "home_page.md")))
+        finally:
+            shutil.rmtree(target)
+
+    def test_export_stays_in_the_directory(self):
+        self.assertEqual(page_path("out", "sub/child"), os.path.join("out", "sub", "child.md"))
+        for url in ("../../x", "sub/../../x", "/x", "sub//x", "sub/.", ""):
+            self.assertRaises(ValueError, page_path, "out", url)
+        self.collection.insert_one({"url": "../escaped", "content": "Out"})
+        with self.assertRaises(ValueError):
+            export_files(iter_export(self.collection), self.directory)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.directory), "escaped.md")))
+
+
+if __name__ == '__main__':
+    unittest.main()
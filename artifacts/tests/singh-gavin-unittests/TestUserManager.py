@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import patch
+
+import mongomock
+from flask import Flask
+
+from wiki import DataAccessObject
+from wiki.web.user import UserManager, user_cache
+
+
+class TestUserManager(unittest.TestCase):
+    def setUp(self):
+        DataAccessObject.db = mongomock.MongoClient().db
+        self.app = Flask(__name__)
+        self.app.config['USER_CACHE_TTL'] = 30
+        self.app.config['PASSWORD_HASHER_OPTIONS'] = {'iterations': 1000}
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        UserManager().add_user("alice", "secret")
+
+    def tearDown(self):
+        user_cache.drop("alice")
+        self.ctx.pop()
+
+    def count_reads(self, manager):
+        return patch.object(manager.collection, 'find_one', wraps=manager.collection.find_one)
+
+    def test_user_is_read_once_per_request(self):
+        manager = UserManager()
+        with self.count_reads(manager) as find_one:
+            self.assertTrue(manager.get_user("alice").check_password("secret"))
+            self.assertTrue(manager.get_user("alice").check_password("secret"))
+            self.assertIsNone(manager.get_user("nobody"))
+            self.assertIsNone(manager.get_user("nobody"))
+        self.assertEqual(find_one.call_count, 2)
+
+    def test_user_is_cached_across_requests(self):
+        UserManager().get_user("alice")
+        manager = UserManager()
+        with self.count_reads(manager) as find_one:
+            self.assertEqual(manager.get_user("alice").name, "alice")
+        self.assertEqual(find_one.call_count, 0)
+
+    def test_set_writes_the_field_and_drops_the_cached_user(self):
+        manager = UserManager()
+        user = manager.get_user("alice")
+        # a field changed by someone else must not be overwritten
+        manager.collection.update_one({"name": "alice"}, {"$set": {"roles": ["admin"]}})
+        user.set("authenticated", True)
+
+        stored = manager.collection.find_one({"name": "alice"})
+        self.assertEqual(stored["roles"], ["admin"])
+        self.assertTrue(stored["authenticated"])
+        self.assertTrue(UserManager().get_user("alice").is_authenticated())
+
+    def test_delete_user_drops_the_cached_user(self):
+        manager = UserManager()
+        manager.get_user("alice")
+        manager.delete_user("alice")
+        self.assertIsNone(manager.get_user("alice"))
+        self.assertIsNone(UserManager().get_user("alice"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import unittest
+from unittest.mock import patch
 
 import mongomock
 from flask import Flask, session
 
 from wiki import Wiki, DataAccessObject
-from wiki.core import Page
+from wiki.cli import audit_query_shapes, plan_problem, plan_stages
+from wiki.storage import MongoStorage
+from wiki.core import Page, PageSummary, ResultPage, decode_cursor, encode_cursor, normalize_tags, \
+    unique_summaries
 
 
 class WikiTest(unittest.TestCase):
@@ -37,6 +41,14 @@ class WikiTest(unittest.TestCase):
         # since only 1 page we can match the urls
         self.assertEqual(result.url, url)
 
+    def test_get_reads_page_once(self):
+        url = "single_read_page"
+        self.mock_collection.insert_one({"url": url, "content": "Test Content", "meta": {}})
+        with patch.object(self.wiki.collection, 'find_one', wraps=self.wiki.collection.find_one) as find_one:
+            result = self.wiki.get(url)
+        self.assertEqual(find_one.call_count, 1)
+        self.assertEqual(result.content, "Test Content")
+
     def test_get_or_404(self):
         url = "existing_page"
         self.mock_collection.insert_one({"url": url, "content": "Test Content", "meta": {}})
@@ -72,6 +84,38 @@ class WikiTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             self.wiki.move(new_url, "existing_page")
 
+    def test_move_rewrites_links(self):
+        self.mock_collection.insert_one({"url": "target", "content": "Target", "links": []})
+        self.mock_collection.insert_one({"url": "referrer", "content": "See [[Target]] and [[target|it]].",
+                                         "links": ["target"], "html_hash": "stale"})
+        self.mock_collection.insert_one({"url": "other", "content": "See [[elsewhere]].", "links": ["elsewhere"]})
+
+        self.assertEqual(self.wiki.move("target", "moved"), 1)
+        referrer = self.mock_collection.find_one({"url": "referrer"})
+        self.assertEqual(referrer["content"], "See [[moved|Target]] and [[moved|it]].")
+        self.assertEqual(referrer["links"], ["moved"])
+        self.assertEqual(referrer["html_hash"], "")
+        self.assertEqual(self.mock_collection.find_one({"url": "other"})["content"], "See [[elsewhere]].")
+
+    def test_backfill_links(self):
+        self.mock_collection.insert_one({"url": "old_page", "content": "[[One]] [[two]] [[One|again]]"})
+        self.assertEqual(self.wiki.backfill_links(), 1)
+        self.assertEqual(self.mock_collection.find_one({"url": "old_page"})["links"], ["one", "two"])
+
+    def test_backlinks_and_broken_links(self):
+        self.mock_collection.insert_one({"url": "a", "content": "[[b]] [[gone]]", "links": ["b", "gone"]})
+        self.mock_collection.insert_one({"url": "b", "content": "[[a]] [[b]] [[gone]]", "links": ["a", "b", "gone"]})
+        self.mock_collection.insert_one({"url": "c", "content": "[[nowhere]]", "links": ["nowhere"]})
+
+        self.assertEqual([page.url for page in self.wiki.backlinks("b")], ["a"])
+        self.assertEqual(self.wiki.broken_links(batch_size=1), [("gone", ["a", "b"]), ("nowhere", ["c"])])
+
+    def test_delete_drops_the_html_of_referrers(self):
+        self.mock_collection.insert_one({"url": "target"})
+        self.mock_collection.insert_one({"url": "referrer", "links": ["target"], "html_hash": "rendered"})
+        self.wiki.delete("target")
+        self.assertEqual(self.mock_collection.find_one({"url": "referrer"})["html_hash"], "")
+
     def test_delete(self):
         url = "delete_page"
         # Insert a page with a specific url
@@ -96,6 +140,47 @@ class WikiTest(unittest.TestCase):
         # test if url matches, with index page[0] can be any of the 2 pages we have added previously
         self.assertIn(pages[0].url, ["page1", "page2"])
 
+    def test_index_returns_summaries(self):
+        self.mock_collection.insert_one(
+            {"url": "page1", "content": "Content1", "meta": {"title": "Title 1"}, "tags": "tag1", "author": "a"})
+        pages = self.wiki.index()
+        self.assertIsInstance(pages[0], PageSummary)
+        self.assertEqual(pages[0].title, "Title 1")
+        self.assertEqual(pages[0].tags, "tag1")
+        # summaries are built from the projection only, never from the content
+        self.assertFalse(hasattr(pages[0], "content"))
+
+    def test_index_keyset_pagination(self):
+        self.mock_collection.insert_many([{"url": url, "meta": {}} for url in ["c", "a", "d", "b"]])
+        first = ResultPage(self.wiki.index(limit=3), 2, key=lambda page: page.url)
+        self.assertEqual([page.url for page in first], ["a", "b"])
+        after = decode_cursor(first.next_cursor)
+        self.assertEqual(after, "b")
+        second = ResultPage(self.wiki.index(after=after, limit=3), 2, key=lambda page: page.url)
+        self.assertEqual([page.url for page in second], ["c", "d"])
+        self.assertIsNone(second.next_cursor)
+        with self.assertRaises(ValueError):
+            decode_cursor("not a cursor")
+        # well-formed, but not the key of this listing
+        for key in ([1, "a"], 5, {"a": 1}, None):
+            with self.assertRaises(ValueError):
+                decode_cursor(encode_cursor(key))
+        self.assertEqual(decode_cursor(encode_cursor([1.5, "a"]), scored=True), [1.5, "a"])
+        for key in ("b", [1, 2], [True, "a"], [1, "a", 2]):
+            with self.assertRaises(ValueError):
+                decode_cursor(encode_cursor(key), scored=True)
+
+    def test_search_keyset_pagination(self):
+        self.mock_collection.insert_many([
+            {"url": "page1", "content": "word", "meta": {"title": "word"}},
+            {"url": "page2", "content": "word", "meta": {}},
+            {"url": "page3", "content": "word", "meta": {}}
+        ])
+        first = list(self.wiki.iter_search("word", limit=2))
+        self.assertEqual([page.url for page in first], ["page1", "page2"])
+        rest = self.wiki.iter_search("word", after=[first[-1].score, first[-1].url])
+        self.assertEqual([page.url for page in rest], ["page3"])
+
     def test_get_by_title(self):
         # Insert a page with a specific test_title
         test_title = "Unique Title"
@@ -125,6 +210,33 @@ class WikiTest(unittest.TestCase):
         # Test search by tags
         tag_search_results = self.wiki.search("tag")
         self.assertEqual(len(tag_search_results), 2)
+        # the attrs of older versions are still accepted
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(len(self.wiki.search("tag2", attrs=['tags'])), 2)
+
+    def test_search_ranks_title_matches_first(self):
+        self.mock_collection.insert_many([
+            {"url": "content_match", "content": "All about python", "meta": {"title": "Snakes"}, "tags": ""},
+            {"url": "title_match", "content": "Nothing here", "meta": {"title": "Python"}, "tags": ""},
+            {"url": "no_match", "content": "Other", "meta": {"title": "Other"}, "tags": ""}
+        ])
+        results = self.wiki.search("python")
+        self.assertEqual([page.url for page in results], ["title_match", "content_match"])
+        # case-sensitive search does not match the lowercase content
+        self.assertEqual([page.url for page in self.wiki.search("Python", ignore_case=False)], ["title_match"])
+
+    def test_iter_search_is_lazy_and_unique(self):
+        self.mock_collection.insert_many([
+            {"url": "page1", "content": "lazy", "meta": {}, "author": "test_unique_id"},
+            {"url": "page2", "content": "lazy", "meta": {}, "author": "test_unique_id"}
+        ])
+        results = self.wiki.iter_search("lazy")
+        self.assertNotIsInstance(results, list)
+        self.assertEqual(next(results).url, "page1")
+        self.assertEqual([page.url for page in self.wiki.iter_search_by_author("test_unique_id")],
+                         ["page1", "page2"])
+        duplicated = [{"url": "a"}, {"url": "b"}, {"url": "a"}]
+        self.assertEqual([page.url for page in unique_summaries(duplicated)], ["a", "b"])
 
     def test_search_by_author(self):
         # Insert pages with different authors
@@ -158,5 +270,63 @@ class WikiTest(unittest.TestCase):
             # Check if the correct URL is associated with 'tag1'
             self.assertIn("page1", tags['tag1'])
 
+    def test_tags_of_pages_saved_before_tag_list(self):
+        self.mock_collection.insert_many([
+            {"url": "old", "meta": {}, "tags": "Tag3, tag3 , Other"},
+            {"url": "new", "meta": {}, "tags": "tag3", "tag_list": ["tag3"]},
+            {"url": "untagged", "meta": {}, "tags": ""}
+        ])
+        self.assertEqual(self.wiki.get_tags(), {"other": ["old"], "tag3": ["new", "old"]})
+        self.assertEqual(list(self.wiki.get_tags(after="other")), ["tag3"])
+        self.assertEqual([page.url for page in self.wiki.index_by_tag("TAG3")], ["new", "old"])
+        self.assertEqual(self.wiki.index_by_tag("tag"), [])
+        self.assertEqual(self.wiki.index_by_tag(""), [])
+
+    def test_ensure_indexes(self):
+        # idempotent: running it a second time changes nothing
+        self.assertEqual(DataAccessObject.ensure_indexes(self.mock_db), [])
+        self.assertEqual(DataAccessObject.ensure_indexes(self.mock_db), [])
+        self.assertTrue(self.mock_collection.index_information()['url_unique']['unique'])
+        self.assertIn('name_unique', self.mock_db.Users.index_information())
+
+    def test_plan_stages(self):
+        plan = {"stage": "FETCH", "inputStage": {"stage": "OR", "inputStages": [
+            {"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}}
+        self.assertEqual(list(plan_stages(plan)), ["FETCH", "OR", "IXSCAN", "COLLSCAN"])
+        self.assertEqual(plan_problem(["FETCH", "IXSCAN"]), None)
+        self.assertEqual(plan_problem(["SORT", "FETCH", "IXSCAN"]), "SORT")
+        self.assertEqual(plan_problem(["SORT", "COLLSCAN"]), "SCAN")
+
+    def test_audit_explains_the_sorted_shapes(self):
+        plan = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+        with patch('wiki.cli.mongo_storage', return_value=MongoStorage(self.mock_db)), \
+                patch.object(mongomock.collection.Cursor, 'explain', return_value=plan, create=True) as explain, \
+                patch.object(mongomock.collection.Cursor, 'sort', autospec=True,
+                             side_effect=lambda cursor, sort: cursor) as sort:
+            report = audit_query_shapes()
+        self.assertEqual(explain.call_count,
+                         len(MongoStorage.PAGE_QUERY_SHAPES) + len(MongoStorage.USER_QUERY_SHAPES))
+        # the listings are explained with the order they are read in
+        self.assertIn(('pages', 'list_pages', {}, [("url", 1)], ["FETCH", "IXSCAN"]), report)
+        self.assertEqual(sort.call_count, len([shape for shape in MongoStorage.PAGE_QUERY_SHAPES if shape[2]]))
+
+    def test_get_tags_pagination(self):
+        self.mock_collection.insert_many([
+            {"url": "page1", "meta": {}, "tags": "B, a", "tag_list": normalize_tags("B, a")},
+            {"url": "page2", "meta": {}, "tags": "b, c", "tag_list": normalize_tags("b, c")}
+        ])
+        self.assertEqual(self.wiki.get_tags(), {"a": ["page1"], "b": ["page1", "page2"], "c": ["page2"]})
+        self.assertEqual(list(self.wiki.get_tags(after="a", limit=1).items()), [("b", ["page1", "page2"])])
+
+    def test_index_by_tag_matches_exactly(self):
+        self.mock_collection.insert_many([
+            {"url": "page1", "meta": {}, "tags": "Py", "tag_list": normalize_tags("Py")},
+            {"url": "page2", "meta": {}, "tags": "happy", "tag_list": normalize_tags("happy")}
+        ])
+        pages = self.wiki.index_by_tag("py")
+        self.assertEqual([page.url for page in pages], ["page1"])
+        self.assertIsInstance(pages[0], PageSummary)
+        self.assertEqual([page.url for page in self.wiki.index_by_tag(" HAPPY ")], ["page2"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,272 @@
+"""
+    DataAccessObject
+    ~~~~~~~~~~~~~~~~
+
+    The MongoDB client of the wiki. It is created on first use rather than
+    on import, once per process: a client must not be shared by the
+    processes forked from the one that created it (e.g. by gunicorn), so
+    a forked process creates its own. Its pool and timeouts are read from
+    the configuration passed to configure by create_app, or config.py.
+"""
+import os
+import threading
+
 import certifi
-from pymongo import MongoClient
+from pymongo import ASCENDING, TEXT, MongoClient
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
 
 from config import *
 
+DATABASE_NAME = 'wikiDB'
+
+# MongoClient option set by every setting.
+CLIENT_SETTINGS = [
+    ('MONGO_MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MONGO_MIN_POOL_SIZE', 'minPoolSize'),
+    ('MONGO_MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+    ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('MONGO_READ_PREFERENCE', 'readPreference'),
+    ('MONGO_COMPRESSORS', 'compressors'),
+]
+
+_config = None
+_client = None
+_client_lock = threading.Lock()
+
+
+class PoolStats(ConnectionPoolListener):
+    """
+    Counts the connections of the pools of the client of this process.
+
+    Attributes:
+        created (int): The connections opened.
+        closed (int): The connections closed.
+        checked_out (int): The connections in use right now.
+        checkouts (int): The connections taken from a pool.
+        checkout_failures (int): The checkouts that failed, e.g. because the
+            pool was full for longer than the wait queue timeout.
+        clears (int): The times a pool was cleared after a network error.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.created = self.closed = self.checked_out = 0
+        self.checkouts = self.checkout_failures = self.clears = 0
+
+    def as_dict(self):
+        return dict(vars(self), open=self.created - self.closed, pid=os.getpid())
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.checkouts += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+
+pool_stats = PoolStats()
+
+
+def _setting(name, default=None):
+    if _config is not None and name in _config:
+        return _config[name]
+    return globals().get(name, default)
+
+
+def client_options():
+    """
+    Returns the options of the MongoClient, from the MONGO_* settings.
+    """
+    options = {'tlsCAFile': certifi.where(), 'event_listeners': [pool_stats]}
+    for setting, option in CLIENT_SETTINGS:
+        value = _setting(setting)
+        if value is not None:
+            options[option] = value
+    return options
+
+
+def configure(config):
+    """
+    Makes the client use the settings of an app, instead of those of
+    config.py. A client created before is closed.
+    Parameters:config (flask.Config): The configuration of the app.
+    """
+    global _config
+    _config = config
+    close()
+
+
+def get_client():
+    """
+    Returns the client of this process, created on the first call.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(_setting('CONNECTION_STRING'), **client_options())
+    return _client
+
+
+def get_db():
+    return get_client()[DATABASE_NAME]
+
+
+def close():
+    """
+    Closes the client of this process; the next use creates a new one.
+    """
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
 
 class DatabaseSingleton:
-    _instance = None
+    """
+    The client and database of the current process, for the code that
+    still asks the singleton for them.
+    """
+
+    @property
+    def client(self):
+        return get_client()
+
+    @property
+    def db(self):
+        return get_db()
+
+
+def _after_fork():
+    # the pool of the parent holds its sockets, which must not be used, nor
+    # closed, by the child
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+    pool_stats.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def __getattr__(name):
+    # DataAccessObject.db is the database of the client of this process;
+    # tests replace it by assigning the attribute
+    if name == 'db':
+        return get_db()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class LazyCollection(object):
+    """
+    Stands in for a collection of the database of the current process, for
+    objects created once per app that outlive a fork.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(_current_db()[self.name], attribute)
+
+
+class LazyDatabase(object):
+    """
+    Stands in for the database of the current process, see LazyCollection.
+    """
+
+    def __getitem__(self, name):
+        return LazyCollection(name)
+
+    def __getattr__(self, name):
+        return getattr(_current_db(), name)
+
+    def resolve(self):
+        """
+        Returns the database of the current process itself, for APIs that
+        need a pymongo Database, like GridFS.
+        """
+        return _current_db()
+
+
+def _current_db():
+    # honours a database assigned to DataAccessObject.db
+    database = globals().get('db')
+    return get_db() if database is None else database
+
+
+database = LazyDatabase()
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(DatabaseSingleton, cls).__new__(cls)
-            cls._instance.client = MongoClient(CONNECTION_STRING, tlsCAFile=certifi.where())
-            cls._instance.db = cls._instance.client.wikiDB
-        return cls._instance
+# (collection, keys, options) of every index the queries of Wiki and
+# UserManager rely on.
+INDEXES = [
+    ('pages', [('url', ASCENDING)], {'name': 'url_unique', 'unique': True}),
+    # the listings are ordered by url, which the index hands over sorted
+    ('pages', [('author', ASCENDING), ('url', ASCENDING)], {'name': 'author_url'}),
+    ('pages', [('meta.title', ASCENDING), ('author', ASCENDING)], {'name': 'title_author'}),
+    ('pages', [('tag_list', ASCENDING), ('url', ASCENDING)], {'name': 'tag_list_url'}),
+    # the referrers of a page, Wiki.move and the backlinks
+    ('pages', [('links', ASCENDING), ('url', ASCENDING)], {'name': 'links_url'}),
+    # the pages showing an image, MongoStorage.set_image_variants
+    ('pages', [('image_ref.sha256', ASCENDING)], {'name': 'image_sha256', 'sparse': True}),
+    # Wiki.search; the weights match wiki.search.FIELD_WEIGHTS
+    ('pages', [('meta.title', TEXT), ('tags', TEXT), ('content', TEXT)],
+     {'name': 'text_search', 'weights': {'meta.title': 10, 'tags': 5, 'content': 1}}),
+    ('Users', [('name', ASCENDING)], {'name': 'name_unique', 'unique': True}),
+    # wiki.web.fragments.SharedFragmentStore.drop
+    ('fragments', [('group', ASCENDING)], {'name': 'fragment_group'}),
+    # expires the shared fragments; the listing generation has no created_at
+    ('fragments', [('created_at', ASCENDING)], {'name': 'fragment_ttl', 'expireAfterSeconds': 24 * 60 * 60}),
+]
 
 
-# Now, you can create a single instance of your database like this:
-db = DatabaseSingleton().db
+def ensure_indexes(database=None):
+    """
+    Creates the indexes listed in INDEXES. Creating an index that already
+    exists is a no-op, so this is safe to run on every start of the app.
+    Parameters:database (pymongo.database.Database): The database, the shared one by default.
+    Returns:list[tuple]: (index name, error) for every index that could not be created,
+        e.g. a unique index over a collection that still holds duplicates.
+    """
+    if database is None:
+        database = _current_db()
+    failed = []
+    for collection, keys, options in INDEXES:
+        try:
+            database[collection].create_index(keys, **options)
+        except OperationFailure as error:
+            failed.append((options['name'], error))
+    return failed
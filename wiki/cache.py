@@ -0,0 +1,228 @@
+"""
+    Page cache
+    ~~~~~~~~~~
+
+    A cache of page documents by URL in front of the pages collection, so
+    a page read on every request (or several times by one) is read from
+    MongoDB once per PAGE_CACHE_TTL, and of the pages linking to each page,
+    listed on every view of it. MongoStorage drops what the pages it writes
+    change, and a ChangeStreamListener what the other app nodes write.
+"""
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache(object):
+    """
+    A least recently used cache of page documents, and of the summaries of
+    the pages linking to a page, each kept at most ttl seconds.
+
+    Attributes:
+        maxsize (int): The number of pages kept, and of backlink lists.
+        ttl (float): The seconds a page is kept.
+        listener (ChangeStreamListener): Drops the pages written elsewhere, or None.
+        hits (int): The number of lookups answered by the cache.
+        misses (int): The number of lookups that went to the database.
+    """
+
+    def __init__(self, maxsize=1024, ttl=10, listener=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.listener = listener
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()
+        self._backlinks = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def token(self):
+        """
+        Returns what set needs to tell a document read before a write from
+        one read after it; take it before reading the document.
+        """
+        if self.listener is not None:
+            self.listener.ensure_running()
+        return self._writes
+
+    def get(self, url):
+        """
+        Looks a page up.
+        Parameters:url (str): The URL of the page.
+        Returns:dict: A copy of the document of the page, or None.
+        """
+        return self._get(self._documents, url)
+
+    def set(self, url, document, token):
+        """
+        Stores the document of a page, unless a page was written since the
+        token was taken, in which case the document may be stale.
+        """
+        self._set(self._documents, url, document, token)
+
+    def get_backlinks(self, url):
+        """
+        Looks the pages linking to a page up.
+        Parameters:url (str): The URL of the linked page.
+        Returns:list[dict]: Copies of the summary documents of the linking pages, or None.
+        """
+        return self._get(self._backlinks, url)
+
+    def set_backlinks(self, url, documents, token):
+        """
+        Stores the summaries of the pages linking to a page, like set.
+        """
+        self._set(self._backlinks, url, list(documents), token)
+
+    def _get(self, entries, url):
+        with self._lock:
+            entry = entries.get(url)
+            if entry is not None and entry[0] > time.monotonic():
+                entries.move_to_end(url)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry is not None:
+                del entries[url]
+            self.misses += 1
+            return None
+
+    def _set(self, entries, url, value, token):
+        with self._lock:
+            if token != self._writes:
+                return
+            entries[url] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+            entries.move_to_end(url)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def drop(self, *urls, links=()):
+        """
+        Drops pages, called after they were written, with the backlinks
+        listing them and those of the pages they link to now.
+        Parameters:
+            urls (str): The URLs of the written pages.
+            links (list[str]): The links the written pages have now, if known.
+        """
+        targets = set(urls) | set(links)
+        self._drop_where(lambda url, document: url in urls,
+                         lambda target, documents: target in targets or
+                         any(document["url"] in urls for document in documents))
+
+    def drop_linking(self, url):
+        """
+        Drops the pages linking to a page, whose stored HTML was dropped.
+        """
+        self._drop_where(lambda referrer, document: url in document.get("links", ()))
+
+    def drop_image(self, digest):
+        """
+        Drops the pages showing an image, whose variants were recorded.
+        """
+        self._drop_where(lambda url, document: (document.get("image_ref") or {}).get("sha256") == digest)
+
+    def clear(self):
+        self._drop_where(lambda url, document: True, lambda target, documents: True)
+
+    def _drop_where(self, predicate, backlinks_predicate=None):
+        # the backlinks only list the url, title, tags, author and save time
+        # of a page, which only change when the page itself is written
+        with self._lock:
+            self._writes += 1
+            for entries, drops in ((self._documents, predicate), (self._backlinks, backlinks_predicate)):
+                if drops is not None:
+                    for url in [url for url, (_, value) in entries.items() if drops(url, value)]:
+                        del entries[url]
+
+    def apply_change(self, change):
+        """
+        Drops what a change stream event of the pages collection made stale.
+        Parameters:change (dict): The event, with the full document of updates.
+        """
+        document = change.get("fullDocument") or {}
+        updated = change.get("updateDescription", {}).get("updatedFields", {})
+        if change.get("operationType") in ("insert", "replace", "update") and "url" in document and \
+                "url" not in updated:
+            # the referrers whose HTML a write dropped have events of their own
+            self.drop(document["url"], links=document.get("links", ()))
+        else:
+            # deletes and moves only carry the _id, which is not cached
+            self.clear()
+
+    def stats(self):
+        return {'size': len(self._documents), 'backlinks': len(self._backlinks), 'hits': self.hits,
+                'misses': self.misses}
+
+
+class ChangeStreamListener(object):
+    """
+    Watches the pages collection from a background thread of every process
+    and drops the pages written by other app nodes from a PageCache. Needs
+    a replica set; on a standalone server it logs why and stops.
+    """
+
+    def __init__(self, collection, retry_delay=5):
+        self.collection = collection
+        self.retry_delay = retry_delay
+        self.cache = None
+        self.disabled = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        """
+        Starts the thread, in this process, unless it runs or was disabled.
+        """
+        if self.disabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='page-change-stream', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                with self.collection.watch(full_document='updateLookup') as stream:
+                    # what changed before the stream was open was not seen
+                    self.cache.clear()
+                    for change in stream:
+                        self.cache.apply_change(change)
+            except OperationFailure as error:
+                # e.g. a standalone server, which has no change streams
+                logger.warning('Page cache change stream disabled: %s', error)
+                break
+            except PyMongoError:
+                logger.exception('Page cache change stream failed, reopening it')
+                self.cache.clear()
+                time.sleep(self.retry_delay)
+            except Exception:
+                logger.exception('Page cache change stream disabled')
+                break
+        self.disabled = True
+        self.cache.clear()
+
+
+def create_page_cache(config, collection):
+    """
+    Creates the page cache configured by PAGE_CACHE_SIZE, PAGE_CACHE_TTL
+    and PAGE_CACHE_CHANGE_STREAM.
+    Parameters:
+        config (flask.Config): The configuration of the app.
+        collection (pymongo.collection.Collection): The pages collection.
+    Returns:PageCache: The page cache, or None if disabled.
+    """
+    maxsize = config.get('PAGE_CACHE_SIZE', 1024)
+    if not maxsize:
+        return None
+    listener = ChangeStreamListener(collection) if config.get('PAGE_CACHE_CHANGE_STREAM', False) else None
+    cache = PageCache(maxsize, config.get('PAGE_CACHE_TTL', 10), listener)
+    if listener is not None:
+        listener.cache = cache
+    return cache
@@ -0,0 +1,233 @@
+"""
+    Command line
+    ~~~~~~~~~~~~
+
+    Maintenance commands, registered on the app by create_app and run
+    through flask, e.g.:
+
+        flask --app RikiPDYea audit-indexes
+"""
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from wiki import DataAccessObject
+from wiki.core import Wiki
+from wiki.storage import MongoStorage, get_storage
+from wiki.transfer import (URL_PLACEHOLDER, export_files, export_ndjson, import_pages, iter_export,
+                           scan_pages)
+from wiki.web import passwords
+from wiki.web.fragments import LISTINGS
+
+
+def mongo_storage():
+    """
+    Returns the storage of the app, for the commands that work on the
+    MongoDB collections directly.
+    Raises:click.UsageError: If the app does not use the mongo storage.
+    """
+    storage = get_storage()
+    if not isinstance(storage, MongoStorage):
+        raise click.UsageError('This command needs STORAGE = \'mongo\' in config.py.')
+    return storage
+
+
+def plan_stages(plan):
+    """
+    Yields the name of every stage of an explain() query plan.
+    Parameters:plan (dict): The (winning) plan as returned by explain().
+    """
+    if not plan:
+        return
+    if 'stage' in plan:
+        yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        yield from plan_stages(plan.get(key))
+    for stage in plan.get('inputStages', []):
+        yield from plan_stages(stage)
+
+
+def audit_query_shapes():
+    """
+    Runs explain() on every query shape of MongoStorage, with its sort and
+    projection, so an index that serves the filter but not the sort shows
+    up as a SORT stage.
+    Returns:list[tuple]: (collection name, method, filter, sort, stages) for every shape.
+    """
+    storage = mongo_storage()
+    report = []
+    for collection, shapes in ((storage.pages, MongoStorage.PAGE_QUERY_SHAPES),
+                               (storage.users, MongoStorage.USER_QUERY_SHAPES)):
+        for method, query, sort, projection in shapes:
+            cursor = collection.find(query, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            winning_plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+            report.append((collection.name, method, query, sort, list(plan_stages(winning_plan))))
+    return report
+
+
+def plan_problem(stages):
+    """
+    Returns what is wrong with a query plan: 'SCAN' if it reads the whole
+    collection, 'SORT' if it sorts in memory, or None.
+    """
+    if 'COLLSCAN' in stages:
+        return 'SCAN'
+    if 'SORT' in stages:
+        return 'SORT'
+    return None
+
+
+@click.command('ensure-indexes')
+@with_appcontext
+def ensure_indexes_command():
+    """Create the indexes the wiki relies on."""
+    mongo_storage()
+    failed = DataAccessObject.ensure_indexes()
+    for name, error in failed:
+        click.echo('Could not create index %s: %s' % (name, error), err=True)
+    if failed:
+        raise SystemExit(1)
+    click.echo('All %d indexes are in place.' % len(DataAccessObject.INDEXES))
+
+
+@click.command('audit-indexes')
+@with_appcontext
+def audit_indexes_command():
+    """Report the query shapes that are not backed by an index."""
+    unindexed = 0
+    for collection, method, query, sort, stages in audit_query_shapes():
+        problem = plan_problem(stages)
+        unindexed += problem is not None
+        click.echo('%-4s %s.%s %s%s [%s]' % (problem or 'ok', collection, method, query,
+                                            ' sorted by %s' % sort if sort else '', ' <- '.join(stages)))
+    if unindexed:
+        click.echo('%d query shape(s) scan the whole collection or sort in memory.' % unindexed, err=True)
+        raise SystemExit(1)
+
+
+@click.command('backfill-tags')
+@with_appcontext
+def backfill_tags_command():
+    """Store the normalized tag list on pages saved without one."""
+    click.echo('Normalized the tags of %d page(s).' % Wiki().backfill_tag_lists())
+
+
+@click.command('backfill-links')
+@with_appcontext
+def backfill_links_command():
+    """Record the links of pages saved without them."""
+    click.echo('Recorded the links of %d page(s).' % Wiki().backfill_links())
+
+
+@click.command('broken-links')
+@with_appcontext
+def broken_links_command():
+    """List the links to pages that do not exist."""
+    broken = Wiki().broken_links()
+    for target, sources in broken:
+        click.echo('%s <- %s' % (target, ', '.join(sources)))
+    if broken:
+        click.echo('%d missing page(s) are linked to.' % len(broken), err=True)
+        raise SystemExit(1)
+
+
+@click.command('migrate-images')
+@with_appcontext
+def migrate_images_command():
+    """Move the images in static/Images into the image store."""
+    from wiki.web.routes import image_index, img
+    collection = mongo_storage().pages
+    migrated = 0
+    for doc in collection.find({"image_ref": None}, {"url": 1}):
+        extension = image_index.lookup(doc['url'])
+        if not extension:
+            continue
+        path = os.path.join(img, doc['url'] + extension)
+        with open(path, 'rb') as file:
+            digest = current_app.extensions['image_store'].put(file.read())
+        collection.update_one({"_id": doc["_id"]},
+                              {"$set": {"image_ref": {"sha256": digest, "extension": extension.lower()}}})
+        os.remove(path)
+        image_index.remove(doc['url'])
+        migrated += 1
+    click.echo('Moved %d image(s) into the image store.' % migrated)
+
+
+@click.command('import-pages')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--author', default='import', show_default=True, help='The author of the imported pages.')
+@click.option('--batch-size', default=500, show_default=True, help='Pages written per bulk write.')
+@click.option('--workers', type=int, default=None,
+              help='Processes rendering the pages, one per CPU by default; 0 renders in this process.')
+@with_appcontext
+def import_pages_command(directory, author, batch_size, workers):
+    """Import a directory of Markdown files as pages.
+
+    The URL of a page is the path of its file without the extension, its
+    front matter sets the title and tags. Pages imported before from the
+    same content are skipped, so an interrupted import is continued by
+    running it again.
+    """
+    collection = mongo_storage().pages
+    pages = scan_pages(directory)
+    url_template = current_app.url_map.bind(
+        'localhost', script_name=current_app.config.get('APPLICATION_ROOT')
+    ).build('wiki.display', {'url': URL_PLACEHOLDER})
+    with click.progressbar(length=len(pages), label='Importing') as bar:
+        imported, skipped = import_pages(collection, pages, author, url_template,
+                                         batch_size=batch_size, workers=workers, progress=bar.update)
+    current_app.extensions['fragment_cache'].drop(LISTINGS)
+    click.echo('Imported %d page(s), skipped %d unchanged page(s).' % (imported, skipped))
+
+
+@click.command('export-pages')
+@click.argument('target', type=click.Path())
+@click.option('--ndjson', is_flag=True,
+              help='Write a JSON document per line to TARGET (- for stdout) instead of a Markdown '
+                   'file per page to the TARGET directory.')
+@click.option('--after', help='Only export the pages after this URL, to continue an interrupted export.')
+@click.option('--batch-size', default=500, show_default=True, help='Pages read per round trip.')
+@with_appcontext
+def export_pages_command(target, ndjson, after, batch_size):
+    """Export the pages, ordered by URL."""
+    collection = mongo_storage().pages
+    total = collection.count_documents({"url": {"$gt": after}} if after else {})
+    documents = iter_export(collection, after, batch_size)
+    with click.progressbar(length=total, label='Exporting', file=click.get_text_stream('stderr')) as bar:
+        if ndjson:
+            with click.open_file(target, 'a' if after else 'w', encoding='utf-8') as file:
+                last_url = export_ndjson(documents, file, progress=bar.update)
+        else:
+            try:
+                last_url = export_files(documents, target, progress=bar.update)
+            except ValueError as error:
+                raise click.ClickException('%s, export the pages after it with --after.' % error)
+    click.echo('Exported %d page(s), the last one was %s.' % (total, last_url), err=True)
+
+
+@click.command('calibrate-hasher')
+@click.option('--hasher', 'name', type=click.Choice(sorted(passwords.HASHERS)), default='pbkdf2',
+              show_default=True)
+@click.option('--target-ms', default=250, show_default=True, help='The time a login should spend hashing.')
+def calibrate_hasher_command(name, target_ms):
+    """Find the password hashing cost for a target login time."""
+    options, elapsed = passwords.calibrate(passwords.HASHERS[name], target_ms / 1000.0)
+    click.echo('# %.0f ms per hash on this machine' % (elapsed * 1000))
+    click.echo('PASSWORD_HASHER = %r' % name)
+    click.echo('PASSWORD_HASHER_OPTIONS = %r' % options)
+
+
+def register_commands(app):
+    app.cli.add_command(ensure_indexes_command)
+    app.cli.add_command(audit_indexes_command)
+    app.cli.add_command(backfill_tags_command)
+    app.cli.add_command(backfill_links_command)
+    app.cli.add_command(broken_links_command)
+    app.cli.add_command(migrate_images_command)
+    app.cli.add_command(import_pages_command)
+    app.cli.add_command(export_pages_command)
+    app.cli.add_command(calibrate_hasher_command)
@@ -2,15 +2,66 @@
     Wiki core
     ~~~~~~~~~
 """
+import base64
+import binascii
+import functools
+import hashlib
+import json
 import re
+import threading
+import warnings
 from collections import OrderedDict
 from datetime import *
 
 import markdown
+from blinker import Namespace
 from flask import abort, session
 from flask import url_for
-
 from wiki import DataAccessObject
+from wiki.storage import MongoStorage, as_storage, get_storage
+
+# Sent with the URL of a page after it was written: saved, moved (with the
+# new URL as new_url) or deleted. Caches of anything derived from the page
+# subscribe to them.
+_signals = Namespace()
+page_saved = _signals.signal('page-saved')
+page_moved = _signals.signal('page-moved')
+page_deleted = _signals.signal('page-deleted')
+
+# Bump whenever a change to the Processor pipeline alters the rendered
+# output, so that the HTML stored with every page is re-rendered on load.
+RENDERER_VERSION = '2'
+
+# Extensions every Markdown engine is built with.
+MARKDOWN_EXTENSIONS = [
+    'codehilite',
+    'fenced_code',
+    'meta',
+    'tables'
+]
+
+# One Markdown engine per thread; building an engine (and its Pygments
+# setup) costs more than converting a typical page with it.
+_markdown_engines = threading.local()
+
+# Number of search results fetched per round trip, i.e. rendered before
+# the next batch is read from the cursor.
+SEARCH_BATCH_SIZE = 50
+
+# Wikilink syntax "[[Link]]" and "[[url|Title]]", compiled once.
+WIKILINK_REGEX = re.compile(
+    r"((?<!<code>)\[\[([^<].+?)\s*([|]\s*(.+?)\s*)?]])",
+    re.X | re.U
+)
+
+# Fenced code blocks (up to the closing fence, or the end of the text) and
+# inline code spans (within a paragraph), which the markdown renders as code
+# and so never as wikilinks.
+CODE_REGEX = re.compile(
+    r"^(`{3,}|~{3,}).*?(?:^\1[ \t]*$|\Z)"
+    r"|(`+)(?:(?!\n[ \t]*\n).)+?(?<!`)\2(?!`)",
+    re.M | re.S
+)
 
 
 def clean_url(url):
@@ -32,7 +83,116 @@ def clean_url(url):
     return url
 
 
-def wikilink(text, url_formatter=None):
+def split_code(text):
+    """
+        Splits markdown at its fenced code blocks and inline code spans,
+        the parts wikilinks are not read in.
+
+        :param str text: the markdown to split
+
+        :returns: the text between code and the code, alternating: the
+            even items are text, the odd items code
+        :rtype: list[str]
+    """
+    parts = []
+    position = 0
+    for match in CODE_REGEX.finditer(text):
+        parts += [text[position:match.start()], match.group(0)]
+        position = match.end()
+    parts.append(text[position:])
+    return parts
+
+
+def extract_links(text):
+    """
+        Finds the pages a text links to with wikilinks, as stored in the
+        links of a page, the index Wiki.move looks the referrers of a page up in.
+        Wikilinks within code are not links.
+
+        :param str text: the markdown content of a page
+
+        :returns: the cleaned URLs of the linked pages, sorted and without duplicates
+        :rtype: list[str]
+    """
+    prose = " ".join(split_code(text or "")[::2])
+    return sorted({clean_url(match.group(2)) for match in WIKILINK_REGEX.finditer(prose)})
+
+
+def rewrite_links(text, old_url, new_url):
+    """
+        Points the wikilinks to a moved page at its new URL. The text shown
+        for a link stays the same, wikilinks within code are left alone.
+
+        :param str text: the markdown content of a page
+        :param str old_url: the URL the page was moved from
+        :param str new_url: the URL the page was moved to
+
+        :returns: the rewritten content
+        :rtype: str
+    """
+    def replace_link(match):
+        if clean_url(match.group(2)) != old_url:
+            return match.group(0)
+        return "[[{0}|{1}]]".format(new_url, match.group(4) or match.group(2))
+
+    parts = split_code(text)
+    parts[::2] = [WIKILINK_REGEX.sub(replace_link, part) for part in parts[::2]]
+    return "".join(parts)
+
+
+def normalize_tags(tags):
+    """
+        Turns the comma separated tags of a page into the normalized
+        list stored (and indexed) alongside them: stripped, lowercased
+        and without empty entries or duplicates.
+
+        :param str tags: the comma separated tags
+
+        :returns: the normalized tags, in their original order
+        :rtype: list[str]
+    """
+    normalized = []
+    for tag in (tags or "").split(','):
+        tag = tag.strip().lower()
+        if tag and tag not in normalized:
+            normalized.append(tag)
+    return normalized
+
+
+def render_hash(content):
+    """
+        Computes the hash the rendered HTML of a page is stored under.
+        It covers both the raw content and the renderer version, so
+        stored HTML goes stale when either of them changes.
+
+        :param str content: the markdown content of the page
+
+        :returns: the hex digest
+        :rtype: str
+    """
+    digest = hashlib.sha256(RENDERER_VERSION.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update((content or '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_markdown_engine():
+    """
+        Returns the Markdown engine of the current thread, reset and
+        ready to convert a new document. The engine is built the first
+        time a thread asks for it and reused afterwards.
+
+        :returns: the Markdown engine
+        :rtype: markdown.Markdown
+    """
+    engine = getattr(_markdown_engines, 'engine', None)
+    if engine is None:
+        engine = _markdown_engines.engine = markdown.Markdown(
+            extensions=MARKDOWN_EXTENSIONS)
+    return engine.reset()
+
+
+def wikilink(text, url_formatter=None, missing_links=None):
     """
         Processes Wikilink syntax "[[Link]]" within the html body.
         This is intended to be run after content has been processed
@@ -41,6 +201,8 @@ def wikilink(text, url_formatter=None):
         :param str text: the html to highlight wiki links in.
         :param function url_formatter: which URL formatter to use,
             will by default use the flask url formatter
+        :param set missing_links: the cleaned URLs of the linked pages
+            that do not exist, their links get the class "missing"
 
         Syntax:
             This accepts Wikilink syntax in the form of [[WikiLink]] or
@@ -53,19 +215,20 @@ def wikilink(text, url_formatter=None):
     """
     if url_formatter is None:
         url_formatter = url_for
-    link_regex = re.compile(
-        r"((?<!<code>)\[\[([^<].+?)\s*([|]\s*(.+?)\s*)?]])",
-        re.X | re.U
-    )
-    for i in link_regex.findall(text):
-        title = [i[-1] if i[-1] else i[1]][0]
-        url = clean_url(i[1])
-        html_url = "<a href='{0}'>{1}</a>".format(
-            url_formatter('wiki.display', url=url),
-            title
-        )
-        text = re.sub(link_regex, html_url, text, count=1)
-    return text
+    missing_links = missing_links or ()
+    # the same page is usually linked many times, format its URL once
+    formatted_urls = {}
+
+    def replace_link(match):
+        title = match.group(4) or match.group(2)
+        url = clean_url(match.group(2))
+        if url not in formatted_urls:
+            formatted_urls[url] = url_formatter('wiki.display', url=url)
+        if url in missing_links:
+            return "<a href='{0}' class='missing'>{1}</a>".format(formatted_urls[url], title)
+        return "<a href='{0}'>{1}</a>".format(formatted_urls[url], title)
+
+    return WIKILINK_REGEX.sub(replace_link, text)
 
 
 class Processor(object):
@@ -80,19 +243,20 @@ class Processor(object):
     preprocessors = []
     postprocessors = [wikilink]
 
-    def __init__(self, text):
+    def __init__(self, text, missing_links=None, url_formatter=None):
         """
             Initialization of the processor.
 
             :param str text: the text to process
+            :param set missing_links: the cleaned URLs of the linked pages
+                that do not exist, passed on to the postprocessors
+            :param function url_formatter: formats the URLs of links,
+                passed on to the postprocessors; flask's url_for by default
         """
-        self.md = markdown.Markdown(extensions=[
-            'codehilite',
-            'fenced_code',
-            'meta',
-            'tables'
-        ])
+        self.md = None
         self.input = text
+        self.missing_links = missing_links
+        self.url_formatter = url_formatter
         self.markdown = None
         self.meta_raw = None
         self.pre = None
@@ -113,6 +277,7 @@ class Processor(object):
         """
             Convert to HTML and extract metadata.
         """
+        self.md = get_markdown_engine()
         self.html = self.md.convert(self.input)
         self.meta_raw = self.md.Meta if hasattr(self.md, 'Meta') else {}
 
@@ -136,7 +301,7 @@ class Processor(object):
         """
         current = self.html
         for processor in self.postprocessors:
-            current = processor(current)
+            current = processor(current, url_formatter=self.url_formatter, missing_links=self.missing_links)
         self.final = current
 
     def process(self):
@@ -153,40 +318,153 @@ class Processor(object):
         return self.final, self.markdown, self.meta
 
 
+# Fenced code may hold blank lines, it is never split into blocks.
+FENCE_REGEX = re.compile(r'^(`{3,}|~{3,})')
+LIST_ITEM_REGEX = re.compile(r'^ {0,3}([*+-]|\d+\.)\s')
+# Reference definitions and raw HTML tie blocks together, documents using
+# them are rendered whole.
+WHOLE_DOCUMENT_REGEX = re.compile(r'^ {0,3}(\[[^\]]+\]:|<[A-Za-z!/])', re.M)
+
+# Number of rendered blocks kept for the editor preview, shared by all editors.
+PREVIEW_CACHE_SIZE = 1024
+
+
+def continues_block(block, line):
+    """
+        Tells whether a line after a blank line still belongs to the block
+        before it: an indented line (list item paragraph, code) or the next
+        item of a list or line of a quote. Rendering them together is always
+        correct, rendering them apart only when they are independent.
+    """
+    if line[0] in ' \t':
+        return True
+    if LIST_ITEM_REGEX.match(line) and LIST_ITEM_REGEX.match(block[0]):
+        return True
+    return line.startswith('>') and block[0].startswith('>')
+
+
+def split_blocks(text):
+    """
+        Splits markdown into its top-level blocks, which render to the same
+        HTML on their own as they do within the document.
+
+        :param str text: the markdown to split
+
+        :returns: the blocks, in document order
+        :rtype: list[str]
+    """
+    blocks = []
+    current = []
+    fence = None
+    for line in text.split('\n'):
+        if fence:
+            current.append(line)
+            if line.rstrip() == fence:
+                fence = None
+            continue
+        match = FENCE_REGEX.match(line)
+        if match:
+            fence = match.group(1)
+        elif not line.strip():
+            if current:
+                blocks.append(current)
+                current = []
+            continue
+        elif not current and blocks and continues_block(blocks[-1], line):
+            current = blocks.pop() + ['']
+        current.append(line)
+    if current:
+        blocks.append(current)
+    return ['\n'.join(block) for block in blocks]
+
+
+@functools.lru_cache(maxsize=PREVIEW_CACHE_SIZE)
+def render_block(source):
+    """
+        Renders a single block, as prepared by render_blocks.
+    """
+    return Processor(source).process()[0]
+
+
+def render_blocks(text):
+    """
+        Renders a document block by block for the editor preview. Blocks
+        rendered before, by any editor, come from a cache, so an edit only
+        renders the blocks it changed.
+
+        :param str text: the markdown to render
+
+        :returns: (render hash, html) of every block, in document order
+        :rtype: list[tuple]
+    """
+    blocks = [text] if WHOLE_DOCUMENT_REGEX.search(text) else split_blocks(text)
+    rendered = []
+    for position, block in enumerate(blocks):
+        # a leading blank line keeps the meta extension from reading the
+        # "key: value" lines a later block may start with as metadata
+        source = block if position == 0 else '\n' + block
+        rendered.append((render_hash(source), render_block(source)))
+    return rendered
+
+
 # in this class commented code is original code provided
 class Page(object):
     """
     Represents a single page in the wiki.
 
     Attributes:
-        db (pymongo.MongoClient): The database client used to interact with MongoDB.
+        storage (wiki.storage.Storage): The storage of the wiki pages.
         url (str): The URL of the wiki page, used as a unique identifier.
-        collection (pymongo.collection.Collection): The MongoDB collection storing the wiki pages.
         _meta (OrderedDict): Metadata associated with the wiki page.
         new (bool): Indicates whether the page is new and not yet saved in the database.
+        image_ref (dict): The sha256 and extension of the page image in the image store, if any.
+        updated_at (datetime): When the page was last saved, if it has been.
     """
 
-    def __init__(self, db, url, new_flag=False):
+    def __init__(self, db, url, new_flag=False, document=None):
         """
             Initializes a new instance of the Page class.
            Parameters:
-               db (pymongo.MongoClient): The database client.
+               db (wiki.storage.Storage): The storage, or a MongoDB database.
                url (str): The URL of the wiki page.
                new (bool): True if the page is new, False otherwise. Default is False.
+               document (dict): The already fetched page document, if any. When given,
+                   the page is built from it instead of being read from the database.
         """
         self.path = ""
         self.url = url
-        self.collection = db.pages  # 'pages' is the MongoDB collection name
+        self.storage = as_storage(db)
         self._meta = OrderedDict()
         self.new = new_flag
         self.content = ""
         self._html = ""
+        self._html_hash = ""
+        self._stored_html_hash = None
+        self._missing_links = []
         self._tags = ""
+        self.image_ref = None
+        self._stored_image_ref = None
+        self.updated_at = None
         self.author = session.get('unique_id', '') or ""
 
-        if not self.new:
+        if document is not None:
+            self.load_document(document)
+            self.refresh()
+        elif not self.new:
             self.load()
-            self.render()
+            self.refresh()
+
+    @classmethod
+    def from_document(cls, db, document):
+        """
+        Builds a Page from a page document that has already been fetched,
+        saving the second read Page.load would otherwise issue.
+        Parameters:
+            db (wiki.storage.Storage): The storage, or a MongoDB database.
+            document (dict): The document of the page.
+        Returns:Page: The page built from the document.
+        """
+        return cls(db, document['url'], new_flag=False, document=document)
 
     def __eq__(self, other):
         return isinstance(other, Page) and self.url == other.url
@@ -202,45 +480,110 @@ class Page(object):
     # won't change as it is just processing pages
     def render(self):
         """
-        Renders the page content from markdown to HTML if not already processed.
+        Renders the page content from markdown to HTML unless the stored HTML
+        was rendered from the current content by the current renderer.
+        Returns:bool: True if the HTML was rendered again.
+        """
+        content_hash = render_hash(self.content)
+        if self._html_hash == content_hash:
+            return False
+        # one lookup for all the links, so missing pages can be marked
+        links = [link for link in extract_links(self.content) if link != self.url]
+        if links:
+            existing = self.storage.existing_urls(links)
+            self._missing_links = [link for link in links if link not in existing]
+        else:
+            self._missing_links = []
+        processor = Processor(self.content, missing_links=set(self._missing_links))
+        self._html, _, meta = processor.process()
+        # metadata from the markdown header is merged so the title set
+        # through the editor survives a re-render
+        self._meta.update(meta)
+        self._html_hash = content_hash
+        return True
+
+    def refresh(self):
+        """
+        Renders a loaded page again if its stored HTML is stale, and stores
+        the new HTML so the next load does not render it again. The page is
+        only written while it still has the stale render hash, so a save
+        made in the meantime is not overwritten.
         """
-        if not self._html:  # Only process if HTML content is not available
-            processor = Processor(self.content)
-            self._html, _, self._meta = processor.process()
+        stale_hash = self._stored_html_hash
+        if self.render():
+            self.storage.set_page_fields([(self.url,
+                                           {"html": self._html,
+                                            "html_hash": self._html_hash,
+                                            "missing_links": self._missing_links,
+                                            "meta": dict(self._meta)},
+                                           {"html_hash": stale_hash})])
+            self._stored_html_hash = self._html_hash
 
     def load(self):
         """
-        Loads the page content, metadata, processed HTML, and tags from the MongoDB database.
+        Loads the page content, metadata, processed HTML, and tags from the storage.
+        """
+        self.load_document(self.storage.find_page(self.url))
+
+    def load_document(self, page_data):
+        """
+        Loads the page content, metadata, processed HTML, and tags from a page document.
+        Parameters:page_data (dict): The MongoDB document of the page, or None if there is none.
         """
-        page_data = self.collection.find_one({"url": self.url})
         if page_data:
             self.content = page_data.get("content", "")
             self._html = page_data.get("html", "")
+            self._html_hash = page_data.get("html_hash", "")
+            # None when the page was saved before the hash was stored
+            self._stored_html_hash = page_data.get("html_hash")
+            self._missing_links = page_data.get("missing_links", [])
             self._meta = page_data.get("meta", {})
             self._tags = page_data.get("tags", "")  # Load tags
+            self.image_ref = self._stored_image_ref = page_data.get("image_ref")
+            self.updated_at = page_data.get("updated_at")
         else:
             self.content = ""
             self._html = ""
+            self._html_hash = ""
+            self._stored_html_hash = None
+            self._missing_links = []
             self._meta = OrderedDict()
             self._tags = ""  # Initialize tags
+            self.image_ref = self._stored_image_ref = None
+            self.updated_at = None
 
     def save(self, update=True):
         """
-        Saves the page content, metadata, processed HTML, and tags to the MongoDB database.
+        Saves the page content, metadata, processed HTML, and tags to the storage.
+        The HTML is rendered here, once per write, and stored together with its
+        render hash so that loading the page does not have to render it again.
+        Creating a page drops the stored HTML of the pages linking to it, which
+        showed the link as missing.
         """
+        self.render()
         current_time = datetime.utcnow()
         page_data = {
-            "url": self.url,
             "content": self.content,
+            "html": self._html,
+            "html_hash": self._html_hash,
+            "missing_links": self._missing_links,
             "meta": dict(self._meta),
             "tags": self._tags,  # Save tags
+            "tag_list": normalize_tags(self._tags),
+            "links": extract_links(self.content),
             "author": self.author,
             "updated_at": current_time
         }
         if self.new:
             page_data["created_at"] = current_time
+        # only written when the image was replaced, so saving a page loaded
+        # before its image variants were recorded does not drop them
+        if self.image_ref is not self._stored_image_ref:
+            page_data["image_ref"] = self.image_ref
 
-        self.collection.update_one({"url": self.url}, {"$set": page_data}, upsert=True)
+        if self.storage.save_page(self.url, page_data):
+            self.storage.clear_html(self.url)
+        page_saved.send(self.url)
 
         if update:
             self.load()
@@ -280,6 +623,19 @@ class Page(object):
     def html(self):
         return self._html
 
+    @property
+    def etag(self):
+        """
+        Gets a validator of the stored page, for conditional requests. It
+        changes whenever the page is saved, its image variants are recorded
+        or a page it links to is created or deleted.
+        Returns:str: The SHA-256 hex digest of the render hash, save time, image and missing links of the page.
+        """
+        updated_at = self.updated_at.isoformat() if self.updated_at else ""
+        image_ref = json.dumps(self.image_ref, sort_keys=True)
+        missing_links = ",".join(self._missing_links)
+        return hashlib.sha256("\0".join((self._html_hash, updated_at, image_ref, missing_links)).encode("utf-8")).hexdigest()
+
     def __html__(self):
         return self.html
 
@@ -301,19 +657,166 @@ class Page(object):
         self._meta['title'] = value
 
 
+class PageSummary(object):
+    """
+    A lightweight, read-only view of a page used by the list views (index,
+    tags, search, profile). It is built straight from a projected cursor
+    document, so listing pages neither loads their content nor renders it.
+
+    Attributes:
+        url (str): The URL of the wiki page.
+        title (str): The title of the page, the URL if it has none.
+        tags (str): The comma separated tags of the page.
+        author (str): The unique id of the author of the page.
+        updated_at (datetime): When the page was last saved, if known.
+        score (float): The relevance of the page, for search results only.
+    """
+
+    __slots__ = ('url', 'title', 'tags', 'author', 'updated_at', 'score')
+
+    def __init__(self, url, title=None, tags="", author="", updated_at=None, score=None):
+        self.url = url
+        self.title = title or url
+        self.tags = tags or ""
+        self.author = author or ""
+        self.updated_at = updated_at
+        self.score = score
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Builds a summary from a (projected) MongoDB page document.
+        Parameters:document (dict): The page document.
+        Returns:PageSummary: The summary of the page.
+        """
+        return cls(
+            document['url'],
+            title=document.get('meta', {}).get('title'),
+            tags=document.get('tags', ""),
+            author=document.get('author', ""),
+            updated_at=document.get('updated_at'),
+            score=document.get('score')
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, PageSummary) and self.url == other.url
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __repr__(self):
+        return "<PageSummary: {}>".format(self.url)
+
+
+def encode_cursor(key):
+    """
+    Encodes the sort key of the last item of a page as the opaque cursor
+    the next page is requested with.
+    Parameters:key: The JSON serializable sort key.
+    Returns:str: The cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, scored=False):
+    """
+    Decodes a cursor made by encode_cursor.
+    Parameters:
+        cursor (str): The cursor, or None for the first page.
+        scored (bool): Whether the sort key is the [score, url] of a search
+            result, rather than a URL or tag.
+    Returns:The sort key the next page starts after, None for the first page.
+    Raises:ValueError: If the cursor is malformed, or its key has another shape.
+    """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, binascii.Error, json.JSONDecodeError):
+        raise ValueError('Malformed cursor: %s' % cursor)
+    if scored:
+        valid = (isinstance(key, list) and len(key) == 2 and isinstance(key[0], (int, float))
+                 and not isinstance(key[0], bool) and isinstance(key[1], str))
+    else:
+        valid = isinstance(key, str)
+    if not valid:
+        raise ValueError('Malformed cursor: %s' % cursor)
+    return key
+
+
+class ResultPage(object):
+    """
+    One page of a keyset paginated listing. The listing is fetched with a
+    limit of page_size + 1 and read lazily; iterating the page yields at most
+    page_size items, and once they are exhausted next_cursor holds the cursor
+    of the next page, or None if this is the last one.
+
+    Attributes:
+        page_size (int): The maximum number of items on the page.
+        next_cursor (str): The cursor of the next page, set once iterated.
+    """
+
+    def __init__(self, items, page_size, key):
+        """
+        Parameters:
+            items (iterable): The listing, fetched with a limit of page_size + 1.
+            page_size (int): The maximum number of items on the page.
+            key (function): Returns the sort key of an item, as passed back as `after`.
+        """
+        self.page_size = page_size
+        self.next_cursor = None
+        self._items = items
+        self._key = key
+
+    def __iter__(self):
+        last = None
+        for count, item in enumerate(self._items):
+            if count == self.page_size:
+                self.next_cursor = encode_cursor(self._key(last))
+                return
+            last = item
+            yield item
+
+
+def unique_summaries(documents):
+    """
+    Lazily turns page documents into summaries, skipping any URL that was
+    already yielded.
+    Parameters:documents (iterable[dict]): The (projected) page documents.
+    Returns:iterator[PageSummary]: The summaries, in the order of the documents.
+    """
+    seen = set()
+    for doc in documents:
+        if doc['url'] not in seen:
+            seen.add(doc['url'])
+            yield PageSummary.from_document(doc)
+
+
 class Wiki(object):
     """
-        Wiki class manages the interactions with the wiki pages stored in MongoDB.
+        Wiki class manages the interactions with the wiki pages in the storage.
         It provides methods to perform CRUD operations on wiki pages, as well as to search and index them.
         Attributes:
-            collection (pymongo.collection.Collection): A MongoDB collection that stores the wiki pages.
+            storage (wiki.storage.Storage): The storage of the wiki pages.
+        """
+
+    def __init__(self, storage=None):
+        """
+                Initializes the Wiki object on the storage of the app, by default.
         """
+        self.storage = storage if storage is not None else get_storage()
 
-    def __init__(self):
+    @property
+    def collection(self):
         """
-                Initializes the Wiki object by setting up the MongoDB collection.
+        The MongoDB collection of the pages, for the commands that work on
+        it directly; only there with the mongo storage.
         """
-        self.collection = DataAccessObject.db.pages  # Use your MongoDB collection name
+        return self.storage.pages
+
+    @collection.setter
+    def collection(self, collection):
+        self.storage = MongoStorage(collection.database, pages=collection.name)
 
     def exists(self, url):
         """
@@ -321,7 +824,7 @@ class Wiki(object):
         Parameters:url (str): The URL of the wiki page to check.
         Returns:bool: True if the page exists, False otherwise.
         """
-        return self.collection.count_documents({"url": url, "author": session.get('unique_id')}) > 0
+        return self.storage.page_exists(url, author=session.get('unique_id'))
 
     def get(self, url):
         """
@@ -331,24 +834,30 @@ class Wiki(object):
         Returns:
             Page: The Page object corresponding to the URL and author, or None if not found.
         """
-        query = {"url": url}
-        document = self.collection.find_one(query)
+        document = self.storage.find_page(url)
 
         if document:
-            return Page(DataAccessObject.db, url, new_flag=False)
+            return Page.from_document(self.storage, document)
         return None
 
     # to get all the pages by author
     def get_all(self):
         """
         Retrieves all wiki pages from the database that belong to an author.
-        Returns: list[Page]: A list of all Page objects.
+        Returns: list[PageSummary]: A list of summaries of the author's pages.
         """
-        author_id = session.get('unique_id')
+        author_id = session.get('unique_id') or ""
 
-        cursor = self.collection.find({"author": author_id})
-        pages = [Page(DataAccessObject.db, doc['url']) for doc in cursor]
-        return pages
+        return [PageSummary.from_document(doc) for doc in self.storage.list_pages(author=author_id)]
+
+    def get_image_ref(self, url):
+        """
+        Retrieves the reference to the image of a page, without loading the page.
+        Parameters:url (str): The URL of the wiki page.
+        Returns:dict: The sha256 and extension of the image, or None if the page has none.
+        """
+        document = self.storage.find_page(url, fields=["image_ref"])
+        return document.get("image_ref") if document else None
 
     def get_or_404(self, url):
         """
@@ -369,110 +878,209 @@ class Wiki(object):
         Returns:Page: A new Page object if the URL does not exist, False otherwise.
         """
         if not self.exists(url):
-            return Page(DataAccessObject.db, url, new_flag=True)
+            return Page(self.storage, url, new_flag=True)
         return False
 
     def move(self, old_url, new_url):
         """
-        Moves a wiki page from an old URL to a new URL.
+        Moves a wiki page from an old URL to a new URL and points the
+        wikilinks of the pages linking to it at the new URL. The referrers
+        are found through the indexed links of the pages and rewritten in a
+        single bulk write, which also drops their stored HTML.
         Parameters:
             old_url (str): The current URL of the wiki page.
             new_url (str): The new URL for the wiki page
-        Raises:RuntimeError: If a page with the new URL already exists.
+        Returns:int: The number of pages whose links were rewritten.
+        Raises:RuntimeError: If a page with the new URL already exists, by any author.
         """
-        if self.exists(new_url):
+        # URLs are unique across authors
+        if self.storage.page_exists(new_url):
             raise RuntimeError('Target URL already exists: %s' % new_url)
-        self.collection.update_one({"url": old_url}, {"$set": {"url": new_url}})
+        self.storage.rename_page(old_url, new_url)
+        # pages linking to the new URL showed the link as missing
+        self.storage.clear_html(new_url)
+        page_moved.send(old_url, new_url=new_url)
+
+        current_time = datetime.utcnow()
+        updates = []
+        for doc in self.storage.linking_pages(old_url, fields=["content"]):
+            content = rewrite_links(doc.get("content", ""), old_url, new_url)
+            # matched on the content read, so a concurrent edit is not overwritten
+            updates.append((doc["url"],
+                            {"content": content,
+                             "links": extract_links(content),
+                             "html": "",
+                             "html_hash": "",
+                             "updated_at": current_time},
+                            {"content": doc.get("content", "")}))
+        if not updates:
+            return 0
+        rewritten = self.storage.set_page_fields(updates)
+        for url, _, _ in updates:
+            page_saved.send(url)
+        return rewritten
 
     def delete(self, url):
         """
-        Deletes a wiki page from the database
+        Deletes a wiki page from the database, and drops the stored HTML of
+        the pages linking to it so they show the link as missing.
         Parameters:url (str): The URL of the wiki page to delete.
         Returns:bool: True if the page was successfully deleted, False otherwise.
         """
-        result = self.collection.delete_one({"url": url})
-        return result.deleted_count > 0
+        deleted = self.storage.delete_page(url)
+        if deleted:
+            self.storage.clear_html(url)
+        page_deleted.send(url)
+        return deleted
 
-    def index(self):
+    def index(self, after=None, limit=0):
         """
-        Retrieves an index of all wiki pages.
-        Returns:list[Page]: A list of all Page objects in the database.
+        Retrieves an index of all wiki pages, ordered by URL.
+        Parameters:
+            after (str): Only list the pages whose URL sorts after this one.
+            limit (int): The maximum number of pages, 0 for all of them.
+        Returns:list[PageSummary]: A list of summaries of the pages.
         """
-        cursor = self.collection.find()
-        return [Page(DataAccessObject.db, doc['url']) for doc in cursor]
+        return [PageSummary.from_document(doc) for doc in self.storage.list_pages(after, limit)]
 
     def get_by_title(self, title):
         """
         Retrieves a wiki page by its title.
         Parameters:title (str): The title of the wiki page.
-        Returns:dict: The MongoDB document for the page, or None if not found.
+        Returns:dict: The document of the page, or None if not found.
         """
         author_id = session.get('unique_id')
-        query = {"meta.title": title, "author": author_id}
-        return self.collection.find_one(query)
-
-    def get_tags(self):
-        # Fetch and store documents in a list
-        documents = list(self.collection.find())
-
-        tags = {}
-        for doc in documents:
-            page_tags = doc.get("tags", "").split(',')
-            for tag in page_tags:
-                tag = tag.strip()
-                if tag:
-                    # Appending only the URL of the page to the tag's list
-                    tags.setdefault(tag, []).append(doc['url'])
-        return tags
-
-    def index_by_tag(self, tag):
-        """
-        Retrieves a list of pages that have a specific tag.
-        """
-        query = {"tags": {"$regex": tag, "$options": "i"}}
-        cursor = self.collection.find(query)
-        pages = [Page(DataAccessObject.db, doc['url']) for doc in cursor]
-        return pages
-
-    def search(self, term, ignore_case=True, attrs=['title', 'tags', 'content']):
-        regex = re.compile(term, re.IGNORECASE if ignore_case else 0)
-        matched = []
-        for attr in attrs:
-            query = {"$regex": regex.pattern, "$options": "i"} if ignore_case else regex.pattern
-
-            if attr == 'tags':
-                cursor = self.collection.find()
-
-                for doc in cursor:
-                    tags_list = doc.get("tags", "").split(', ')
-                    if any(regex.search(tag) for tag in tags_list):
-                        page = Page(DataAccessObject.db, doc['url'])
-                        if page not in matched:
-                            matched.append(page)
-            elif attr == 'content':
-                cursor = self.collection.find({f"{attr}": query})
-
-                for doc in cursor:
-                    page = Page(DataAccessObject.db, doc['url'])
-                    if page not in matched:
-                        matched.append(page)
-            else:
-                cursor = self.collection.find({f"meta.{attr}": query})
-
-                for doc in cursor:
-                    page = Page(DataAccessObject.db, doc['url'])
-                    if page not in matched:
-                        matched.append(page)
-        return matched
+        return self.storage.find_page_by_title(title, author_id)
 
-    def search_by_author(self, author_name):
-        matched = []
-        query = {"author": author_name}
-        cursor = self.collection.find(query)
+    def backlinks(self, url):
+        """
+        Retrieves the pages linking to a page, through the indexed links of the pages.
+        Parameters:url (str): The URL of the wiki page.
+        Returns:list[PageSummary]: Summaries of the linking pages, ordered by URL.
+        """
+        return [PageSummary.from_document(doc) for doc in self.storage.linking_pages(url)]
 
-        for doc in cursor:
-            page = Page(DataAccessObject.db, doc['url'])
-            if page not in matched:
-                matched.append(page)
+    def broken_links(self, batch_size=500):
+        """
+        Finds the links to pages that do not exist, from the links recorded
+        on the pages, without rendering any of them. The existence of the
+        targets is looked up batch_size targets at a time.
+        Parameters:batch_size (int): The number of targets looked up per query.
+        Returns:list[tuple]: (missing URL, URLs of the pages linking to it), ordered by missing URL.
+        """
+        targets = self.storage.link_targets()
+        broken = []
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            existing = self.storage.existing_urls([target for target, sources in batch])
+            broken.extend((target, sources) for target, sources in batch if target not in existing)
+        return broken
+
+    def get_tags(self, after=None, limit=0):
+        """
+        Retrieves the tags in use and the pages tagged with each of them.
+        Parameters:
+            after (str): Only list the tags that sort after this one.
+            limit (int): The maximum number of tags, 0 for all of them.
+        Returns:dict: The URLs of the tagged pages by tag, ordered by tag.
+        """
+        return self.storage.tags(after, limit)
+
+    def backfill_tag_lists(self, batch_size=500):
+        """
+        Stores the normalized tag list on the pages saved before it existed.
+        Parameters:batch_size (int): The number of pages updated per bulk write.
+        Returns:int: The number of pages updated.
+        """
+        return self._backfill("tag_list", "tags", normalize_tags, batch_size)
 
-        return matched
+    def backfill_links(self, batch_size=500):
+        """
+        Stores the links on the pages saved before they were recorded.
+        Parameters:batch_size (int): The number of pages updated per bulk write.
+        Returns:int: The number of pages updated.
+        """
+        return self._backfill("links", "content", extract_links, batch_size)
+
+    def _backfill(self, field, source, compute, batch_size):
+        """
+        Stores a field derived from another on the pages that lack it, in
+        bulk writes of batch_size pages.
+        """
+        updated = 0
+        batch = []
+        for url, value in self.storage.pages_without(field, source):
+            batch.append((url, {field: compute(value)}, None))
+            if len(batch) == batch_size:
+                updated += self.storage.set_page_fields(batch)
+                batch = []
+        if batch:
+            updated += self.storage.set_page_fields(batch)
+        return updated
+
+    def index_by_tag(self, tag, after=None, limit=0):
+        """
+        Retrieves a list of pages that have a specific tag, ordered by URL.
+        The tag is matched exactly, ignoring case, on the indexed tag_list.
+        Parameters:
+            tag (str): The tag.
+            after (str): Only list the pages whose URL sorts after this one.
+            limit (int): The maximum number of pages, 0 for all of them.
+        Returns:list[PageSummary]: A list of summaries of the tagged pages.
+        """
+        documents = self.storage.list_pages(after, limit, tags=normalize_tags(tag))
+        return [PageSummary.from_document(doc) for doc in documents]
+
+    def search(self, term, ignore_case=True, attrs=None):
+        """
+        Full-text search over the title, tags and content of all pages, as a
+        single result set ranked by relevance, with title matches boosted.
+        Parameters:
+            term (str): The words to search for; a page matches any of them.
+            ignore_case (bool): Whether the search is case-insensitive.
+            attrs (list): Deprecated and ignored. The fields searched one by
+                one before the text index; the index covers all of them.
+        Returns:list[PageSummary]: The matching pages, best match first.
+        """
+        if attrs is not None:
+            warnings.warn('The attrs of Wiki.search are ignored, every page is searched by '
+                          'title, tags and content', DeprecationWarning, stacklevel=2)
+        return list(self.iter_search(term, ignore_case))
+
+    def iter_search(self, term, ignore_case=True, after=None, limit=0, batch_size=SEARCH_BATCH_SIZE):
+        """
+        Lazy version of search: the pages are yielded while the cursor is read,
+        batch_size documents per round trip, so the first hits can be rendered
+        before the rest are fetched. The mongo storage runs it on the MongoDB
+        text index, falling back to an in-process inverted index when the
+        server cannot run a $text query (no text index, mongomock).
+        Parameters:
+            term (str): The words to search for; a page matches any of them.
+            ignore_case (bool): Whether the search is case-insensitive.
+            after (list): The [score, url] of the result to continue after.
+            limit (int): The maximum number of results, 0 for all of them.
+            batch_size (int): The number of documents fetched per round trip.
+        Returns:iterator[PageSummary]: The matching pages, best match first.
+        """
+        return unique_summaries(self.storage.search(term, ignore_case, after, limit, batch_size))
+
+    def search_by_author(self, author_name):
+        """
+        Retrieves the pages of an author.
+        Parameters:author_name (str): The unique id of the author.
+        Returns:list[PageSummary]: The pages of the author.
+        """
+        return list(self.iter_search_by_author(author_name))
+
+    def iter_search_by_author(self, author_name, after=None, limit=0, batch_size=SEARCH_BATCH_SIZE):
+        """
+        Lazy version of search_by_author, yielding the pages, ordered by URL,
+        while the cursor is read.
+        Parameters:
+            author_name (str): The unique id of the author.
+            after (str): Only list the pages whose URL sorts after this one.
+            limit (int): The maximum number of pages, 0 for all of them.
+            batch_size (int): The number of documents fetched per round trip.
+        Returns:iterator[PageSummary]: The pages of the author.
+        """
+        return unique_summaries(self.storage.list_pages(after, limit, author=author_name, batch_size=batch_size))
@@ -0,0 +1,99 @@
+"""
+    Search
+    ~~~~~~
+
+    Ranking for the full-text search of the wiki. Pages are searched with
+    the MongoDB text index; InvertedIndex is the in-process fallback used
+    when the server cannot run a $text query (no text index, mongomock).
+"""
+import re
+from bisect import bisect_left
+
+TOKEN_REGEX = re.compile(r'\w+', re.U)
+
+# Relative weight of a match in each field, so a match in the title ranks
+# above one in the tags, which ranks above one in the content. The text
+# index in DataAccessObject.INDEXES uses the same weights.
+FIELD_WEIGHTS = {
+    'title': 10,
+    'tags': 5,
+    'content': 1
+}
+
+
+def tokenize(text, ignore_case=True):
+    """
+        Splits text into its word tokens.
+
+        :param str text: the text to split
+        :param bool ignore_case: whether to lowercase the tokens
+
+        :returns: the tokens
+        :rtype: list[str]
+    """
+    if ignore_case:
+        text = text.lower()
+    return TOKEN_REGEX.findall(text)
+
+
+class InvertedIndex(object):
+    """
+    An in-process inverted index over page documents. A term matches every
+    token it is a prefix of, the score of a page is the weighted number of
+    matched tokens, and a page matches when any of the terms does.
+
+    Attributes:
+        ignore_case (bool): Whether tokens and terms are compared case-insensitively.
+        postings (dict): Maps each token to {url: weighted frequency}.
+        documents (dict): Maps each url to the document it was built from.
+    """
+
+    def __init__(self, ignore_case=True):
+        self.ignore_case = ignore_case
+        self.postings = {}
+        self.documents = {}
+        self._tokens = None
+
+    def add(self, document):
+        """
+        Indexes a page document.
+        Parameters:document (dict): A page document with url, meta.title, tags and content.
+        """
+        url = document['url']
+        self.documents[url] = document
+        fields = {
+            'title': document.get('meta', {}).get('title') or '',
+            'tags': document.get('tags') or '',
+            'content': document.get('content') or ''
+        }
+        for field, text in fields.items():
+            for token in tokenize(text, self.ignore_case):
+                posting = self.postings.setdefault(token, {})
+                posting[url] = posting.get(url, 0) + FIELD_WEIGHTS[field]
+        self._tokens = None
+
+    def matching_tokens(self, term):
+        """
+        Yields every indexed token the term is a prefix of.
+        Parameters:term (str): A single search term.
+        """
+        if self._tokens is None:
+            self._tokens = sorted(self.postings)
+        position = bisect_left(self._tokens, term)
+        while position < len(self._tokens) and self._tokens[position].startswith(term):
+            yield self._tokens[position]
+            position += 1
+
+    def search(self, text):
+        """
+        Searches the index.
+        Parameters:text (str): The search text, split into terms like the documents are.
+        Returns:list[dict]: The matching documents with their score, best match first.
+        """
+        scores = {}
+        for term in set(tokenize(text, self.ignore_case)):
+            for token in self.matching_tokens(term):
+                for url, weight in self.postings[token].items():
+                    scores[url] = scores.get(url, 0) + weight
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [dict(self.documents[url], score=score) for url, score in ranked]
@@ -0,0 +1,773 @@
+"""
+    Storage
+    ~~~~~~~
+
+    Where the pages and users of the wiki are kept. Wiki, Page and
+    UserManager only talk to a Storage, selected by the STORAGE setting:
+    MongoStorage keeps them in MongoDB, MemoryStorage in dicts and sorted
+    lists of the process, for tests, offline development and as a baseline
+    for benchmarks of the MongoDB path. Documents are plain dicts, shaped
+    like the MongoDB documents, without their _id.
+"""
+import copy
+import logging
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_right, insort
+
+from flask import current_app, has_app_context
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from wiki import DataAccessObject
+from wiki.cache import create_page_cache
+from wiki.search import InvertedIndex
+
+logger = logging.getLogger(__name__)
+
+# Seconds the in-process search index of MongoStorage is kept, for the
+# writes of the other processes; those of this one drop it at once.
+FALLBACK_INDEX_TTL = 30
+
+# The only fields the list views need; used as the MongoDB projection for
+# every query that builds PageSummary objects.
+PAGE_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "url": 1,
+    "meta.title": 1,
+    "tags": 1,
+    "author": 1,
+    "updated_at": 1
+}
+
+# The order of every listing of pages.
+URL_ORDER = [("url", ASCENDING)]
+
+# The tagged pages saved before tag_list was stored, until
+# Wiki.backfill_tag_lists has run; their tags are normalized on read.
+LEGACY_TAGS_QUERY = {"tag_list": {"$exists": False}, "tags": {"$gt": ""}}
+
+
+class Storage(ABC):
+    """
+    The operations the wiki needs from a storage. Every listing of pages is
+    ordered by URL and yields summary documents (PAGE_SUMMARY_PROJECTION).
+    A subclass implements all of them, it cannot be instantiated otherwise.
+    """
+
+    # pages
+
+    @abstractmethod
+    def find_page(self, url, fields=None):
+        """
+        Reads a page.
+        Parameters:
+            url (str): The URL of the page.
+            fields (list[str]): The top-level fields to read, all if None.
+        Returns:dict: The document of the page, or None if there is no such page.
+        """
+
+    @abstractmethod
+    def page_exists(self, url, author=None):
+        """
+        Tells whether a page exists.
+        Parameters:
+            url (str): The URL of the page.
+            author (str): If given, the page must have been written by this author.
+        Returns:bool: True if there is such a page.
+        """
+
+    @abstractmethod
+    def existing_urls(self, urls):
+        """
+        Looks several pages up at once.
+        Parameters:urls (list[str]): The URLs to look up.
+        Returns:set: The given URLs that have a page.
+        """
+
+    @abstractmethod
+    def save_page(self, url, fields):
+        """
+        Sets the given fields of a page, creating it if needed.
+        Parameters:
+            url (str): The URL of the page.
+            fields (dict): The top-level fields to set.
+        Returns:bool: True if the page was created.
+        """
+
+    @abstractmethod
+    def set_page_fields(self, updates):
+        """
+        Sets fields of several pages at once.
+        Parameters:updates (list[tuple]): (url, fields, expected) of every
+            page, where the page is only updated if its fields still have the
+            expected values (a dict, or None).
+        Returns:int: The number of pages updated.
+        """
+
+    @abstractmethod
+    def rename_page(self, old_url, new_url):
+        """
+        Moves a page to a new URL, leaving its other fields as they are.
+        The links of other pages are not rewritten, see Wiki.move.
+        Parameters:
+            old_url (str): The URL of the page.
+            new_url (str): The URL to move it to.
+        Raises:RuntimeError: If a page with the new URL exists.
+        """
+
+    @abstractmethod
+    def delete_page(self, url):
+        """
+        Deletes a page.
+        Parameters:url (str): The URL of the page.
+        Returns:bool: True if there was a page to delete.
+        """
+
+    @abstractmethod
+    def clear_html(self, url):
+        """
+        Drops the render hash of the pages linking to a page, so their
+        stored HTML is rendered again.
+        Parameters:url (str): The URL of the linked page.
+        """
+
+    @abstractmethod
+    def set_image_variants(self, digest, width, variants):
+        """
+        Records the variants of an image on every page showing it.
+        Parameters:
+            digest (str): The SHA-256 hex digest of the original image.
+            width (int): The width of the original image.
+            variants (dict): The resized variants by name, see make_variants.
+        """
+
+    @abstractmethod
+    def list_pages(self, after=None, limit=0, author=None, tags=None, batch_size=0):
+        """
+        Lists pages after a URL, only those of an author or tagged with any
+        of the given normalized tags if given.
+        Parameters:
+            after (str): The URL to list the pages after, from the first if None.
+            limit (int): The most pages to list, all if 0.
+            author (str): The author of the pages, any if None.
+            tags (list[str]): The normalized tags of the pages, any if None.
+            batch_size (int): The number of documents read per round trip, if not 0.
+        Returns:iterable[dict]: The summary documents.
+        """
+
+    @abstractmethod
+    def find_page_by_title(self, title, author):
+        """
+        Reads the page of an author with a title.
+        Parameters:
+            title (str): The title of the page, in its metadata.
+            author (str): The author of the page.
+        Returns:dict: The document of the page, or None if there is no such page.
+        """
+
+    @abstractmethod
+    def linking_pages(self, url, fields=None):
+        """
+        Lists the other pages whose recorded links include url.
+        Parameters:
+            url (str): The URL of the linked page.
+            fields (list[str]): The top-level fields to read, summaries if None.
+        Returns:iterable[dict]: The documents of the linking pages.
+        """
+
+    @abstractmethod
+    def link_targets(self):
+        """
+        Returns:list[tuple]: (target, sorted URLs of the pages linking to it)
+            of every link recorded on a page, ordered by target.
+        """
+
+    @abstractmethod
+    def pages_without(self, field, source):
+        """
+        Lists the pages a field is to be backfilled on.
+        Parameters:
+            field (str): The top-level field the pages do not have.
+            source (str): The top-level field the missing one is derived from.
+        Returns:iterable[tuple]: (url, value of source) of the pages without the field.
+        """
+
+    @abstractmethod
+    def tags(self, after=None, limit=0):
+        """
+        Lists the tags of the pages after a tag, ordered by tag.
+        Parameters:
+            after (str): The normalized tag to list the tags after, from the first if None.
+            limit (int): The most tags to list, all if 0.
+        Returns:dict: The URLs of the pages tagged with every normalized tag.
+        """
+
+    @abstractmethod
+    def search(self, term, ignore_case=True, after=None, limit=0, batch_size=0):
+        """
+        Full-text search, see Wiki.iter_search.
+        Parameters:
+            term (str): The words to search for.
+            ignore_case (bool): Whether the case of the words is ignored.
+            after (list): The [score, url] of the result to list the results after.
+            limit (int): The most results to list, all if 0.
+            batch_size (int): The number of documents read per round trip, if not 0.
+        Returns:iterable[dict]: The summary documents with their score, best match first.
+        """
+
+    # users
+
+    @abstractmethod
+    def find_user(self, name):
+        """
+        Reads a user.
+        Parameters:name (str): The unique name of the user.
+        Returns:dict: The document of the user, or None if there is no such user.
+        """
+
+    @abstractmethod
+    def insert_user(self, document):
+        """
+        Stores a new user.
+        Parameters:document (dict): The document of the user, with its unique name.
+        """
+
+    @abstractmethod
+    def update_user(self, name, fields, unset=(), expected=None):
+        """
+        Sets, and unsets, fields of a user.
+        Parameters:
+            name (str): The unique name of the user.
+            fields (dict): The top-level fields to set.
+            unset (iterable[str]): The top-level fields to remove.
+            expected (dict): If given, the user is only updated if its fields
+                still have these values.
+        Returns:bool: True if the user was updated.
+        """
+
+    @abstractmethod
+    def delete_user(self, name):
+        """
+        Deletes a user.
+        Parameters:name (str): The unique name of the user.
+        Returns:bool: True if there was a user to delete.
+        """
+
+
+def search_index(index, term, after=None, limit=0):
+    """
+    Searches an InvertedIndex, continuing after the [score, url] of a result.
+    """
+    documents = index.search(term)
+    if after:
+        score, url = after
+        documents = [doc for doc in documents
+                     if doc['score'] < score or (doc['score'] == score and doc['url'] > url)]
+    return documents[:limit] if limit else documents
+
+
+class MongoStorage(Storage):
+    """
+    Keeps the pages and users in MongoDB collections.
+
+    Attributes:
+        pages (pymongo.collection.Collection): The pages collection.
+        users (pymongo.collection.Collection): The users collection.
+        page_cache (wiki.cache.PageCache): The cache pages and their
+            backlinks are read through, and dropped from by every write, or None.
+    """
+
+    # A sample of every query sent to the collections, keyed by method, as
+    # (method, filter, sort, projection); used to audit the query plans. The
+    # aggregations are listed by the $match and $project they start with.
+    PAGE_QUERY_SHAPES = [
+        ('page_exists', {"url": "", "author": ""}, None, None),
+        ('find_page', {"url": ""}, None, {"_id": 0}),
+        ('find_page_by_title', {"meta.title": "", "author": ""}, None, {"_id": 0}),
+        ('list_pages', {}, URL_ORDER, PAGE_SUMMARY_PROJECTION),
+        ('list_pages', {"url": {"$gt": ""}}, URL_ORDER, PAGE_SUMMARY_PROJECTION),
+        ('list_pages', {"author": ""}, URL_ORDER, PAGE_SUMMARY_PROJECTION),
+        ('list_pages', {"$or": [{"tag_list": {"$in": [""]}},
+                                {"tag_list": {"$exists": False}, "tags": {"$regex": ""}}]},
+         URL_ORDER, PAGE_SUMMARY_PROJECTION),
+        ('clear_html', {"links": "", "url": {"$ne": ""}}, None, None),
+        ('set_image_variants', {"image_ref.sha256": ""}, None, None),
+        ('linking_pages', {"links": "", "url": {"$ne": ""}}, URL_ORDER, PAGE_SUMMARY_PROJECTION),
+        ('link_targets', {"links": {"$gt": ""}}, None, {"_id": 0, "url": 1, "links": 1}),
+        ('existing_urls', {"url": {"$in": [""]}}, None, {"_id": 0, "url": 1}),
+        ('pages_without', {"tag_list": {"$exists": False}}, None, {"_id": 0, "url": 1, "tags": 1}),
+        ('pages_without', {"links": {"$exists": False}}, None, {"_id": 0, "url": 1, "content": 1}),
+        ('tags', {"tag_list": {"$gt": ""}}, None, {"_id": 0, "url": 1, "tag_list": 1}),
+        ('tags', LEGACY_TAGS_QUERY, None, {"_id": 0, "url": 1, "tags": 1}),
+        # ranked by textScore, which no index holds, so the sort is left out
+        ('search', {"$text": {"$search": "wiki"}}, None,
+         dict(PAGE_SUMMARY_PROJECTION, score={"$meta": "textScore"})),
+    ]
+    USER_QUERY_SHAPES = [
+        ('find_user', {"name": ""}, None, {"_id": 0}),
+    ]
+
+    def __init__(self, database, pages='pages', users='Users', page_cache=None):
+        self.pages = database[pages]
+        self.users = database[users]
+        self.page_cache = page_cache
+        # (index, time built) by ignore_case, without a usable text index
+        self._search_indexes = {}
+        self._fallback_logged = False
+
+    def _projection(self, fields):
+        if fields is None:
+            return {"_id": 0}
+        return dict({"_id": 0}, **{field: 1 for field in fields})
+
+    def find_page(self, url, fields=None):
+        if self.page_cache is None:
+            return self.pages.find_one({"url": url}, self._projection(fields))
+        document = self.page_cache.get(url)
+        if document is None:
+            token = self.page_cache.token()
+            document = self.pages.find_one({"url": url}, {"_id": 0})
+            if document is None:
+                return None
+            self.page_cache.set(url, document, token)
+        if fields is not None:
+            document = {field: document[field] for field in ["url"] + list(fields) if field in document}
+        return document
+
+    def _dropped(self, *urls, links=()):
+        self._search_indexes = {}
+        if self.page_cache is not None:
+            self.page_cache.drop(*urls, links=links)
+
+    def page_exists(self, url, author=None):
+        if self.page_cache is not None:
+            document = self.page_cache.get(url)
+            if document is not None:
+                return author is None or document.get("author") == author
+        query = {"url": url}
+        if author is not None:
+            query["author"] = author
+        return self.pages.count_documents(query, limit=1) > 0
+
+    def existing_urls(self, urls):
+        return {doc["url"] for doc in self.pages.find({"url": {"$in": list(urls)}}, {"_id": 0, "url": 1})}
+
+    def save_page(self, url, fields):
+        result = self.pages.update_one({"url": url}, {"$set": dict(fields, url=url)}, upsert=True)
+        self._dropped(url, links=fields.get("links", ()))
+        return result.upserted_id is not None
+
+    def set_page_fields(self, updates):
+        requests = [UpdateOne(dict(expected or {}, url=url), {"$set": fields}) for url, fields, expected in updates]
+        if not requests:
+            return 0
+        modified = self.pages.bulk_write(requests, ordered=False).modified_count
+        self._dropped(*[url for url, fields, expected in updates],
+                      links=[link for url, fields, expected in updates for link in fields.get("links", ())])
+        return modified
+
+    def rename_page(self, old_url, new_url):
+        try:
+            self.pages.update_one({"url": old_url}, {"$set": {"url": new_url}})
+        except DuplicateKeyError:
+            # created after Wiki.move checked, the unique index refused it
+            raise RuntimeError('Target URL already exists: %s' % new_url)
+        finally:
+            self._dropped(old_url, new_url)
+
+    def delete_page(self, url):
+        deleted = self.pages.delete_one({"url": url}).deleted_count > 0
+        self._dropped(url)
+        return deleted
+
+    def clear_html(self, url):
+        self.pages.update_many({"links": url, "url": {"$ne": url}}, {"$set": {"html_hash": ""}})
+        if self.page_cache is not None:
+            self.page_cache.drop_linking(url)
+
+    def set_image_variants(self, digest, width, variants):
+        self.pages.update_many({"image_ref.sha256": digest},
+                               {"$set": {"image_ref.width": width, "image_ref.variants": variants}})
+        if self.page_cache is not None:
+            self.page_cache.drop_image(digest)
+
+    def list_pages(self, after=None, limit=0, author=None, tags=None, batch_size=0):
+        query = {}
+        if author is not None:
+            query["author"] = author
+        if tags is not None:
+            tags = list(tags)
+            query["$or"] = [{"tag_list": {"$in": tags}}]
+            if tags:
+                # the comma separated tags of the pages saved before tag_list
+                pattern = r'(^|,)\s*(%s)\s*(,|$)' % '|'.join(re.escape(tag) for tag in tags)
+                query["$or"].append({"tag_list": {"$exists": False}, "tags": {"$regex": pattern, "$options": "i"}})
+        if after:
+            query["url"] = {"$gt": after}
+        cursor = self.pages.find(query, PAGE_SUMMARY_PROJECTION, batch_size=batch_size)
+        return cursor.sort(URL_ORDER).limit(limit)
+
+    def find_page_by_title(self, title, author):
+        return self.pages.find_one({"meta.title": title, "author": author}, {"_id": 0})
+
+    def linking_pages(self, url, fields=None):
+        projection = PAGE_SUMMARY_PROJECTION if fields is None else self._projection(["url"] + list(fields))
+        if fields is not None or self.page_cache is None:
+            return self.pages.find({"links": url, "url": {"$ne": url}}, projection).sort(URL_ORDER)
+        # the summaries are listed on every view of the page
+        documents = self.page_cache.get_backlinks(url)
+        if documents is None:
+            token = self.page_cache.token()
+            documents = list(self.pages.find({"links": url, "url": {"$ne": url}}, projection).sort(URL_ORDER))
+            self.page_cache.set_backlinks(url, documents, token)
+        return documents
+
+    def link_targets(self):
+        pipeline = [
+            # the pages with any link, through the links index
+            {"$match": {"links": {"$gt": ""}}},
+            {"$project": {"_id": 0, "url": 1, "links": 1}},
+            {"$unwind": "$links"},
+            {"$group": {"_id": "$links", "sources": {"$addToSet": "$url"}}},
+            {"$sort": {"_id": ASCENDING}}
+        ]
+        return [(doc["_id"], sorted(doc["sources"])) for doc in self.pages.aggregate(pipeline)]
+
+    def pages_without(self, field, source):
+        for doc in self.pages.find({field: {"$exists": False}}, {"_id": 0, "url": 1, source: 1}):
+            yield doc["url"], doc.get(source)
+
+    def tags(self, after=None, limit=0):
+        # only the tags in range are unwound and grouped, on the server, and
+        # only the tagged pages are read, through the tag_list index
+        tag_range = [{"$match": {"tag_list": {"$gt": after or ""}}}]
+        pipeline = tag_range + [
+            {"$project": {"_id": 0, "url": 1, "tag_list": 1}},
+            {"$unwind": "$tag_list"}
+        ] + tag_range + [
+            {"$group": {"_id": "$tag_list", "urls": {"$push": "$url"}}},
+            {"$sort": {"_id": ASCENDING}}
+        ]
+        if limit:
+            pipeline.append({"$limit": limit})
+        tags = {doc["_id"]: doc["urls"] for doc in self.pages.aggregate(pipeline)}
+        legacy = self.pages.find(LEGACY_TAGS_QUERY, {"_id": 0, "url": 1, "tags": 1})
+        for doc in legacy:
+            for tag in tag_list(doc):
+                if not after or tag > after:
+                    tags.setdefault(tag, []).append(doc["url"])
+        ordered = sorted(tags)
+        return {tag: tags[tag] for tag in (ordered[:limit] if limit else ordered)}
+
+    def search(self, term, ignore_case=True, after=None, limit=0, batch_size=0):
+        # runs on the text index, and falls back to an in-process inverted
+        # index when the server cannot run a $text query (no text index,
+        # mongomock)
+        pipeline = [
+            {"$match": {"$text": {"$search": term, "$caseSensitive": not ignore_case}}},
+            {"$addFields": {"score": {"$meta": "textScore"}}}
+        ]
+        if after:
+            score, url = after
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": score}},
+                                                {"score": score, "url": {"$gt": url}}]}})
+        pipeline.append({"$sort": {"score": DESCENDING, "url": ASCENDING}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$project": dict(PAGE_SUMMARY_PROJECTION, score=1)})
+        options = {"batchSize": batch_size} if batch_size else {}
+        try:
+            return self.pages.aggregate(pipeline, **options)
+        except (OperationFailure, NotImplementedError) as error:
+            return search_index(self._fallback_index(ignore_case, error), term, after, limit)
+
+    def _fallback_index(self, ignore_case, error):
+        # reading every page is only done once per write or FALLBACK_INDEX_TTL
+        index, built_at = self._search_indexes.get(ignore_case, (None, 0))
+        if index is None or time.monotonic() - built_at > FALLBACK_INDEX_TTL:
+            if not self._fallback_logged:
+                logger.warning('Searching an in-process index of every page, the text index cannot be '
+                               'used (%s); run ensure-indexes', error)
+                self._fallback_logged = True
+            index = InvertedIndex(ignore_case)
+            for doc in self.pages.find({}, dict(PAGE_SUMMARY_PROJECTION, content=1)):
+                index.add(doc)
+            self._search_indexes[ignore_case] = (index, time.monotonic())
+        return index
+
+    def find_user(self, name):
+        return self.users.find_one({"name": name}, {"_id": 0})
+
+    def insert_user(self, document):
+        self.users.insert_one(dict(document))
+
+    def update_user(self, name, fields, unset=(), expected=None):
+        update = {"$set": fields}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        return self.users.update_one(dict(expected or {}, name=name), update).matched_count > 0
+
+    def delete_user(self, name):
+        return self.users.delete_one({"name": name}).deleted_count > 0
+
+
+def tag_list(document):
+    """
+    Returns the normalized tags of a page document, from its tags when it
+    was saved before tag_list was stored.
+    """
+    if "tag_list" in document:
+        return document["tag_list"] or []
+    # imported here, wiki.core imports this module
+    from wiki.core import normalize_tags
+    return normalize_tags(document.get("tags"))
+
+
+def summary(document):
+    """
+    Projects a page document on PAGE_SUMMARY_PROJECTION.
+    """
+    projected = {key: document[key] for key in ("url", "tags", "author", "updated_at") if key in document}
+    if "title" in document.get("meta", {}):
+        projected["meta"] = {"title": document["meta"]["title"]}
+    return projected
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps the pages and users in dicts of the process, with the URLs in a
+    sorted list and the pages indexed by author, tag and link, so listings
+    and lookups never scan every page. Documents are copied in and out, as
+    they would be by a database.
+    """
+
+    def __init__(self):
+        self._pages = {}
+        self._urls = []
+        self._by_author = {}
+        self._by_tag = {}
+        self._by_link = {}
+        self._search_indexes = {}
+        self._users = {}
+        self._lock = threading.RLock()
+
+    def _secondary_keys(self, document):
+        return ((self._by_author, [document.get("author")]),
+                (self._by_tag, tag_list(document)),
+                (self._by_link, document.get("links") or []))
+
+    def _put(self, document):
+        url = document["url"]
+        old = self._pages.get(url)
+        if old is None:
+            insort(self._urls, url)
+        else:
+            self._unindex(old)
+        self._pages[url] = document
+        for index, keys in self._secondary_keys(document):
+            for key in keys:
+                index.setdefault(key, set()).add(url)
+        self._search_indexes = {}
+
+    def _unindex(self, document):
+        for index, keys in self._secondary_keys(document):
+            for key in keys:
+                urls = index.get(key)
+                if urls is not None:
+                    urls.discard(document["url"])
+                    if not urls:
+                        del index[key]
+
+    def _remove(self, url):
+        document = self._pages.pop(url)
+        self._unindex(document)
+        self._urls.remove(url)
+        self._search_indexes = {}
+        return document
+
+    def _project(self, document, fields):
+        if fields is None:
+            return copy.deepcopy(document)
+        return {field: copy.deepcopy(document[field]) for field in ["url"] + list(fields) if field in document}
+
+    def _iter_urls(self, after=None, urls=None):
+        # the URLs after a URL, in order, only those in urls if given
+        start = bisect_right(self._urls, after) if after else 0
+        if urls is not None and len(urls) < len(self._urls) - start:
+            return sorted(url for url in urls if not after or url > after)
+        return (url for url in self._urls[start:] if urls is None or url in urls)
+
+    def find_page(self, url, fields=None):
+        with self._lock:
+            document = self._pages.get(url)
+            return self._project(document, fields) if document is not None else None
+
+    def page_exists(self, url, author=None):
+        with self._lock:
+            document = self._pages.get(url)
+            return document is not None and (author is None or document.get("author") == author)
+
+    def existing_urls(self, urls):
+        with self._lock:
+            return {url for url in urls if url in self._pages}
+
+    def save_page(self, url, fields):
+        with self._lock:
+            old = self._pages.get(url)
+            document = dict(old or {}, **copy.deepcopy(fields))
+            document["url"] = url
+            self._put(document)
+            return old is None
+
+    def set_page_fields(self, updates):
+        updated = 0
+        with self._lock:
+            for url, fields, expected in updates:
+                document = self._pages.get(url)
+                if document is None or any(document.get(key) != value for key, value in (expected or {}).items()):
+                    continue
+                self._put(dict(document, **copy.deepcopy(fields)))
+                updated += 1
+        return updated
+
+    def rename_page(self, old_url, new_url):
+        with self._lock:
+            if new_url in self._pages:
+                raise RuntimeError('Target URL already exists: %s' % new_url)
+            if old_url in self._pages:
+                self._put(dict(self._remove(old_url), url=new_url))
+
+    def delete_page(self, url):
+        with self._lock:
+            if url not in self._pages:
+                return False
+            self._remove(url)
+            return True
+
+    def clear_html(self, url):
+        with self._lock:
+            for referrer in self._by_link.get(url, set()) - {url}:
+                self._pages[referrer]["html_hash"] = ""
+
+    def set_image_variants(self, digest, width, variants):
+        with self._lock:
+            for document in self._pages.values():
+                image_ref = document.get("image_ref")
+                if image_ref and image_ref.get("sha256") == digest:
+                    document["image_ref"] = dict(image_ref, width=width, variants=copy.deepcopy(variants))
+
+    def list_pages(self, after=None, limit=0, author=None, tags=None, batch_size=0):
+        with self._lock:
+            urls = None
+            if author is not None:
+                urls = self._by_author.get(author, set())
+            if tags is not None:
+                tagged = set().union(*[self._by_tag.get(tag, set()) for tag in tags])
+                urls = tagged if urls is None else urls & tagged
+            documents = []
+            for url in self._iter_urls(after, urls):
+                if limit and len(documents) == limit:
+                    break
+                documents.append(summary(self._pages[url]))
+            return documents
+
+    def find_page_by_title(self, title, author):
+        with self._lock:
+            for url in self._by_author.get(author, ()):
+                if self._pages[url].get("meta", {}).get("title") == title:
+                    return copy.deepcopy(self._pages[url])
+        return None
+
+    def linking_pages(self, url, fields=None):
+        with self._lock:
+            referrers = sorted(self._by_link.get(url, set()) - {url})
+            if fields is None:
+                return [summary(self._pages[referrer]) for referrer in referrers]
+            return [self._project(self._pages[referrer], fields) for referrer in referrers]
+
+    def link_targets(self):
+        with self._lock:
+            return [(target, sorted(self._by_link[target])) for target in sorted(self._by_link)]
+
+    def pages_without(self, field, source):
+        with self._lock:
+            missing = [(url, copy.deepcopy(document.get(source)))
+                       for url, document in self._pages.items() if field not in document]
+        return iter(missing)
+
+    def tags(self, after=None, limit=0):
+        with self._lock:
+            tags = sorted(tag for tag in self._by_tag if not after or tag > after)
+            if limit:
+                tags = tags[:limit]
+            return {tag: sorted(self._by_tag[tag]) for tag in tags}
+
+    def search(self, term, ignore_case=True, after=None, limit=0, batch_size=0):
+        with self._lock:
+            # built on the first search after a write, then reused
+            index = self._search_indexes.get(ignore_case)
+            if index is None:
+                index = self._search_indexes[ignore_case] = InvertedIndex(ignore_case)
+                for document in self._pages.values():
+                    index.add(dict(summary(document), content=document.get("content", "")))
+            return [dict(summary(doc), score=doc["score"]) for doc in search_index(index, term, after, limit)]
+
+    def find_user(self, name):
+        with self._lock:
+            document = self._users.get(name)
+            return copy.deepcopy(document) if document is not None else None
+
+    def insert_user(self, document):
+        with self._lock:
+            self._users[document["name"]] = copy.deepcopy(document)
+
+    def update_user(self, name, fields, unset=(), expected=None):
+        with self._lock:
+            document = self._users.get(name)
+            if document is None or any(document.get(key) != value for key, value in (expected or {}).items()):
+                return False
+            document.update(copy.deepcopy(fields))
+            for field in unset:
+                document.pop(field, None)
+            return True
+
+    def delete_user(self, name):
+        with self._lock:
+            return self._users.pop(name, None) is not None
+
+
+def create_storage(config):
+    """
+    Creates the storage selected by the STORAGE setting: 'mongo' or 'memory'.
+    Parameters:config (flask.Config): The configuration of the app.
+    Returns:Storage: The storage.
+    Raises:ValueError: If the setting names an unknown storage.
+    """
+    kind = config.get('STORAGE', 'mongo')
+    if kind == 'mongo':
+        # resolved per process, the storage is created before workers fork
+        database = DataAccessObject.database
+        return MongoStorage(database, page_cache=create_page_cache(config, database['pages']))
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError('Unknown STORAGE: %r' % kind)
+
+
+def get_storage():
+    """
+    Returns the storage of the current app, or one on the shared MongoDB
+    database outside of an app.
+    """
+    if has_app_context() and 'storage' in current_app.extensions:
+        return current_app.extensions['storage']
+    return MongoStorage(DataAccessObject.db)
+
+
+def as_storage(database):
+    """
+    Returns the Storage given, or a MongoStorage on the database given.
+    """
+    return database if isinstance(database, Storage) else MongoStorage(database)
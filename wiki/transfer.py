@@ -0,0 +1,247 @@
+"""
+    Transfer
+    ~~~~~~~~
+
+    Bulk import of a directory of Markdown files into the pages collection
+    and export of the collection to Markdown files or NDJSON, run by the
+    import-pages and export-pages commands. Imported pages are rendered in
+    a pool of processes and written in batches. Pages whose stored render
+    hash matches their file are skipped, so an interrupted import continues
+    where it stopped when it is run again.
+"""
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from urllib.parse import quote
+
+from pymongo import ASCENDING, UpdateOne
+
+from wiki.core import Processor, clean_url, extract_links, normalize_tags, render_hash
+
+PAGE_EXTENSIONS = ('.md', '.markdown')
+
+# Stands in for the URL of a page in the URL template of the display view.
+URL_PLACEHOLDER = 'riki-url-placeholder'
+
+# Everything but what the wiki derives from the content again on load.
+EXPORT_PROJECTION = {"_id": 0, "html": 0, "html_hash": 0, "missing_links": 0}
+
+# A "key: value" line of the front matter read by the meta extension.
+META_LINE_REGEX = re.compile(r'^[ ]{0,3}([A-Za-z0-9_-]+):')
+
+# Set in every worker of the pool by _init_worker.
+_known_urls = frozenset()
+_url_formatter = None
+
+
+def scan_pages(directory):
+    """
+    Lists the Markdown files of a directory tree. The URL of the page of a
+    file is its path relative to the directory, without the extension.
+    Parameters:directory (str): The directory to import.
+    Returns:list[tuple]: (url, path) of every file, ordered by URL.
+    """
+    pages = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            name, extension = os.path.splitext(file)
+            if extension.lower() in PAGE_EXTENSIONS:
+                url = clean_url(os.path.relpath(os.path.join(root, name), directory))
+                pages.append((url, os.path.join(root, file)))
+    return sorted(pages)
+
+
+def format_url(url_template, endpoint, url):
+    """
+    Formats the URL of a page from the URL template of the display view,
+    for the workers of the pool, which have no app to call url_for in.
+    """
+    return url_template.replace(URL_PLACEHOLDER, quote(url, safe='/'))
+
+
+def _init_worker(known_urls, url_template):
+    global _known_urls, _url_formatter
+    _known_urls = known_urls
+    _url_formatter = partial(format_url, url_template)
+
+
+def render_document(item):
+    """
+    Renders a page like Page.save does, in a worker of the pool.
+    Parameters:item (tuple): The URL and the content of the page.
+    Returns:dict: The fields of the page document derived from its content.
+    """
+    url, content = item
+    links = extract_links(content)
+    missing_links = [link for link in links if link != url and link not in _known_urls]
+    html, _, meta = Processor(content, missing_links=set(missing_links), url_formatter=_url_formatter).process()
+    tags = meta.get('tags', '')
+    return {
+        "url": url,
+        "content": content,
+        "html": html,
+        "html_hash": render_hash(content),
+        "missing_links": missing_links,
+        "meta": dict(meta),
+        "tags": tags,
+        "tag_list": normalize_tags(tags),
+        "links": links
+    }
+
+
+def write_batch(collection, documents, author):
+    """
+    Upserts a batch of rendered pages in a single bulk write, and drops the
+    stored HTML of the pages that showed a link to a created one as missing.
+    Returns:int: The number of pages written.
+    """
+    current_time = datetime.utcnow()
+    documents = list(documents)
+    requests = [UpdateOne({"url": document["url"]},
+                          {"$set": dict(document, author=author, updated_at=current_time),
+                           "$setOnInsert": {"created_at": current_time}},
+                          upsert=True)
+                for document in documents]
+    result = collection.bulk_write(requests, ordered=False)
+    created = [documents[index]["url"] for index in result.upserted_ids]
+    if created:
+        collection.update_many({"links": {"$in": created}, "missing_links": {"$in": created}},
+                               {"$set": {"html_hash": ""}})
+    return len(requests)
+
+
+def import_pages(collection, pages, author, url_template, batch_size=500, workers=None, progress=None):
+    """
+    Imports Markdown files as pages, batch_size pages at a time. The pages
+    are rendered by a pool of worker processes and written with one bulk
+    write per batch. A page with the same URL is overwritten, unless its
+    stored render hash shows it was imported from the same content before.
+    Parameters:
+        collection (pymongo.collection.Collection): The pages collection.
+        pages (list[tuple]): (url, path) of every file, as returned by scan_pages.
+        author (str): The author of the imported pages.
+        url_template (str): The URL of the display view of URL_PLACEHOLDER.
+        batch_size (int): The number of pages written per bulk write.
+        workers (int): The number of rendering processes, one per CPU by
+            default; 0 renders in this process.
+        progress (function): Called with the number of files of every batch done.
+    Returns:tuple: The number of pages imported and of unchanged pages skipped.
+    """
+    known_urls = frozenset([url for url, path in pages] +
+                           [doc["url"] for doc in collection.find({}, {"_id": 0, "url": 1})])
+    if workers == 0:
+        _init_worker(known_urls, url_template)
+        pool = None
+        render = map
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(known_urls, url_template))
+        chunksize = max(1, batch_size // (4 * (workers or os.cpu_count() or 1)))
+        render = partial(pool.map, chunksize=chunksize)
+    imported = skipped = 0
+    try:
+        for start in range(0, len(pages), batch_size):
+            batch = pages[start:start + batch_size]
+            stored = {doc["url"]: doc.get("html_hash") for doc in collection.find(
+                {"url": {"$in": [url for url, path in batch]}}, {"_id": 0, "url": 1, "html_hash": 1})}
+            items = []
+            for url, path in batch:
+                with open(path, encoding='utf-8') as file:
+                    content = file.read()
+                if stored.get(url) == render_hash(content):
+                    skipped += 1
+                else:
+                    items.append((url, content))
+            if items:
+                imported += write_batch(collection, render(render_document, items), author)
+            if progress:
+                progress(len(batch))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return imported, skipped
+
+
+def page_file(document):
+    """
+    Returns the Markdown file of a page: its content, with the title and
+    tags stored outside of it added to its front matter.
+    Parameters:document (dict): The page document.
+    Returns:str: The content of the file.
+    """
+    content = document.get("content", "")
+    keys = set()
+    for line in content.split('\n'):
+        match = META_LINE_REGEX.match(line)
+        if not match:
+            break
+        keys.add(match.group(1).lower())
+    header = []
+    if 'title' not in keys:
+        header.append("title: %s" % document.get("meta", {}).get("title", document["url"]))
+    if 'tags' not in keys and document.get("tags"):
+        header.append("tags: %s" % document["tags"])
+    if not header:
+        return content
+    # lines added in front of an existing front matter become part of it
+    return '\n'.join(header) + ('\n' if keys else '\n\n') + content
+
+
+def iter_export(collection, after=None, batch_size=500):
+    """
+    Streams the page documents ordered by URL, batch_size per round trip.
+    Parameters:
+        collection (pymongo.collection.Collection): The pages collection.
+        after (str): Only export the pages whose URL sorts after this one.
+        batch_size (int): The number of documents read per round trip.
+    """
+    query = {"url": {"$gt": after}} if after else {}
+    return collection.find(query, EXPORT_PROJECTION).sort("url", ASCENDING).batch_size(batch_size)
+
+
+def page_path(directory, url):
+    """
+    Returns the path of the Markdown file of a page in an export directory.
+    Raises:ValueError: If the URL has an empty, '.' or '..' segment, which
+        would name a file outside the directory, or no file at all.
+    """
+    segments = url.split('/')
+    if any(segment in ('', '.', '..') for segment in segments):
+        raise ValueError('Cannot export the page %r to a file' % url)
+    return os.path.join(directory, *segments) + '.md'
+
+
+def export_files(documents, directory, progress=None):
+    """
+    Writes every page to a Markdown file named after its URL.
+    Returns:str: The URL of the last page written, or None.
+    Raises:ValueError: At the first page whose URL leaves the directory, see page_path.
+    """
+    last_url = None
+    for document in documents:
+        path = page_path(directory, document["url"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(page_file(document))
+        last_url = document["url"]
+        if progress:
+            progress(1)
+    return last_url
+
+
+def export_ndjson(documents, file, progress=None):
+    """
+    Writes every page document as a line of JSON, dates in ISO 8601.
+    Returns:str: The URL of the last page written, or None.
+    """
+    last_url = None
+    for document in documents:
+        file.write(json.dumps(document, ensure_ascii=False,
+                              default=lambda value: value.isoformat()) + '\n')
+        last_url = document["url"]
+        if progress:
+            progress(1)
+    return last_url
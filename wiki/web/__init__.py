@@ -6,7 +6,11 @@ from flask import g
 from flask_login import LoginManager
 from werkzeug.local import LocalProxy
 
+from wiki import DataAccessObject
 from wiki.core import Wiki
+from wiki.storage import MongoStorage, create_storage
+from wiki.web.fragments import create_fragment_cache
+from wiki.web.images import create_image_store
 from wiki.web.user import UserManager
 
 class WikiError(Exception):
@@ -29,6 +33,18 @@ def get_users():
 current_users = LocalProxy(get_users)
 
 
+def get_image_store():
+    return current_app.extensions['image_store']
+
+current_image_store = LocalProxy(get_image_store)
+
+
+def get_fragment_cache():
+    return current_app.extensions['fragment_cache']
+
+current_fragment_cache = LocalProxy(get_fragment_cache)
+
+
 def create_app(directory):
     app = Flask(__name__)
     app.config['RIKI_DIR'] = directory
@@ -41,11 +57,29 @@ def create_app(directory):
         msg = "You need to place a config.py in your content directory."
         raise WikiError(msg)
 
+    # the client itself is created on first use, in every worker process
+    DataAccessObject.configure(app.config)
+    storage = app.extensions['storage'] = create_storage(app.config)
+    # the image store and fragment cache only use the database with the mongo storage
+    database = DataAccessObject.database if isinstance(storage, MongoStorage) else None
+
+    if app.config.get('ENSURE_INDEXES', True) and database is not None:
+        for name, error in DataAccessObject.ensure_indexes():
+            app.logger.warning('Could not create index %s: %s', name, error)
+        Wiki(storage).backfill_tag_lists()
+        Wiki(storage).backfill_links()
+
+    app.extensions['image_store'] = create_image_store(app.config, database)
+    app.extensions['fragment_cache'] = create_fragment_cache(app.config, database)
+
     loginmanager.init_app(app)
 
     from wiki.web.routes import bp
     app.register_blueprint(bp)
 
+    from wiki.cli import register_commands
+    register_commands(app)
+
     return app
 
 
@@ -20,7 +20,8 @@ class URLForm(FlaskForm):
     url = StringField('', validators=[InputRequired()])
 
     def validate_url(self, field):
-        if current_wiki.exists(field.data):
+        # URLs are unique across authors
+        if current_wiki.storage.page_exists(field.data):
             raise ValidationError('The URL "%s" exists already.' % field.data)
 
     def clean_url(self, url):
@@ -0,0 +1,201 @@
+"""
+    Fragments
+    ~~~~~~~~~
+
+    A cache of rendered templates. Every fragment belongs to a group, the
+    URL of the page it shows or LISTINGS for the index and tag listings,
+    and is stored under a key that includes the version of what it shows,
+    so a stale fragment is never looked up. The version of the listings is
+    a generation counter kept in the database, bumped by every write, so
+    that a write on one app node (or by a command) reaches all of them.
+    Fragments are kept in a process-local LRU and, optionally, in a
+    database collection shared by every app node. The groups touched by a
+    page are dropped when the page is saved, moved or deleted.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from wiki.core import page_deleted, page_moved, page_saved
+
+# The group of the listings, which any write to a page may change.
+LISTINGS = ''
+
+
+class SharedFragmentStore(object):
+    """
+    Keeps fragments in a MongoDB collection, so every node of the wiki
+    renders a fragment once. Fragments expire a day after they were stored
+    (the fragment_ttl index of DataAccessObject.INDEXES), so the keys of
+    pages no longer requested do not pile up.
+    """
+
+    def __init__(self, database, collection='fragments'):
+        self.collection = database[collection]
+
+    def get(self, key):
+        document = self.collection.find_one({"_id": key}, {"html": 1})
+        return document["html"] if document else None
+
+    def set(self, group, key, html):
+        try:
+            self.collection.replace_one({"_id": key}, {"group": group, "html": html,
+                                                       "created_at": datetime.utcnow()}, upsert=True)
+        except DuplicateKeyError:
+            pass  # stored by a concurrent render of the same fragment
+
+    def drop(self, group):
+        self.collection.delete_many({"group": group})
+
+
+class ListingGeneration(object):
+    """
+    The generation of the listings, a counter in a MongoDB collection.
+    """
+
+    def __init__(self, database, collection='fragments'):
+        self.collection = database[collection]
+
+    def get(self):
+        document = self.collection.find_one({"_id": "generation"}, {"value": 1})
+        return document["value"] if document else 0
+
+    def bump(self):
+        self.collection.update_one({"_id": "generation"}, {"$inc": {"value": 1}}, upsert=True)
+
+
+class FragmentCache(object):
+    """
+    A least recently used cache of rendered fragments in front of an
+    optional SharedFragmentStore.
+
+    Attributes:
+        maxsize (int): The number of fragments kept in the process.
+        shared (SharedFragmentStore): The shared tier, or None.
+        listing_generation (ListingGeneration): The generation of the
+            listings, or None to count them in the process only.
+        hits (int): The number of lookups answered by either tier.
+        misses (int): The number of lookups that found nothing.
+    """
+
+    def __init__(self, maxsize=256, shared=None, listing_generation=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.listing_generation = listing_generation
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._groups = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return '\0'.join(str(part) for part in key)
+
+    def _store(self, group, key, html):
+        with self._lock:
+            self._fragments[key] = (group, html)
+            self._fragments.move_to_end(key)
+            self._groups.setdefault(group, set()).add(key)
+            while len(self._fragments) > self.maxsize:
+                old_key, (old_group, _) = self._fragments.popitem(last=False)
+                self._groups[old_group].discard(old_key)
+
+    def get(self, key):
+        """
+        Looks a fragment up, in the process first and then in the shared tier.
+        Parameters:key (tuple): The key of the fragment, including its version.
+        Returns:str: The rendered fragment, or None.
+        """
+        key = self._key(key)
+        with self._lock:
+            entry = self._fragments.get(key)
+            if entry is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        html = self.shared.get(key) if self.shared is not None else None
+        if html is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # the group is unknown here; the key is versioned, so the copy can
+        # only age out of the LRU, never be served stale
+        self._store(None, key, html)
+        return html
+
+    def set(self, group, key, html):
+        """
+        Stores a rendered fragment.
+        Parameters:
+            group (str): The URL of the page the fragment shows, or LISTINGS.
+            key (tuple): The key of the fragment, including its version.
+            html (str): The rendered fragment.
+        """
+        key = self._key(key)
+        if self.maxsize > 0:
+            self._store(group, key, html)
+        if self.shared is not None:
+            self.shared.set(group, key, html)
+
+    def generation(self):
+        """
+        Returns the version of the listings, to be part of their keys.
+        """
+        if self.listing_generation is not None:
+            return self.listing_generation.get()
+        return self._generation
+
+    def drop(self, group):
+        """
+        Drops every fragment of a group, in both tiers.
+        Parameters:group (str): The URL of a page, or LISTINGS.
+        """
+        with self._lock:
+            for key in self._groups.pop(group, ()):
+                self._fragments.pop(key, None)
+            if group == LISTINGS:
+                self._generation += 1
+        if self.shared is not None:
+            self.shared.drop(group)
+        if group == LISTINGS and self.listing_generation is not None:
+            self.listing_generation.bump()
+
+    def page_changed(self, url, new_url=None):
+        """
+        Drops the fragments a write to a page made stale: those of the page,
+        of its new URL when it was moved, and the listings.
+        Connected to the page_saved, page_moved and page_deleted signals.
+        """
+        self.drop(url)
+        if new_url is not None:
+            self.drop(new_url)
+        self.drop(LISTINGS)
+
+    def connect(self):
+        """
+        Subscribes the cache to the writes of wiki.core.
+        """
+        for signal in (page_saved, page_moved, page_deleted):
+            signal.connect(self.page_changed)
+
+
+def create_fragment_cache(config, database):
+    """
+    Creates the fragment cache configured by FRAGMENT_CACHE_SIZE and
+    FRAGMENT_CACHE_SHARED and subscribes it to the writes of wiki.core.
+    Parameters:
+        config (flask.Config): The configuration of the app.
+        database (pymongo.database.Database): The database of the wiki, or
+            None without one, when the listings are counted in the process.
+    Returns:FragmentCache: The fragment cache.
+    """
+    shared = None
+    if database is not None and config.get('FRAGMENT_CACHE_SHARED', False):
+        shared = SharedFragmentStore(database)
+    listing_generation = ListingGeneration(database) if database is not None else None
+    cache = FragmentCache(config.get('FRAGMENT_CACHE_SIZE', 256), shared, listing_generation)
+    cache.connect()
+    return cache
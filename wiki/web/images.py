@@ -0,0 +1,292 @@
+"""
+    Images
+    ~~~~~~
+
+    Uploaded page images live in an image store, keyed by the SHA-256 of
+    their content so identical uploads are stored once. The page document
+    references its image by that digest (Page.image_ref). ImageIndex finds
+    the images uploaded to static/Images before the image store existed.
+    Resized variants of every upload are made in the background, when
+    Pillow is installed, and recorded on the image_ref.
+"""
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import gridfs
+
+from wiki import DataAccessObject
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, without it only the original is served
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# (name, width) of the resized variants made of every uploaded image: the
+# thumbnail fills the sidebar, the medium size covers high density screens.
+IMAGE_VARIANTS = (
+    ('thumb', 270),
+    ('medium', 1024),
+)
+
+# Variants are made off the request thread, by a pool created on first use
+# (so after a forking server has forked).
+_variant_pool = None
+_variant_pool_lock = threading.Lock()
+
+
+class ImageIndex(object):
+    """
+    Maps the name (without extension) of every image in a directory to its
+    extension, so finding the image of a page is a dict lookup instead of a
+    walk over the directory. Only the images uploaded to static/Images before
+    the image store existed are in it; new uploads go to the image store, so
+    images are only moved and removed here, along with their pages.
+
+    The index is built on first use. Every lookup compares the modification
+    time of the directory with the one the index was built at and rebuilds it
+    when they differ, which picks up images moved or removed by other
+    workers. move and remove update the index of this worker right away,
+    which also covers filesystems whose coarse modification times do not
+    change for two writes in quick succession.
+
+    Attributes:
+        directory (str): The directory holding the images.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._extensions = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _directory_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self):
+        mtime = self._directory_mtime()
+        if self._extensions is not None and mtime == self._mtime:
+            return
+        with self._lock:
+            extensions = {}
+            for root, dirs, files in os.walk(self.directory):
+                for file in files:
+                    name, extension = os.path.splitext(file)
+                    extensions.setdefault(name, extension)
+            self._extensions = extensions
+            self._mtime = mtime
+
+    def lookup(self, url):
+        """
+        Returns the extension of the image of a page.
+        Parameters:url (str): The URL of the page.
+        Returns:str: The extension, with its leading dot, or None if the page has no image.
+        """
+        self._refresh()
+        return self._extensions.get(os.path.splitext(url)[0])
+
+    def move(self, old_url, new_url):
+        """
+        Records that the image of a page was renamed along with the page.
+        Parameters:
+            old_url (str): The old URL of the page.
+            new_url (str): The new URL of the page.
+        """
+        self._refresh()
+        with self._lock:
+            extension = self._extensions.pop(os.path.splitext(old_url)[0], None)
+            if extension is not None:
+                self._extensions[os.path.splitext(new_url)[0]] = extension
+
+    def remove(self, url):
+        """
+        Records that the image of a page was removed.
+        Parameters:url (str): The URL of the page.
+        """
+        self._refresh()
+        with self._lock:
+            self._extensions.pop(os.path.splitext(url)[0], None)
+
+
+class ImageStore(ABC):
+    """
+    A content-addressed store of image blobs. A subclass implements put and
+    open, it cannot be instantiated otherwise.
+    """
+
+    @abstractmethod
+    def put(self, data):
+        """
+        Stores a blob unless a blob with the same content is stored already.
+        Parameters:data (bytes): The content of the image.
+        Returns:str: The SHA-256 hex digest the blob is stored under.
+        """
+
+    @abstractmethod
+    def open(self, digest):
+        """
+        Opens a blob for reading.
+        Parameters:digest (str): The SHA-256 hex digest of the blob.
+        Returns:tuple: A seekable binary file object and the length of the blob.
+        Raises:KeyError: If there is no such blob.
+        """
+
+
+class LocalImageStore(ImageStore):
+    """
+    Stores the blobs as files in a local directory, fanned out over
+    sub-directories named after the first two characters of the digest.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside and renamed, so readers never see a partial blob
+            handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        return digest
+
+    def open(self, digest):
+        try:
+            file = open(self._path(digest), 'rb')
+        except FileNotFoundError:
+            raise KeyError(digest)
+        return file, os.fstat(file.fileno()).st_size
+
+
+class GridFSImageStore(ImageStore):
+    """
+    Stores the blobs in GridFS, so every node of the wiki serves the same
+    images without a shared filesystem.
+    """
+
+    def __init__(self, database, collection='images'):
+        self.database = database
+        self.collection = collection
+
+    @property
+    def fs(self):
+        # made on every use, so it uses the client of the current process
+        database = self.database
+        if isinstance(database, DataAccessObject.LazyDatabase):
+            database = database.resolve()
+        return gridfs.GridFS(database, self.collection)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.fs.exists(digest):
+            try:
+                self.fs.put(data, _id=digest)
+            except gridfs.errors.FileExists:
+                pass  # stored by a concurrent upload of the same image
+        return digest
+
+    def open(self, digest):
+        try:
+            file = self.fs.get(digest)
+        except gridfs.errors.NoFile:
+            raise KeyError(digest)
+        return file, file.length
+
+
+def create_image_store(config, database):
+    """
+    Creates the image store selected by the IMAGE_STORE setting.
+    Parameters:
+        config (flask.Config): The configuration of the app.
+        database (pymongo.database.Database): The database of the wiki, None without one.
+    Returns:ImageStore: The image store.
+    Raises:ValueError: If the setting names an unknown store, or gridfs without the mongo storage.
+    """
+    backend = config.get('IMAGE_STORE', 'local')
+    if backend == 'gridfs':
+        if database is None:
+            raise ValueError('The gridfs image store needs the mongo storage')
+        return GridFSImageStore(database)
+    if backend == 'local':
+        return LocalImageStore(os.path.join(config['RIKI_DIR'], config.get('IMAGE_STORE_DIR', 'images')))
+    raise ValueError('Unknown IMAGE_STORE: %r' % backend)
+
+
+def make_variants(store, data):
+    """
+    Resizes and recompresses an image into the IMAGE_VARIANTS narrower than
+    it and stores them. Images with transparency stay PNG, all others are
+    recompressed as progressive JPEG.
+    Parameters:
+        store (ImageStore): The store the variants are put in.
+        data (bytes): The content of the original image.
+    Returns:tuple: The width of the original and the variants by name, each
+        a dict with the sha256, extension and width of the variant.
+    """
+    with Image.open(io.BytesIO(data)) as opened:
+        # phone photos are stored sideways with an orientation tag
+        original = ImageOps.exif_transpose(opened)
+    variants = {}
+    for name, width in IMAGE_VARIANTS:
+        if width >= original.width:
+            continue
+        height = max(1, round(original.height * width / original.width))
+        variant = original.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if variant.mode in ('RGBA', 'LA') or 'transparency' in variant.info:
+            variant.save(buffer, 'PNG', optimize=True)
+            extension = '.png'
+        else:
+            variant.convert('RGB').save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+            extension = '.jpg'
+        variants[name] = {"sha256": store.put(buffer.getvalue()), "extension": extension, "width": width}
+    return original.width, variants
+
+
+def generate_variants(store, storage, digest, data):
+    """
+    Makes the variants of an uploaded image and records them on the image_ref
+    of every page showing that image.
+    Parameters:
+        store (ImageStore): The store the variants are put in.
+        storage (wiki.storage.Storage): The storage of the pages.
+        digest (str): The SHA-256 hex digest of the original image.
+        data (bytes): The content of the original image.
+    """
+    try:
+        width, variants = make_variants(store, data)
+    except Exception:
+        logger.exception('Could not make the variants of image %s', digest)
+        return
+    storage.set_image_variants(digest, width, variants)
+
+
+def submit_variants(store, storage, digest, data, workers=2):
+    """
+    Schedules generate_variants on the background pool. Does nothing when
+    Pillow is not installed.
+    Returns:concurrent.futures.Future: The scheduled job, or None.
+    """
+    global _variant_pool
+    if Image is None:
+        return None
+    with _variant_pool_lock:
+        if _variant_pool is None:
+            _variant_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-variants')
+    return _variant_pool.submit(generate_variants, store, storage, digest, data)
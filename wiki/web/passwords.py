@@ -0,0 +1,204 @@
+"""
+    Passwords
+    ~~~~~~~~~
+
+    Password hashers, selected by the PASSWORD_HASHER setting and tuned by
+    PASSWORD_HASHER_OPTIONS. A hash records the hasher and the parameters
+    it was made with, in the PHC string format
+
+        $pbkdf2$digest=sha256,iterations=600000$<salt>$<hash>
+
+    so it stays verifiable after the configured hasher or its cost change,
+    and calibrate finds the cost that makes a hash take a given time.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+from abc import ABC, abstractmethod
+
+SALT_SIZE = 16
+
+# Hasher classes by name, filled by register_hasher.
+HASHERS = {}
+
+
+def register_hasher(cls):
+    """
+    Makes a PasswordHasher subclass selectable by its name.
+    """
+    HASHERS[cls.name] = cls
+    return cls
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher(ABC):
+    """
+    Base class of the password hashers. A subclass sets the attributes and
+    implements derive, it cannot be instantiated otherwise.
+
+    Attributes:
+        name (str): The name of the hasher in the settings and in its hashes.
+        cost_parameter (str): The option calibrate raises to slow the hasher down.
+        defaults (dict): The options used when the settings leave them out.
+        options (dict): The options of this hasher.
+    """
+    name = None
+    cost_parameter = None
+    defaults = {}
+
+    def __init__(self, **options):
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError('Unknown options of the %s hasher: %s' % (self.name, ', '.join(sorted(unknown))))
+        self.options = dict(self.defaults, **options)
+
+    @abstractmethod
+    def derive(self, password, salt):
+        """
+        Derives the hash of a password.
+        Parameters:
+            password (str): The password.
+            salt (bytes): The salt.
+        Returns:bytes: The hash.
+        """
+
+    def encode(self, password):
+        """
+        Hashes a password with a new salt.
+        Returns:str: The hash, with the name and options of the hasher.
+        """
+        salt = os.urandom(SALT_SIZE)
+        parameters = ','.join('%s=%s' % (key, value) for key, value in sorted(self.options.items()))
+        return '$'.join(['', self.name, parameters, _b64encode(salt), _b64encode(self.derive(password, salt))])
+
+    def verify(self, password, salt, digest):
+        """
+        Checks a password against a hash derived with the options of this hasher.
+        Parameters:
+            password (str): The password.
+            salt (bytes): The salt of the hash.
+            digest (bytes): The hash.
+        Returns:bool: True if the password matches.
+        """
+        return hmac.compare_digest(self.derive(password, salt), digest)
+
+
+@register_hasher
+class PBKDF2Hasher(PasswordHasher):
+    name = 'pbkdf2'
+    cost_parameter = 'iterations'
+    defaults = {'digest': 'sha256', 'iterations': 600000}
+
+    def derive(self, password, salt):
+        return hashlib.pbkdf2_hmac(self.options['digest'], password.encode('utf-8'), salt,
+                                   self.options['iterations'])
+
+
+@register_hasher
+class ScryptHasher(PasswordHasher):
+    name = 'scrypt'
+    cost_parameter = 'n'
+    defaults = {'n': 2 ** 15, 'r': 8, 'p': 1}
+
+    def derive(self, password, salt):
+        n, r, p = self.options['n'], self.options['r'], self.options['p']
+        # scrypt needs 128 * n * r bytes, hashlib refuses more than 32 MiB by default
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r, dklen=32)
+
+
+def get_hasher(config):
+    """
+    Creates the hasher selected by the PASSWORD_HASHER setting.
+    Parameters:config (flask.Config): The configuration of the app.
+    Returns:PasswordHasher: The hasher.
+    Raises:ValueError: If the setting names an unknown hasher.
+    """
+    name = config.get('PASSWORD_HASHER', 'pbkdf2')
+    if name not in HASHERS:
+        raise ValueError('Unknown PASSWORD_HASHER: %r' % name)
+    return HASHERS[name](**config.get('PASSWORD_HASHER_OPTIONS', {}))
+
+
+def decode(encoded):
+    """
+    Splits a hash into the hasher it was made with, its salt and digest.
+    Returns:tuple: The PasswordHasher, the salt and the digest.
+    Raises:NotImplementedError: If the hash was made by an unknown hasher.
+    """
+    _, name, parameters, salt, digest = encoded.split('$')
+    if name not in HASHERS:
+        raise NotImplementedError(name)
+    options = {}
+    for parameter in parameters.split(','):
+        key, value = parameter.split('=', 1)
+        options[key] = int(value) if value.isdigit() else value
+    return HASHERS[name](**options), _b64decode(salt), _b64decode(digest)
+
+
+def is_encoded(value):
+    """
+    Tells whether a stored hash was made by one of the HASHERS, as opposed
+    to the SHA-512 hashes of older versions.
+    """
+    return bool(value) and value.startswith('$')
+
+
+def verify_password(password, encoded):
+    """
+    Checks a password against a hash made by one of the HASHERS, with the
+    hasher and parameters recorded in the hash.
+    """
+    hasher, salt, digest = decode(encoded)
+    return hasher.verify(password, salt, digest)
+
+
+def needs_rehash(encoded, hasher):
+    """
+    Tells whether a hash was made by another hasher, or with other options,
+    than the configured one.
+    """
+    if not is_encoded(encoded):
+        return True
+    made_by = decode(encoded)[0]
+    return made_by.name != hasher.name or made_by.options != hasher.options
+
+
+def time_hash(hasher, rounds=3):
+    """
+    Returns the fastest of a few hashes made by a hasher, in seconds.
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.encode('calibration password')
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def calibrate(cls, target, **options):
+    """
+    Finds the cost of a hasher that makes a hash take at least target
+    seconds on this machine, doubling the cost parameter from a cheap start.
+    Parameters:
+        cls (type): The PasswordHasher subclass.
+        target (float): The time a hash should take, in seconds.
+        options: The other options of the hasher, kept as given.
+    Returns:tuple: The options and the time a hash takes with them.
+    """
+    cost = max(1, cls.defaults[cls.cost_parameter] // 64)
+    while True:
+        hasher = cls(**dict(options, **{cls.cost_parameter: cost}))
+        elapsed = time_hash(hasher)
+        if elapsed >= target:
+            return hasher.options, elapsed
+        cost *= 2
@@ -2,39 +2,179 @@
     Routes
     ~~~~~~
 """
+import hashlib
+import mimetypes
 import os.path
 
-from flask import Blueprint, jsonify, session, send_file
+from flask import Blueprint, abort, current_app, jsonify, session, send_file
 from flask import flash
 from flask import redirect
 from flask import render_template
+from flask import stream_template
 from flask import request
 from flask import url_for
 from flask_login import login_required
 from flask_login import login_user
 from flask_login import logout_user
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
-from wiki.core import Processor
+from wiki import DataAccessObject
+from wiki.core import ResultPage, decode_cursor, render_blocks
 from wiki.web import current_users, user
 from wiki.web import current_wiki
+from wiki.web import current_image_store
+from wiki.web import current_fragment_cache
+from wiki.web.fragments import LISTINGS
 from wiki.web.forms import EditorForm, SignUpForm
 from wiki.web.forms import LoginForm
 from wiki.web.forms import SearchForm
 from wiki.web.forms import URLForm
+from wiki.web.images import ImageIndex, submit_variants
 from wiki.web.user import *
 
 bp = Blueprint('wiki', __name__, static_folder='static', static_url_path='/static')
 img = os.path.join(bp.static_folder, 'Images')
+image_index = ImageIndex(img)
 
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# upper bound for the page_size a listing can be requested with
+MAX_PAGE_SIZE = 500
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def page_image_url(page):
+    """
+    Returns the URL the image of a page is served from, '' if it has none.
+    Images uploaded before the image store existed are still served from
+    static/Images. Once its variants are made, the thumbnail is served.
+    """
+    if page.image_ref:
+        if 'thumb' in page.image_ref.get('variants', {}):
+            return url_for('wiki.image', url=page.url, variant='thumb')
+        return url_for('wiki.image', url=page.url)
+    file_extension = image_index.lookup(page.url)
+    if file_extension:
+        return url_for('wiki.static', filename='Images/' + f"{page.url}{file_extension}")
+    return ''
+
+
+def page_image_srcset(page):
+    """
+    Returns the srcset listing every variant of the image of a page and the
+    original with their widths, '' until the variants are made.
+    """
+    image_ref = page.image_ref
+    if not image_ref or not image_ref.get('variants'):
+        return ''
+    variants = sorted(image_ref['variants'].items(), key=lambda item: item[1]['width'])
+    candidates = ['%s %dw' % (url_for('wiki.image', url=page.url, variant=name), variant['width'])
+                  for name, variant in variants]
+    candidates.append('%s %dw' % (url_for('wiki.image', url=page.url), image_ref['width']))
+    return ', '.join(candidates)
+
+
+def private_cache(response):
+    """
+    Lets browsers keep a response of the logged in wiki but revalidate it
+    on every use, and keeps it out of shared caches.
+    """
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def send_image(image_ref, download_name=None):
+    """
+    Streams an image from the image store in chunks. The digest of the image
+    is its ETag, and conditional and Range requests are answered.
+    """
+    try:
+        blob, length = current_image_store.open(image_ref['sha256'])
+    except KeyError:
+        abort(404)
+    mimetype = mimetypes.guess_type('image' + image_ref['extension'])[0] or 'application/octet-stream'
+    response = current_app.response_class(wrap_file(request.environ, blob), mimetype=mimetype,
+                                          direct_passthrough=True)
+    response.content_length = length
+    response.set_etag(image_ref['sha256'])
+    if download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    private_cache(response)
+    response.make_conditional(request, accept_ranges=True, complete_length=length)
+    if response.status_code == 304:
+        blob.close()
+    return response
+
+
+def cached_render(group, key, render):
+    """
+    Returns a rendered template from the fragment cache, rendering and
+    caching it on a miss. Responses carrying flash messages, which are shown
+    only once, are neither served from nor put in the cache.
+
+    :param str group: the URL of the page the template shows, or LISTINGS
+    :param tuple key: the key of the fragment, including its version
+    :param function render: renders the template
+
+    :returns: the rendered template
+    :rtype: str
+    """
+    if session.get('_flashes'):
+        return render()
+    html = current_fragment_cache.get(key)
+    if html is None:
+        html = render()
+        current_fragment_cache.set(group, key, html)
+    return html
+
+
+def requested_page_size():
+    """
+    Returns the page_size argument of the request within 1 and
+    MAX_PAGE_SIZE, or None if it has none (or not a number).
+    """
+    page_size = request.args.get('page_size', type=int)
+    return None if page_size is None else max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def listing_key(name):
+    """
+    Returns the fragment key of a listing as requested: the arguments that
+    select the page of the listing and the login state, which the navigation
+    shows. Other arguments are left out, they do not change the listing.
+    """
+    return (name, request.path, request.args.get('cursor'), requested_page_size(),
+            bool(session.get('is_authenticated')), current_fragment_cache.generation())
+
+
+def paginate(fetch, key, scored=False):
+    """
+    Fetches one page of a keyset paginated listing, as selected by the
+    cursor and page_size arguments of the request.
+
+    :param function fetch: called with after and limit, returns the listing
+    :param function key: returns the sort key of an item of the listing
+    :param bool scored: whether the sort key is a [score, url] pair, rather
+        than a URL or tag
+
+    :returns: the page of the listing
+    :rtype: ResultPage
+    """
+    page_size = requested_page_size() or current_app.config.get('PAGE_SIZE', 50)
+    try:
+        after = decode_cursor(request.args.get('cursor'), scored)
+    except ValueError:
+        abort(400)
+    return ResultPage(fetch(after=after, limit=page_size + 1), page_size, key)
+
+
 @bp.route('/')
 @protect
 def home():
@@ -42,7 +182,7 @@ def home():
     if User.is_authenticated:
         page = current_wiki.get(user_name + '-' + 'home')
         if page:
-            return display(user_name + '-' + 'home')
+            return render_page(page)
         return render_template('home.html')
     return redirect(url_for('user_login'))
 
@@ -50,8 +190,8 @@ def home():
 @bp.route('/index/')
 @protect
 def index():
-    pages = current_wiki.index()
-    return render_template('index.html', pages=pages)
+    return cached_render(LISTINGS, listing_key('index'), lambda: render_template(
+        'index.html', pages=paginate(current_wiki.index, key=lambda page: page.url)))
 
 
 # function used to display profile page
@@ -59,33 +199,54 @@ def index():
 @protect
 def profile():
     user_name = session["unique_id"]
-    all_pages = current_wiki.get_all()
     bio_page = current_wiki.get(user_name + '-' +'bio')
     if bio_page:
-        return display(user_name + '-' + 'bio', pages_sent_by_author=all_pages)
+        return render_page(bio_page, pages_sent_by_author=current_wiki.get_all())
     return render_template('bio.html')
 
 
 @bp.route('/<path:url>/')
 @protect
-def display(url, pages_sent_by_author=None):
+def display(url):
     page = current_wiki.get_or_404(url)
-
+    return render_page(page)
+
+
+def render_page(page, pages_sent_by_author=None):
+    """
+    Renders an already fetched page, so views that looked the page up
+    themselves do not read it from the database a second time.
+
+    The ETag of the response comes from the stored page, the pages linking
+    to it and the user, and a client already holding the current version
+    gets a 304 without the page being rendered. There is no Last-Modified,
+    the save time of the page misses the changes of the pages around it.
+    The profile page lists every page and pending flash messages are shown
+    only once, so neither is answered with a 304.
+    """
+    url = page.url
     user_name = session["unique_id"]
-    file_extension = search_file_in_directory(img, url)
 
-    if file_extension:
-        page_image = f"{url}{file_extension}"
-    else:
-        page_image = ''
-
-    if url == 'home':
-        return render_template('page.html', page=page, image=page_image)
-    elif url == user_name + '-bio':
-        page_bio = current_wiki.get_or_404(url)
-        pages_sent_by_author = current_wiki.get_all()
-        return render_template('page_bio.html', page=page_bio, pages_sent=pages_sent_by_author, image=page_image)
-    return render_template('page.html', page=page, image=page_image)
+    if url == user_name + '-bio':
+        if pages_sent_by_author is None:
+            pages_sent_by_author = current_wiki.get_all()
+        return render_template('page_bio.html', page=page, pages_sent=pages_sent_by_author,
+                               image=page_image_url(page), image_srcset=page_image_srcset(page))
+
+    backlinks = current_wiki.backlinks(url)
+    # the navigation differs by user, and the pages linking here are listed
+    # as well, so both are part of the validator
+    etag = hashlib.sha256("\0".join([page.etag, user_name] + [
+        f"{backlink.url}\0{backlink.title}" for backlink in backlinks]).encode("utf-8")).hexdigest()
+    response = private_cache(current_app.response_class())
+    response.set_etag(etag)
+    if not session.get('_flashes') and not is_resource_modified(request.environ, etag=etag):
+        response.status_code = 304
+        return response
+    response.set_data(cached_render(url, ('page', url, etag), lambda: render_template(
+        'page.html', page=page, image=page_image_url(page), image_srcset=page_image_srcset(page),
+        backlinks=backlinks)))
+    return response
 
 
 @bp.route('/create/', methods=['GET', 'POST'])
@@ -98,31 +259,18 @@ def create():
     return render_template('create.html', form=form)
 
 
-def search_file_in_directory(directory, filename):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            # Compare filenames without extensions
-            if os.path.splitext(file)[0] == os.path.splitext(filename)[0]:
-                file_extension = os.path.splitext(file)[1]
-                return file_extension
-    return None
-
-
 @bp.route('/edit/<path:url>/', methods=['GET', 'POST'])
 @protect
 def edit(url):
     page = current_wiki.get(url)
 
-    file_extension = search_file_in_directory(img, url)
-
-    if file_extension:
-        page_image = f"{url}{file_extension}"
-    else:
-        page_image = ''
-
     if not page:
         page = current_wiki.get_bare(url)
 
+    page_image = page_image_url(page)
+    image_srcset = page_image_srcset(page)
+    uploaded_image = None
+
     form = EditorForm(obj=page)
 
     # Initialize form with page data
@@ -134,10 +282,11 @@ def edit(url):
             file = upload_image
 
             original_file_name = secure_filename(file.filename)
-            file_extension = original_file_name.split('.', 1)[-1]
-            new_file_name = f"{url}.{file_extension}"
+            file_extension = original_file_name.split('.', 1)[-1].lower()
 
-            file.save(os.path.join(img, new_file_name))
+            uploaded_image = file.read()
+            digest = current_image_store.put(uploaded_image)
+            page.image_ref = {"sha256": digest, "extension": f".{file_extension}"}
             flash('Image uploaded successfully!', 'success')
         elif upload_image is None:
             pass
@@ -145,9 +294,14 @@ def edit(url):
             flash('Invalid file type. Allowed types are png, jpg, jpeg.', 'error')
 
         page.save()
+        if uploaded_image is not None:
+            # after the save, so the variants are recorded on the new image_ref
+            submit_variants(current_image_store._get_current_object(), current_wiki.storage,
+                            page.image_ref['sha256'], uploaded_image,
+                            workers=current_app.config.get('IMAGE_VARIANT_WORKERS', 2))
         flash('"%s" was saved.' % page.title, 'success')
         return redirect(url_for('wiki.display', url=url))
-    return render_template('editor.html', form=form, page=page, image=page_image)
+    return render_template('editor.html', form=form, page=page, image=page_image, image_srcset=image_srcset)
 
 
 
@@ -169,10 +323,19 @@ def save(url):
 @bp.route('/preview/', methods=['POST'])
 @protect
 def preview():
-    data = {}
-    processor = Processor(request.form['body'])
-    data['html'], data['body'], data['meta'] = processor.process()
-    return data['html']
+    """
+    Renders the editor preview block by block. A client sending the hashes
+    of the blocks it already shows as known gets the hashes of all blocks,
+    in order, and the HTML of only the blocks it does not have; any other
+    client gets the whole HTML.
+    """
+    blocks = render_blocks(request.form['body'])
+    known = request.form.get('known')
+    if known is None:
+        return '\n'.join(html for digest, html in blocks)
+    known = set(known.split(','))
+    return jsonify(blocks=[digest for digest, html in blocks],
+                   html={digest: html for digest, html in blocks if digest not in known})
 
 
 @bp.route('/move/<path:url>/', methods=['GET', 'POST'])
@@ -182,15 +345,25 @@ def move(url):
     form = URLForm(obj=page)
     if form.validate_on_submit():
         new_url = form.url.data
-        current_wiki.move(url, new_url)
-
-        file_extension = search_file_in_directory(img, url)
+        try:
+            rewritten = current_wiki.move(url, new_url)
+        except RuntimeError:
+            # created by someone else since the form was validated
+            flash('The URL "%s" exists already.' % new_url, 'error')
+            return render_template('move.html', form=form, page=page)
+        if rewritten:
+            flash('Updated the links of %d page(s).' % rewritten, 'success')
+
+        # the image store is keyed by content, only images in static/Images
+        # are named after the page
+        file_extension = None if page.image_ref else image_index.lookup(url)
 
         if file_extension:
             old_image_path = os.path.join(img,f"{url}{file_extension}")
             new_image_path = os.path.join(img,f"{new_url}{file_extension}")
 
             os.rename(old_image_path, new_image_path)
+            image_index.move(url, new_url)
 
         return redirect(url_for('wiki.display', url=new_url))
     return render_template('move.html', form=form, page=page)
@@ -199,9 +372,13 @@ def move(url):
 @bp.route('/download_image/<path:url>/')
 @protect
 def download_image(url):
-    user_name = session["unique_id"]
+    image_ref = current_wiki.get_image_ref(url)
+    if image_ref:
+        return send_image(image_ref, download_name=f"{url}{image_ref['extension']}")
 
-    file_extension = search_file_in_directory(img, url)
+    file_extension = image_index.lookup(url)
+    if not file_extension:
+        abort(404)
 
 
     page_image = f"{url}{file_extension}"
@@ -212,7 +389,21 @@ def download_image(url):
     # Set the filename that the user will see when downloading
     filename = page_image
 
-    return send_file(image_path, as_attachment=True, download_name=filename)
+    return private_cache(send_file(image_path, as_attachment=True, download_name=filename))
+
+
+@bp.route('/image/<path:url>/')
+@protect
+def image(url):
+    image_ref = current_wiki.get_image_ref(url)
+    if not image_ref:
+        abort(404)
+    variant = request.args.get('variant')
+    if variant:
+        image_ref = image_ref.get('variants', {}).get(variant)
+        if not image_ref:
+            abort(404)
+    return send_image(image_ref)
 
 
 @bp.route('/delete/<path:url>/')
@@ -220,6 +411,13 @@ def download_image(url):
 def delete(url):
     page = current_wiki.get_or_404(url)
     current_wiki.delete(url)
+
+    # blobs in the image store may be shared by pages and are left in place
+    file_extension = None if page.image_ref else image_index.lookup(url)
+    if file_extension:
+        os.remove(os.path.join(img, f"{url}{file_extension}"))
+        image_index.remove(url)
+
     flash('Page "%s" was deleted.' % page.title, 'success')
     return redirect(url_for('wiki.home'))
 
@@ -227,31 +425,61 @@ def delete(url):
 @bp.route('/tags/')
 @protect
 def tags():
-    tags = current_wiki.get_tags()
-    return render_template('tags.html', tags=tags)
+    return cached_render(LISTINGS, listing_key('tags'), lambda: render_template('tags.html', tags=paginate(
+        lambda **kwargs: current_wiki.get_tags(**kwargs).items(), key=lambda tag: tag[0])))
 
 
 @bp.route('/tag/<string:name>/')
 @protect
 def tag(name):
-    tagged = current_wiki.index_by_tag(name)
-    return render_template('tag.html', pages=tagged, tag=name)
+    return cached_render(LISTINGS, listing_key('tag'), lambda: render_template('tag.html', tag=name, pages=paginate(
+        lambda **kwargs: current_wiki.index_by_tag(name, **kwargs), key=lambda page: page.url)))
+
+
+@bp.route('/links/broken/')
+@protect
+def broken_links():
+    return render_template('broken_links.html', broken=current_wiki.broken_links())
+
+
+@bp.route('/stats/')
+@protect
+def stats():
+    """
+    The connection pool and cache counters of the worker process serving
+    the request, as JSON.
+    """
+    page_cache = getattr(current_wiki.storage, 'page_cache', None)
+    return jsonify({
+        'connection_pool': DataAccessObject.pool_stats.as_dict(),
+        'fragment_cache': {'hits': current_fragment_cache.hits, 'misses': current_fragment_cache.misses},
+        'page_cache': page_cache.stats() if page_cache is not None else None,
+    })
 
 
 @bp.route('/search/', methods=['GET', 'POST'])
 @protect
 def search():
     form = SearchForm()
-    if form.validate_on_submit():
-        if form.search_by_author.data:
-
-            results = current_wiki.search_by_author(form.term.data)
-        else:
-            results = current_wiki.search(form.term.data, form.ignore_case.data)
+    if not form.validate_on_submit():
+        if not request.args.get('term'):
+            return render_template('search.html', form=form, search=None)
+        # the next pages of the results are requested with GET links
+        form.term.data = request.args['term']
+        form.ignore_case.data = bool(request.args.get('ignore_case', type=int))
+        form.search_by_author.data = bool(request.args.get('search_by_author', type=int))
+
+    if form.search_by_author.data:
+        results = paginate(lambda **kwargs: current_wiki.iter_search_by_author(form.term.data, **kwargs),
+                           key=lambda page: page.url)
+    else:
+        results = paginate(lambda **kwargs: current_wiki.iter_search(form.term.data, form.ignore_case.data,
+                                                                     **kwargs),
+                           key=lambda page: [page.score, page.url], scored=True)
 
-        return render_template('search.html', form=form,
-                               results=results, search=form.term.data)
-    return render_template('search.html', form=form, search=None)
+    # streamed, so the first hits are sent while the rest are still read
+    return stream_template('search.html', form=form,
+                           results=results, search=form.term.data)
 
 
 @bp.route('/user/login/', methods=['GET', 'POST'])
@@ -261,6 +489,7 @@ def user_login():
         user = current_users.get_user(form.name.data)
         session["unique_id"] = form.name.data
         login_user(user)
+        current_users.rehash_if_needed(user, form.password.data)
         user.set('authenticated', True)
         session['is_authenticated'] = True
         flash(f'Login successful, {form.name.data}!', 'success')
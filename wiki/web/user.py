@@ -6,18 +6,78 @@ import os
 import json
 import binascii
 import hashlib
+import hmac
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 from flask import current_app
 from flask_login import current_user
-from wiki import DataAccessObject
+from wiki.storage import MongoStorage, get_storage
+from wiki.web import passwords
 
 
 
-class UserManager(object):
-    """A very simple user Manager, that saves it's data as json."""
+class UserCache(object):
+    """
+    The users this process looked up recently, kept for USER_CACHE_TTL
+    seconds so the user_loader does not read the user from the database on
+    every request. A user changed through this process is dropped right
+    away, other processes see the change once their entry expires.
+    """
+
     def __init__(self):
-        self.collection = DataAccessObject.db.Users
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.monotonic():
+                del self._entries[name]
+                return None
+            return data
+
+    def set(self, name, data, ttl):
+        if ttl > 0:
+            with self._lock:
+                self._entries[name] = (time.monotonic() + ttl, data)
+
+    def drop(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+user_cache = UserCache()
+
+# Rehashes the passwords of users logging in with an outdated hash, off the
+# request thread; a single thread, so rehashing never takes more than a
+# core however many users log in at once.
+_rehash_pool = None
+_rehash_pool_lock = threading.Lock()
+
+
+class UserManager(object):
+    """A very simple user Manager, that saves it's data in the storage of the wiki."""
+
+    def __init__(self, storage=None):
+        self.storage = storage if storage is not None else get_storage()
+        # the users looked up through this manager, which lives as long as
+        # the request (see wiki.web.current_users)
+        self._users = {}
+
+    @property
+    def collection(self):
+        # the MongoDB collection of the users, only there with the mongo storage
+        return self.storage.users
+
+    @collection.setter
+    def collection(self, collection):
+        self.storage = MongoStorage(collection.database, users=collection.name)
 
     def add_user(self, name, password,
                  active=True, roles=[], authentication_method=None):
@@ -33,34 +93,80 @@ class UserManager(object):
         }
 
         if authentication_method == 'hash':
-            new_user['hash'] = make_salted_hash(password)
+            new_user['hash'] = passwords.get_hasher(current_app.config).encode(password)
         elif authentication_method == 'cleartext':
             new_user['password'] = password
         else:
             raise NotImplementedError(authentication_method)
 
-        userdata = self.collection.insert_one(new_user)
-        return User(self, name, userdata)
+        self.storage.insert_user(new_user)
+        self.forget(name)
+        return User(self, name, new_user)
 
     def get_user(self, name):
-        userdata = self.collection.find_one({"name": name})
-
+        """
+        Looks a user up in the users of this request, then in the user cache
+        of the process and only then in the database.
+        """
+        if name not in self._users:
+            userdata = user_cache.get(name)
+            if userdata is None:
+                userdata = self.storage.find_user(name)
+                if userdata:
+                    user_cache.set(name, userdata, current_app.config.get('USER_CACHE_TTL', 30))
+            self._users[name] = userdata
+
+        userdata = self._users[name]
         if not userdata:
             return None
-        return User(self, name, userdata)
+        # a copy, User.set changes its data in place
+        return User(self, name, dict(userdata))
+
+    def rehash_if_needed(self, user, password):
+        """
+        Stores the password of a user who just logged in with it, hashed by
+        the configured hasher, when it is stored in clear text or by another
+        hasher or cost. The hash is made in the background.
+        Parameters:
+            user (User): The user, whose password was checked.
+            password (str): The password the user logged in with.
+        Returns:concurrent.futures.Future: The scheduled rehash, or None.
+        """
+        global _rehash_pool
+        hasher = passwords.get_hasher(current_app.config)
+        if user.get('authentication_method') == 'hash' and not passwords.needs_rehash(user.get('hash'), hasher):
+            return None
+        with _rehash_pool_lock:
+            if _rehash_pool is None:
+                _rehash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rehash')
+        # only replaced if unchanged since the login, e.g. not reset meanwhile
+        stored = {"hash": user.get('hash'), "password": user.get('password')}
+        return _rehash_pool.submit(self._rehash, user.name, stored, hasher, password)
+
+    def _rehash(self, name, stored, hasher, password):
+        self.storage.update_user(name, {"authentication_method": 'hash', "hash": hasher.encode(password)},
+                                 unset=["password"], expected=stored)
+        user_cache.drop(name)
+
+    def forget(self, name):
+        self._users.pop(name, None)
+        user_cache.drop(name)
 
     def delete_user(self, name):
-        user = self.collection.delete_one({"name": name})
-        if not user:
-            return False
-        return True
+        deleted = self.storage.delete_user(name)
+        self.forget(name)
+        return deleted
 
     def update(self, name, userdata):
-        self.collection.update_one({"name": name}, {"$set": userdata})
+        """
+        Sets the given fields of a user, leaving the others as they are.
+        """
+        self.storage.update_user(name, userdata)
+        self.forget(name)
 
     def user_exists(self, name):
         # Check if a user with the given name already exists
-        return self.collection.find_one({'name': name}) is not None
+        return self.storage.find_user(name) is not None
 
 
 class User(object):
@@ -74,7 +180,7 @@ class User(object):
 
     def set(self, option, value):
         self.data[option] = value
-        self.save()
+        self.manager.update(self.name, {option: value})
 
     def save(self):
         self.manager.update(self.name, self.data)
@@ -99,31 +205,36 @@ class User(object):
             authentication_method = get_default_authentication_method()
         # See comment in UserManager.add_user about authentication_method.
         if authentication_method == 'hash':
-            result = check_hashed_password(password, self.get('hash'))
+            if passwords.is_encoded(self.get('hash')):
+                result = passwords.verify_password(password, self.get('hash'))
+            else:
+                result = check_hashed_password(password, self.get('hash'))
         elif authentication_method == 'cleartext':
-            result = (self.get('password') == password)
+            result = hmac.compare_digest((self.get('password') or '').encode('utf-8'), password.encode('utf-8'))
         else:
             raise NotImplementedError(authentication_method)
         return result
 
 
 def get_default_authentication_method():
-    return current_app.config.get('DEFAULT_AUTHENTICATION_METHOD', 'cleartext')
+    return current_app.config.get('DEFAULT_AUTHENTICATION_METHOD', 'hash')
 
 
+# The single SHA-512 hashes of older versions, only verified now; users
+# logging in with one are rehashed by UserManager.rehash_if_needed.
 def make_salted_hash(password, salt=None):
     if not salt:
         salt = os.urandom(64)
     d = hashlib.sha512()
     d.update(salt[:32])
-    d.update(password)
+    d.update(password.encode('utf-8'))
     d.update(salt[32:])
-    return binascii.hexlify(salt) + d.hexdigest()
+    return binascii.hexlify(salt).decode('ascii') + d.hexdigest()
 
 
 def check_hashed_password(password, salted_hash):
     salt = binascii.unhexlify(salted_hash[:128])
-    return make_salted_hash(password, salt) == salted_hash
+    return hmac.compare_digest(make_salted_hash(password, salt), salted_hash)
 
 
 def protect(f):